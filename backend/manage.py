@@ -0,0 +1,93 @@
+"""
+Tarefas de manutenção da base de dados.
+
+Uso: python manage.py <comando> [--corrigir]
+"""
+import argparse
+import asyncio
+import sys
+
+from server import (client, ensure_indexes, find_duplicate_keys, rebuild_rollups, take_due_stock_snapshots,
+                    run_stock_reconciliation, rebuild_atribuicoes, atualizar_previsao_consumo)
+
+
+async def check_duplicates(args):
+    duplicates = await find_duplicate_keys()
+    if not duplicates:
+        print("Sem duplicados. Os índices únicos podem ser criados.")
+        return 0
+    for dup in duplicates:
+        print(f"{dup['colecao']}.{dup['campo']} = {dup['valor']!r}: {dup['total']} registos (ids: {', '.join(map(str, dup['ids']))})")
+    print(f"{len(duplicates)} valor(es) duplicado(s). Resolva-os antes de criar os índices únicos.")
+    return 1
+
+
+async def create_indexes(args):
+    await ensure_indexes()
+    print("Índices verificados.")
+    return 0
+
+
+async def rollups(args):
+    if not args.api_parada:
+        print("Pare a API antes de recalcular os rollups (movimentos gravados durante o cálculo perdem-se) "
+              "e repita com --api-parada.")
+        return 1
+    total = await rebuild_rollups()
+    print(f"{total} rollup(s) mensais recalculados.")
+    return 0
+
+
+async def atribuicoes(args):
+    total = await rebuild_atribuicoes()
+    print(f"{total} intervalo(s) de atribuição recalculados.")
+    return 0
+
+
+async def snapshot_stock(args):
+    tirados = await take_due_stock_snapshots()
+    print(f"{tirados} snapshot(s) de stock criados.")
+    return 0
+
+
+async def reconcile_stock(args):
+    relatorio = await run_stock_reconciliation(corrigir=args.corrigir, origem="manage.py")
+    for d in relatorio["divergencias"]:
+        print(f"{d['codigo']}: stock_atual={d['stock_atual']} ledger={d['saldo_ledger']} diferença={d['diferenca']}")
+    print(f"{relatorio['materiais_verificados']} materiais verificados, {relatorio['total_divergencias']} com divergência, "
+          f"{relatorio['ajustes_criados']} ajuste(s) criados.")
+    return 0
+
+
+async def forecast_consumption(args):
+    execucao = await atualizar_previsao_consumo()
+    print(f"Previsão de consumo de {execucao['materiais']} material(is) em {execucao['segundos']}s; "
+          f"{execucao['a_repor']} a repor.")
+    return 0
+
+
+COMMANDS = {
+    "check-duplicates": check_duplicates,
+    "ensure-indexes": create_indexes,
+    "rebuild-rollups": rollups,
+    "rebuild-atribuicoes": atribuicoes,
+    "snapshot-stock": snapshot_stock,
+    "reconcile-stock": reconcile_stock,
+    "forecast-consumption": forecast_consumption,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--corrigir", action="store_true", help="reconcile-stock: criar movimentos de ajuste")
+    parser.add_argument("--api-parada", action="store_true", help="rebuild-rollups: confirma que a API está parada")
+    args = parser.parse_args()
+    try:
+        return asyncio.run(COMMANDS[args.command](args))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,37 +1,87 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, UploadFile, File, BackgroundTasks, Header, Request
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, UpdateMany, InsertOne, ReplaceOne
+from pymongo.read_concern import ReadConcern
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure, PyMongoError
 import os
 import logging
 import asyncio
+import time
+import random
+import heapq
+import itertools
+from collections import OrderedDict
+import re
+import base64
+import json
+import hashlib
+import unicodedata
+import csv
+import tempfile
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError, BeforeValidator, PlainSerializer, TypeAdapter
+from typing import List, Optional, Annotated
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 from io import BytesIO
+from email.message import EmailMessage
+import smtplib
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from openpyxl import Workbook, load_workbook
 import resend
+import numpy as np
+import pandas as pd
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 resend.api_key = os.environ.get('RESEND_API_KEY', '')
 ALERT_EMAIL = os.environ.get('ALERT_EMAIL', '')
 ALERT_DAYS_BEFORE = int(os.environ.get('ALERT_DAYS_BEFORE', 7))
+STOCK_SNAPSHOT_INTERVAL = os.environ.get('STOCK_SNAPSHOT_INTERVAL', 'dia')  # dia | mes
+STOCK_RECONCILE_INTERVAL_HOURS = float(os.environ.get('STOCK_RECONCILE_INTERVAL_HOURS', 0))  # 0 = só a pedido
+STOCK_RECONCILE_AUTOFIX = os.environ.get('STOCK_RECONCILE_AUTOFIX', 'false').lower() in ['1', 'true', 'sim']
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', 5))
+EVENTS_SOURCE = os.environ.get('EVENTS_SOURCE', 'local')  # local | changestream (vários workers)
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 256))
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
 SENDER_EMAIL = "onboarding@resend.dev"
+EMAIL_TRANSPORT = os.environ.get('EMAIL_TRANSPORT', 'resend')  # resend | smtp | ficheiro (desenvolvimento/testes)
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 1025))
+EMAIL_OUTBOX_DIR = os.environ.get('EMAIL_OUTBOX_DIR', str(ROOT_DIR / 'outbox'))
+EMAIL_MAX_TENTATIVAS = int(os.environ.get('EMAIL_MAX_TENTATIVAS', 6))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 60))
+EMAIL_LEASE_SECONDS = float(os.environ.get('EMAIL_LEASE_SECONDS', 300))
+EMAIL_OUTBOX_POLL_SECONDS = float(os.environ.get('EMAIL_OUTBOX_POLL_SECONDS', 30))
+ALERT_DIGEST_HOUR = int(os.environ.get('ALERT_DIGEST_HOUR', 7))  # hora UTC do resumo diário; -1 desliga
+ODOMETER_GAP_TOLERANCE_KM = float(os.environ.get('ODOMETER_GAP_TOLERANCE_KM', 0))  # lacunas maiores ficam sinalizadas
+INGEST_CHUNK_SIZE = int(os.environ.get('INGEST_CHUNK_SIZE', 1000))  # viagens por insert_many
+INGEST_CACHE_SECONDS = float(os.environ.get('INGEST_CACHE_SECONDS', 300))
+KPI_CACHE_SECONDS = float(os.environ.get('KPI_CACHE_SECONDS', 60))
+FORECAST_INTERVAL_HOURS = float(os.environ.get('FORECAST_INTERVAL_HOURS', 6))  # 0 = só a pedido
+FORECAST_HISTORY_DAYS = int(os.environ.get('FORECAST_HISTORY_DAYS', 365))
+FORECAST_WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS', 28))
+FORECAST_LEAD_TIME_DAYS = float(os.environ.get('FORECAST_LEAD_TIME_DAYS', 7))
+FORECAST_SERVICE_Z = float(os.environ.get('FORECAST_SERVICE_Z', 1.65))  # ~95% de nível de serviço
+XLSX_SPOOL_MAX = int(os.environ.get('XLSX_SPOOL_MAX', 8 * 1024 * 1024))  # bytes em memória antes de passar a disco
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -46,6 +96,46 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# ==================== DATE FUNCTIONS ====================
+def db_ts(value: datetime) -> datetime:
+    """Representação de um instante nos campos de data guardados (data BSON, UTC)"""
+    return value.astimezone(timezone.utc)
+
+def parse_ts(value) -> Optional[datetime]:
+    """Converte uma data guardada (ISO ou datetime) num datetime UTC"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def parse_data_param(value, fim_do_dia: bool = False) -> datetime:
+    """Parâmetro de data da API: 'YYYY-MM-DD' (opcionalmente o fim desse dia), um instante ISO ou uma data já guardada"""
+    parsed = parse_ts(value)
+    if parsed is None:
+        raise HTTPException(status_code=400, detail=f"Data inválida: {value}")
+    if fim_do_dia and isinstance(value, str) and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def _instante(value):
+    """Datas recebidas como texto ISO (ou '' de um campo de formulário vazio)"""
+    if value is None or value == "":
+        return None
+    parsed = parse_ts(value)
+    if parsed is None:
+        raise ValueError("Data inválida")
+    return parsed
+
+# Stored as a BSON date, served by the API as an ISO string
+Instante = Annotated[Optional[datetime], BeforeValidator(_instante),
+                     PlainSerializer(lambda v: v.isoformat(), return_type=str, when_used="json-unless-none")]
+
+
 # ==================== AUTH MODELS ====================
 class UserCreate(BaseModel):
     name: str
@@ -79,13 +169,29 @@ class EquipamentoCreate(BaseModel):
     numero_serie: str = ""
     estado_conservacao: str = "Bom"
     foto: str = ""
-    obra_id: Optional[str] = None
+    data_inspecao: Instante = None
 
 class Equipamento(EquipamentoCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     tipo: str = "Equipamento"
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    obra_id: Optional[str] = None  # changed only by assignment movements
+    version: int = 1
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class EquipamentoUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    codigo: Optional[str] = None
+    descricao: Optional[str] = None
+    marca: Optional[str] = None
+    modelo: Optional[str] = None
+    data_aquisicao: Optional[str] = None
+    ativo: Optional[bool] = None
+    categoria: Optional[str] = None
+    numero_serie: Optional[str] = None
+    estado_conservacao: Optional[str] = None
+    foto: Optional[str] = None
+    data_inspecao: Instante = None
 
 # ==================== VIATURA MODEL ====================
 class ViaturaCreate(BaseModel):
@@ -95,31 +201,64 @@ class ViaturaCreate(BaseModel):
     combustivel: str = "Gasoleo"
     ativa: bool = True
     foto: str = ""
-    data_vistoria: Optional[str] = None
-    data_seguro: Optional[str] = None
+    data_vistoria: Instante = None
+    data_seguro: Instante = None
+    data_tacografo: Instante = None
+    km_ultima_revisao: Optional[float] = None  # None: sem revisão registada, a regra por km não se aplica
     documento_unico: str = ""
     apolice_seguro: str = ""
     observacoes: str = ""
-    obra_id: Optional[str] = None
 
 class Viatura(ViaturaCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    version: int = 1
+    obra_id: Optional[str] = None  # changed only by assignment movements
+    km_atual: Optional[float] = None  # odometer, maintained by the km ledger only
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ViaturaUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    matricula: Optional[str] = None
+    marca: Optional[str] = None
+    modelo: Optional[str] = None
+    combustivel: Optional[str] = None
+    ativa: Optional[bool] = None
+    foto: Optional[str] = None
+    data_vistoria: Instante = None
+    data_seguro: Instante = None
+    data_tacografo: Instante = None
+    km_ultima_revisao: Optional[float] = None
+    documento_unico: Optional[str] = None
+    apolice_seguro: Optional[str] = None
+    observacoes: Optional[str] = None
 
 # ==================== MATERIAL MODEL ====================
-class MaterialCreate(BaseModel):
+class MaterialBase(BaseModel):
     codigo: str
     descricao: str
     unidade: str = "unidade"
-    stock_atual: float = 0
     stock_minimo: float = 0
     ativo: bool = True
 
+class MaterialCreate(MaterialBase):
+    stock_atual: float = 0  # saldo inicial; depois só muda através de movimentos de stock
+
 class Material(MaterialCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    version: int = 1
+    abaixo_minimo: bool = False
+    deficit: float = 0
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class MaterialUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    codigo: Optional[str] = None
+    descricao: Optional[str] = None
+    unidade: Optional[str] = None
+    stock_minimo: Optional[float] = None
+    ativo: Optional[bool] = None
 
 # ==================== OBRA MODEL ====================
 class ObraCreate(BaseModel):
@@ -132,7 +271,21 @@ class ObraCreate(BaseModel):
 class Obra(ObraCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    version: int = 1
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ObraUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    codigo: Optional[str] = None
+    nome: Optional[str] = None
+    endereco: Optional[str] = None
+    cliente: Optional[str] = None
+    estado: Optional[str] = None
+
+class EncerrarObraRequest(BaseModel):
+    estado: str = "Concluida"
+    responsavel_devolveu: str = ""
+    observacoes: str = ""
 
 # ==================== MOVIMENTO MODEL ====================
 class MovimentoCreate(BaseModel):
@@ -142,8 +295,8 @@ class MovimentoCreate(BaseModel):
     obra_id: Optional[str] = None
     responsavel_levantou: str = ""
     responsavel_devolveu: str = ""
-    data_levantamento: Optional[str] = None
-    data_devolucao: Optional[str] = None
+    data_levantamento: Instante = None
+    data_devolucao: Instante = None
     observacoes: str = ""
 
 class AtribuirRecursoRequest(BaseModel):
@@ -151,20 +304,22 @@ class AtribuirRecursoRequest(BaseModel):
     tipo_recurso: str  # equipamento, viatura
     obra_id: str
     responsavel_levantou: str = ""
-    data_levantamento: Optional[str] = None
+    data_levantamento: Instante = None
     observacoes: str = ""
+    id_cliente: Optional[str] = Field(default=None, exclude=True)  # id gerado offline: repetir o pedido não duplica o movimento
 
 class DevolverRecursoRequest(BaseModel):
     recurso_id: str
     tipo_recurso: str  # equipamento, viatura
     responsavel_devolveu: str = ""
-    data_devolucao: Optional[str] = None
+    data_devolucao: Instante = None
     observacoes: str = ""
+    id_cliente: Optional[str] = Field(default=None, exclude=True)
 
 class Movimento(MovimentoCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ==================== MOVIMENTO STOCK MODEL ====================
 class MovimentoStockCreate(BaseModel):
@@ -176,11 +331,12 @@ class MovimentoStockCreate(BaseModel):
     documento: str = ""
     responsavel: str = ""
     observacoes: str = ""
+    id_cliente: Optional[str] = Field(default=None, exclude=True)
 
 class MovimentoStock(MovimentoStockCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    data_hora: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    data_hora: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ==================== MOVIMENTO VIATURA MODEL ====================
 class MovimentoViaturaCreate(BaseModel):
@@ -191,11 +347,90 @@ class MovimentoViaturaCreate(BaseModel):
     km_final: float = 0
     data: str = ""
     observacoes: str = ""
+    id_cliente: Optional[str] = Field(default=None, exclude=True)
 
 class MovimentoViatura(MovimentoViaturaCreate):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    km_anterior: Optional[float] = None
+    lacuna_km: float = 0
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class IngestViagem(BaseModel):
+    """Uma viagem de um ficheiro de telemetria (linha NDJSON ou CSV)"""
+    matricula: str
+    data: Instante
+    km_inicial: float
+    km_final: float
+    condutor: str = ""
+    obra_codigo: Optional[str] = None
+    observacoes: str = ""
+
+# Built once: validating each streamed line skips the model class machinery
+VIAGEM_ADAPTER = TypeAdapter(IngestViagem)
+
+class LoteItem(BaseModel):
+    id_cliente: str
+    tipo: str  # stock, atribuir, devolver, viatura
+    dados: dict
+    registado_em: Instante = None  # quando foi registado no dispositivo
+
+class LoteMovimentosRequest(BaseModel):
+    itens: List[LoteItem]
+
+# ==================== RESERVA MODEL ====================
+class ReservaCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    recurso_id: str
+    tipo_recurso: str  # equipamento, viatura
+    obra_id: str
+    inicio: str
+    fim: str
+    responsavel: str = ""
+    observacoes: str = ""
+
+class Reserva(ReservaCreate):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    inicio: Instante
+    fim: Instante
+    version: int = 1
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ReservaUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    obra_id: Optional[str] = None
+    inicio: Optional[str] = None
+    fim: Optional[str] = None
+    responsavel: Optional[str] = None
+    observacoes: Optional[str] = None
+
+# ==================== REGRA ALERTA MODEL ====================
+class RegraAlertaCreate(BaseModel):
+    nome: str
+    tipo_alerta: str  # vistoria, seguro, tacografo, inspecao, revisao...
+    entidade: str  # viatura, equipamento
+    tipo: str = "data"  # data, km
+    campo: str  # data de expiração, ou km da última intervenção nas regras km
+    antecedencia_dias: int = ALERT_DAYS_BEFORE
+    intervalo_km: float = 0
+    antecedencia_km: float = 0
+    ativa: bool = True
+
+class RegraAlerta(RegraAlertaCreate):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    version: int = 1
+    created_at: Instante = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class RegraAlertaUpdate(BaseModel):
+    nome: Optional[str] = None
+    tipo_alerta: Optional[str] = None
+    campo: Optional[str] = None
+    antecedencia_dias: Optional[int] = None
+    intervalo_km: Optional[float] = None
+    antecedencia_km: Optional[float] = None
+    ativa: Optional[bool] = None
 
 # ==================== AUTH FUNCTIONS ====================
 def hash_password(password: str) -> str:
@@ -212,8 +447,11 @@ def create_token(user_id: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await user_from_token(credentials.credentials)
+
+async def user_from_token(token: str):
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user = await db.users.find_one({"id": payload["sub"]}, {"_id": 0})
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
@@ -223,86 +461,453 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-# ==================== EMAIL FUNCTIONS ====================
-async def send_alert_email(alerts):
-    if not ALERT_EMAIL or not resend.api_key or not alerts:
-        return
+# ==================== VERSIONING FUNCTIONS ====================
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    """Extrai a versão esperada do cabeçalho If-Match ("3", W/"3" ou 3). None = sem verificação"""
+    if if_match is None or if_match.strip() == "*":
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cabeçalho If-Match inválido")
+
+def set_etag(response: Response, doc: dict):
+    response.headers["ETag"] = f'"{doc.get("version", 0)}"'
+
+async def versioned_update(collection, doc_id: str, changes: dict, if_match: Optional[str], response: Response,
+                           not_found: str, duplicate: str = "Registo duplicado", derivados: list = None,
+                           session=None):
+    """Atualiza um documento numa única ida à base de dados, incrementando a versão.
     
-    alerts_html = ""
-    for alert in alerts:
-        tipo = "Vistoria" if alert["tipo_alerta"] == "vistoria" else "Seguro"
-        urgency_class = "color: #dc2626;" if alert["dias_restantes"] <= 0 else "color: #f97316;"
-        status = "EXPIRADO" if alert["dias_restantes"] <= 0 else f"Expira em {alert['dias_restantes']} dias"
-        
-        alerts_html += f"""
-        <tr>
-            <td style="padding: 12px; border-bottom: 1px solid #333;">{alert['matricula']}</td>
-            <td style="padding: 12px; border-bottom: 1px solid #333;">{alert['marca']} {alert['modelo']}</td>
-            <td style="padding: 12px; border-bottom: 1px solid #333;">{tipo}</td>
-            <td style="padding: 12px; border-bottom: 1px solid #333;">{alert['data_expiracao']}</td>
-            <td style="padding: 12px; border-bottom: 1px solid #333; {urgency_class} font-weight: bold;">{status}</td>
-        </tr>
-        """
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <body style="font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #1a1a1a; color: #fff;">
-        <div style="max-width: 600px; margin: 0 auto; background-color: #2a2a2a; border-radius: 4px; overflow: hidden;">
-            <div style="background-color: #f97316; color: #000; padding: 20px; text-align: center;">
-                <h1 style="margin: 0; font-size: 24px;">⚠️ Alertas de Viaturas</h1>
-                <p style="margin: 10px 0 0 0;">José Firmino - Construção Civil</p>
-            </div>
-            <div style="padding: 20px;">
-                <p style="color: #ccc; margin-bottom: 20px;">
-                    As seguintes viaturas têm vistorias ou seguros a expirar nos próximos {ALERT_DAYS_BEFORE} dias:
-                </p>
-                <table style="width: 100%; border-collapse: collapse; font-size: 14px; color: #fff;">
-                    <thead>
-                        <tr style="background-color: #333;">
-                            <th style="padding: 12px; text-align: left;">Matrícula</th>
-                            <th style="padding: 12px; text-align: left;">Viatura</th>
-                            <th style="padding: 12px; text-align: left;">Tipo</th>
-                            <th style="padding: 12px; text-align: left;">Data</th>
-                            <th style="padding: 12px; text-align: left;">Estado</th>
-                        </tr>
-                    </thead>
-                    <tbody>{alerts_html}</tbody>
-                </table>
-            </div>
-        </div>
-    </body>
-    </html>
+    Com If-Match, a atualização só é aplicada se a versão guardada coincidir (senão 412).
+    Documentos anteriores ao versionamento não têm o campo e contam como versão 0.
+    derivados são etapas de pipeline que recalculam campos derivados na mesma escrita.
+    session permite fazer a escrita dentro de uma transação de run_transaction.
     """
+    expected = parse_if_match(if_match)
+    query = {"id": doc_id}
+    if expected is not None:
+        query["version"] = expected if expected > 0 else {"$in": [0, None]}
+    
+    changes = {**changes, **await sync_stamp()}
+    if derivados:
+        # Pipeline form, so derived fields see the new values; $literal keeps "$..." strings as data
+        update = [{"$set": {**{campo: {"$literal": valor} for campo, valor in changes.items()},
+                            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}, *derivados]
+    else:
+        update = {"$inc": {"version": 1}, "$set": changes}
+    
+    try:
+        doc = await collection.find_one_and_update(
+            query, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER, session=session
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail=duplicate)
+    if doc is None:
+        # Only the failure path pays for the extra read that tells 404 from 412
+        if expected is not None and await collection.count_documents({"id": doc_id}, limit=1, session=session):
+            raise HTTPException(status_code=412, detail="O registo foi alterado entretanto. Recarregue e tente novamente.")
+        raise HTTPException(status_code=404, detail=not_found)
     
+    pesquisa = PESQUISA.get(collection.name)
+    if pesquisa and not changes.keys().isdisjoint(pesquisa[1] + pesquisa[2]):
+        # Keys come from the whole document, so a partial update recomputes them afterwards;
+        # matching the version keeps a slower concurrent update from storing stale keys
+        chaves = chaves_pesquisa(collection.name, doc)
+        if chaves != doc.get("chaves_pesquisa"):
+            await collection.update_one({"id": doc_id, "version": doc["version"]}, {"$set": {"chaves_pesquisa": chaves}},
+                                        session=session)
+            doc["chaves_pesquisa"] = chaves
+    
+    set_etag(response, doc)
+    publicar(collection.name, "atualizado", doc)
+    return doc
+
+# ==================== SYNC FUNCTIONS ====================
+# Every write to a synced collection stamps a global, monotonic seq (from the
+# counters collection) and updated_at; deletes leave a tombstone with its own seq.
+SYNC_COLLECTIONS = ["equipamentos", "viaturas", "materiais", "obras",
+                    "movimentos", "movimentos_stock", "movimentos_viaturas"]
+
+async def next_seq(n: int = 1) -> int:
+    """Reserva n números de sequência consecutivos e devolve o último"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": "sync"}, {"$inc": {"seq": n}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def sync_stamp() -> dict:
+    seq = await next_seq()
+    # updated_at is read after the seq is reserved: /sync relies on that ordering
+    return {"seq": seq, "updated_at": db_ts(datetime.now(timezone.utc))}
+
+async def sync_stamp_many(docs: list) -> list:
+    """Carimba cada documento de um lote com um seq próprio"""
+    if not docs:
+        return docs
+    ultimo = await next_seq(len(docs))
+    agora = db_ts(datetime.now(timezone.utc))
+    return [{**doc, "seq": ultimo - len(docs) + 1 + i, "updated_at": agora} for i, doc in enumerate(docs)]
+
+async def write_tombstones(colecao: str, ids: list, session=None):
+    if ids:
+        docs = await sync_stamp_many([{"colecao": colecao, "id": doc_id} for doc_id in ids])
+        await db.tombstones.insert_many(docs, session=session)
+
+async def backfill_sync_stamps(lote: int = 1000) -> int:
+    """Atribui seq/updated_at aos documentos anteriores à sincronização"""
+    total = 0
+    for nome in SYNC_COLLECTIONS:
+        collection = db[nome]
+        if not await collection.find_one({"seq": {"$exists": False}}, {"_id": 1}):
+            continue
+        cursor = collection.find({"seq": {"$exists": False}}, {"_id": 1, "created_at": 1, "data_hora": 1})
+        while batch := await cursor.to_list(lote):
+            ultimo = await next_seq(len(batch))
+            ops = [UpdateOne({"_id": doc["_id"]}, {"$set": {
+                "seq": ultimo - len(batch) + 1 + i,
+                "updated_at": doc.get("created_at") or doc.get("data_hora") or db_ts(datetime.now(timezone.utc))
+            }}) for i, doc in enumerate(batch)]
+            await collection.bulk_write(ops, ordered=False)
+            total += len(batch)
+    return total
+
+# ==================== SEARCH FUNCTIONS ====================
+# colecao -> (tipo, campos de código, campos de texto). Códigos e matrículas pesquisam-se por
+# prefixo do valor compacto ('aa11' encontra 'AA-11-BB'); os textos também pelo índice de texto.
+PESQUISA = {
+    "equipamentos": ("equipamento", ["codigo", "numero_serie"], ["descricao", "marca", "modelo"]),
+    "viaturas": ("viatura", ["matricula"], ["marca", "modelo"]),
+    "materiais": ("material", ["codigo"], ["descricao"]),
+    "obras": ("obra", ["codigo"], ["nome", "cliente"]),
+}
+
+def normalizar(texto) -> str:
+    """Minúsculas sem acentos ('Máquina' -> 'maquina')"""
+    decomposto = unicodedata.normalize("NFKD", str(texto or ""))
+    return "".join(c for c in decomposto if not unicodedata.combining(c)).lower()
+
+def compactar(texto) -> str:
+    return re.sub(r"[^0-9a-z]", "", normalizar(texto))
+
+def chaves_pesquisa(colecao: str, doc: dict) -> list:
+    """Chaves de prefixo de um documento: códigos compactados e palavras dos textos, sem acentos"""
+    _, codigos, textos = PESQUISA[colecao]
+    chaves = {compactar(doc.get(campo)) for campo in codigos}
+    for campo in textos:
+        chaves.update(re.findall(r"[0-9a-z]{2,}", normalizar(doc.get(campo))))
+    chaves.discard("")
+    return sorted(chaves)
+
+def com_chaves_pesquisa(colecao: str, doc: dict) -> dict:
+    return {**doc, "chaves_pesquisa": chaves_pesquisa(colecao, doc)}
+
+# ==================== INDEX FUNCTIONS ====================
+# Natural keys enforced by the database instead of find_one pre-checks
+UNIQUE_KEYS = [
+    ("users", "email"),
+    ("equipamentos", "codigo"),
+    ("viaturas", "matricula"),
+    ("materiais", "codigo"),
+    ("obras", "codigo"),
+    ("relatorios_obra_final", "obra_id"),
+    ("stock_snapshots", "data"),
+    ("previsoes_consumo", "material_id"),
+    ("reservas_guardas", "recurso_id"),
+]
+ID_COLLECTIONS = ["users", "equipamentos", "viaturas", "materiais", "obras",
+                  "movimentos", "movimentos_stock", "movimentos_viaturas", "atribuicoes", "reservas",
+                  "regras_alerta", "email_outbox"]
+
+# Compound indexes: (collection, keys, options)
+COMPOUND_INDEXES = [
+    ("movimentos", [("recurso_id", 1), ("created_at", 1)], {}),
+    ("rollups_mensais", [("tipo", 1), ("obra_id", 1), ("periodo", 1), ("chave", 1)], {"unique": True}),
+    ("atribuicoes", [("recurso_id", 1), ("inicio", 1), ("fim", 1)], {}),
+    ("atribuicoes", [("obra_id", 1), ("inicio", 1)], {}),
+    ("reservas", [("recurso_id", 1), ("inicio", 1)], {}),
+    ("reservas", [("obra_id", 1), ("inicio", 1)], {}),
+    ("equipamentos", [("categoria", 1)], {}),
+    ("movimentos", [("obra_id", 1), ("created_at", -1), ("id", -1)], {}),
+    ("movimentos_stock", [("obra_id", 1), ("data_hora", -1), ("id", -1)], {}),
+    ("movimentos_viaturas", [("obra_id", 1), ("created_at", -1), ("id", -1)], {}),
+    ("tombstones", [("seq", 1)], {}),
+    ("email_outbox", [("estado", 1), ("proxima_tentativa", 1)], {}),
+    ("email_outbox", [("criado_em", -1)], {}),
+    ("alertas_notificados", [("notificado_em", 1)], {"expireAfterSeconds": 365 * 24 * 3600}),
+    ("movimentos", [("created_at", 1)], {}),
+    ("movimentos_stock", [("data_hora", 1)], {}),
+    ("movimentos_viaturas", [("created_at", 1)], {}),
+    ("atribuicoes", [("inicio", 1)], {}),
+    ("movimentos_viaturas", [("viatura_id", 1), ("created_at", -1)], {}),
+    ("idempotency", [("criado_em", 1)], {"expireAfterSeconds": int(IDEMPOTENCY_TTL_HOURS * 3600)}),
+    ("materiais", [("deficit", -1), ("codigo", 1)], {"partialFilterExpression": {"abaixo_minimo": True}}),
+    # Natural key of an ingested trip: replaying a telemetry file inserts nothing twice
+    ("movimentos_viaturas", [("viatura_id", 1), ("created_at", 1), ("km_inicial", 1), ("km_final", 1)],
+     {"unique": True, "name": "viagem_ingerida_unique", "partialFilterExpression": {"ingestao_id": {"$exists": True}}}),
+] + [(nome, [("seq", 1)], {}) for nome in SYNC_COLLECTIONS] + [
+    (nome, [("chaves_pesquisa", 1)], {}) for nome in PESQUISA
+] + [
+    # Text indexes are diacritic-insensitive; codes weigh more than free text
+    (nome, [(campo, "text") for campo in codigos + textos],
+     {"name": "pesquisa_texto", "default_language": "portuguese",
+      "weights": {**{campo: 1 for campo in textos}, **{campo: 5 for campo in codigos}}})
+    for nome, (_, codigos, textos) in PESQUISA.items()
+]
+
+def unique_index_specs():
+    return UNIQUE_KEYS + [(name, "id") for name in ID_COLLECTIONS]
+
+async def find_duplicate_keys():
+    """Lista valores repetidos em campos que devem ser únicos (executar antes de criar os índices)"""
+    report = []
+    for name, field in unique_index_specs():
+        pipeline = [
+            {"$group": {"_id": f"${field}", "total": {"$sum": 1}, "ids": {"$push": "$id"}}},
+            {"$match": {"total": {"$gt": 1}}},
+            {"$sort": {"total": -1}}
+        ]
+        async for group in db[name].aggregate(pipeline, allowDiskUse=True):
+            report.append({"colecao": name, "campo": field, "valor": group["_id"],
+                           "total": group["total"], "ids": group["ids"]})
+    return report
+
+async def ensure_indexes():
+    """Cria os índices únicos. Se já existirem duplicados o índice fica por criar e é registado um aviso."""
+    for name, field in unique_index_specs():
+        try:
+            await db[name].create_index(field, unique=True, name=f"{field}_unique")
+        except (DuplicateKeyError, OperationFailure) as e:
+            logger.warning(f"Unique index on {name}.{field} not created ({e}). "
+                           f"Run 'python manage.py check-duplicates' and resolve the duplicates.")
+    for name, keys, options in COMPOUND_INDEXES:
+        try:
+            await db[name].create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning(f"Index {keys} on {name} not created: {e}")
+
+async def insert_many_ignoring_duplicates(collection, docs: list) -> int:
+    """Insere em lote sem parar nos duplicados; devolve o número de documentos inseridos"""
+    if not docs:
+        return 0
     try:
-        email = await asyncio.to_thread(resend.Emails.send, {
+        result = await collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
+
+# ==================== TRANSACTION FUNCTIONS ====================
+_transactions_supported: Optional[bool] = None
+
+async def transactions_supported() -> bool:
+    """Transações multi-documento só existem em replica sets e clusters (mongos)"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        hello = await client.admin.command("hello")
+        _transactions_supported = bool(hello.get("setName") or hello.get("msg") == "isdbgrid")
+        if not _transactions_supported:
+            logger.warning("MongoDB is running standalone: cascading writes will not be atomic")
+    return _transactions_supported
+
+async def run_transaction(callback):
+    """Executa callback(session) numa transação; numa instância standalone corre com session=None"""
+    if not await transactions_supported():
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+def movimento_devolucao(recurso: dict, tipo_recurso: str, observacoes: str = "", responsavel_devolveu: str = "") -> Movimento:
+    """Movimento de Devolução que fecha a atribuição atual de um recurso"""
+    return Movimento(
+        recurso_id=recurso["id"],
+        tipo_recurso=tipo_recurso,
+        tipo_movimento="Devolucao",
+        obra_id=recurso.get("obra_id"),
+        responsavel_devolveu=responsavel_devolveu,
+        data_devolucao=datetime.now(timezone.utc),
+        observacoes=observacoes
+    )
+
+async def delete_recurso(tipo_recurso: str, recurso_id: str, not_found: str):
+    """Elimina um equipamento/viatura: fecha a atribuição em aberto e marca o histórico como órfão"""
+    collection = db.equipamentos if tipo_recurso == "equipamento" else db.viaturas
+    
+    async def cascade(session):
+        recurso = await collection.find_one_and_delete({"id": recurso_id}, projection={"_id": 0}, session=session)
+        if not recurso:
+            raise HTTPException(status_code=404, detail=not_found)
+        
+        await write_tombstones(f"{tipo_recurso}s", [recurso_id], session=session)
+        if recurso.get("obra_id"):
+            movimento = movimento_devolucao(recurso, tipo_recurso, "Devolução automática: recurso eliminado")
+            doc = {**movimento.model_dump(), **await sync_stamp()}
+            await db.movimentos.insert_one(doc, session=session)
+            await update_rollups([doc], session=session)
+            await update_atribuicoes([doc], session=session)
+        
+        if tipo_recurso == "equipamento":
+            orfao = {"recurso_codigo": recurso.get("codigo", ""), "recurso_descricao": recurso.get("descricao", "")}
+        else:
+            orfao = {"recurso_codigo": recurso.get("matricula", ""),
+                     "recurso_descricao": f"{recurso.get('marca', '')} {recurso.get('modelo', '')}"}
+        await db.movimentos.update_many(
+            {"recurso_id": recurso_id, "tipo_recurso": tipo_recurso},
+            {"$set": {"recurso_eliminado": True, **orfao, **await sync_stamp()}}, session=session
+        )
+        await db.reservas.delete_many({"recurso_id": recurso_id}, session=session)
+        await db.reservas_guardas.delete_one({"recurso_id": recurso_id}, session=session)
+        if tipo_recurso == "viatura":
+            await db.movimentos_viaturas.update_many(
+                {"viatura_id": recurso_id},
+                {"$set": {"viatura_eliminada": True, "viatura_matricula": recurso.get("matricula", ""), **await sync_stamp()}},
+                session=session
+            )
+        return recurso
+    
+    recurso = await run_transaction(cascade)
+    reservas_index.remover_recurso(recurso_id)
+    agenda_alertas.remover_entidade(recurso_id)
+    publicar(f"{tipo_recurso}s", "eliminado", {"id": recurso_id})
+    return recurso
+
+# ==================== EMAIL FUNCTIONS ====================
+# Compiled once at import; rendered per digest
+jinja_env = Environment(loader=FileSystemLoader(ROOT_DIR / "templates"), autoescape=select_autoescape(["html"]))
+TEMPLATE_ALERTAS = jinja_env.get_template("alertas_email.html")
+
+def mensagem_mime(mensagem: dict) -> EmailMessage:
+    email = EmailMessage()
+    email["From"] = SENDER_EMAIL
+    email["To"] = ", ".join(mensagem["para"])
+    email["Subject"] = mensagem["assunto"]
+    email["Message-ID"] = f"<{mensagem['id']}@{SENDER_EMAIL.split('@')[-1]}>"
+    email.set_content("Este email requer um cliente com suporte para HTML.")
+    email.add_alternative(mensagem["html"], subtype="html")
+    return email
+
+class ResendTransport:
+    def configurado(self) -> bool:
+        return bool(resend.api_key)
+    
+    async def enviar(self, mensagem: dict):
+        await asyncio.to_thread(resend.Emails.send, {
             "from": SENDER_EMAIL,
-            "to": [ALERT_EMAIL],
-            "subject": f"⚠️ Alertas de Viaturas - {len(alerts)} alerta(s)",
-            "html": html_content
+            "to": mensagem["para"],
+            "subject": mensagem["assunto"],
+            "html": mensagem["html"]
         })
-        return email
-    except Exception as e:
-        logger.error(f"Failed to send alert email: {str(e)}")
-        raise
+
+class SmtpTransport:
+    """SMTP sem autenticação: um relay interno ou um servidor de debug (python -m aiosmtpd -n)"""
+    
+    def configurado(self) -> bool:
+        return bool(SMTP_HOST)
+    
+    async def enviar(self, mensagem: dict):
+        def enviar():
+            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as smtp:
+                smtp.send_message(mensagem_mime(mensagem))
+        await asyncio.to_thread(enviar)
+
+class FicheiroTransport:
+    """Escreve cada email num ficheiro .eml em EMAIL_OUTBOX_DIR (desenvolvimento e testes)"""
+    
+    def configurado(self) -> bool:
+        return True
+    
+    async def enviar(self, mensagem: dict):
+        pasta = Path(EMAIL_OUTBOX_DIR)
+        pasta.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread((pasta / f"{mensagem['id']}.eml").write_bytes, mensagem_mime(mensagem).as_bytes())
+
+EMAIL_TRANSPORTS = {"resend": ResendTransport(), "smtp": SmtpTransport(), "ficheiro": FicheiroTransport()}
+email_transport = EMAIL_TRANSPORTS[EMAIL_TRANSPORT]
+
+# Outgoing mail is written to email_outbox and delivered by outbox_loop, with
+# exponential backoff between attempts. A message claimed by a worker that dies
+# is retried once its lease expires, so delivery is at least once.
+outbox_acordar = asyncio.Event()
+
+async def enfileirar_email(para: list, assunto: str, html: str, origem: str, session=None) -> dict:
+    agora = datetime.now(timezone.utc)
+    mensagem = {
+        "id": str(uuid.uuid4()),
+        "para": para,
+        "assunto": assunto,
+        "html": html,
+        "origem": origem,
+        "estado": "pendente",  # pendente, a_enviar, enviado, falhado
+        "tentativas": 0,
+        "proxima_tentativa": agora,
+        "criado_em": agora
+    }
+    await db.email_outbox.insert_one({**mensagem}, session=session)
+    return mensagem
+
+async def processar_outbox(limite: int = 50) -> int:
+    """Envia as mensagens da outbox que estão em hora de (nova) tentativa; devolve quantas foram enviadas"""
+    enviadas = 0
+    for _ in range(limite):
+        agora = datetime.now(timezone.utc)
+        mensagem = await db.email_outbox.find_one_and_update(
+            {"estado": {"$in": ["pendente", "a_enviar"]}, "proxima_tentativa": {"$lte": agora}},
+            {"$set": {"estado": "a_enviar", "proxima_tentativa": agora + timedelta(seconds=EMAIL_LEASE_SECONDS)}},
+            sort=[("proxima_tentativa", 1)], projection={"_id": 0}
+        )
+        if not mensagem:
+            break
+        tentativas = mensagem["tentativas"] + 1
+        try:
+            await email_transport.enviar(mensagem)
+        except Exception as e:
+            falhou = tentativas >= EMAIL_MAX_TENTATIVAS
+            espera = EMAIL_RETRY_BASE_SECONDS * 2 ** (tentativas - 1) * random.uniform(0.8, 1.2)
+            await db.email_outbox.update_one({"id": mensagem["id"]}, {"$set": {
+                "estado": "falhado" if falhou else "pendente",
+                "tentativas": tentativas,
+                "ultimo_erro": str(e)[:500],
+                "proxima_tentativa": agora + timedelta(seconds=espera)
+            }})
+            logger.warning(f"Email {mensagem['id']} attempt {tentativas} failed: {e}" + (" (giving up)" if falhou else ""))
+            continue
+        await db.email_outbox.update_one({"id": mensagem["id"]}, {"$set": {
+            "estado": "enviado", "tentativas": tentativas, "enviado_em": datetime.now(timezone.utc)
+        }})
+        enviadas += 1
+    return enviadas
+
+async def outbox_loop():
+    while True:
+        try:
+            await processar_outbox()
+        except Exception:
+            logger.exception("Email outbox job failed")
+        try:
+            await asyncio.wait_for(outbox_acordar.wait(), timeout=EMAIL_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        outbox_acordar.clear()
 
 # ==================== AUTH ROUTES ====================
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(data: UserCreate):
-    existing = await db.users.find_one({"email": data.email})
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
     user_id = str(uuid.uuid4())
     user_doc = {
         "id": user_id,
         "name": data.name,
         "email": data.email,
         "password": hash_password(data.password),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc)
     }
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     token = create_token(user_id)
     return TokenResponse(access_token=token, user=UserResponse(id=user_id, name=data.name, email=data.email))
@@ -357,10 +962,11 @@ async def get_equipamentos(user=Depends(get_current_user)):
     return items
 
 @api_router.get("/equipamentos/{equipamento_id}")
-async def get_equipamento(equipamento_id: str, user=Depends(get_current_user)):
+async def get_equipamento(equipamento_id: str, response: Response, user=Depends(get_current_user)):
     item = await db.equipamentos.find_one({"id": equipamento_id}, {"_id": 0})
     if not item:
         raise HTTPException(status_code=404, detail="Equipamento não encontrado")
+    set_etag(response, item)
     
     # Get obra info if assigned
     obra = None
@@ -385,28 +991,35 @@ async def get_equipamento(equipamento_id: str, user=Depends(get_current_user)):
 
 @api_router.post("/equipamentos")
 async def create_equipamento(data: EquipamentoCreate, user=Depends(get_current_user)):
-    existing = await db.equipamentos.find_one({"codigo": data.codigo}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Código já existe")
-    
     equipamento = Equipamento(**data.model_dump())
-    await db.equipamentos.insert_one(equipamento.model_dump())
+    doc = {**com_chaves_pesquisa("equipamentos", equipamento.model_dump()), **await sync_stamp()}
+    try:
+        await db.equipamentos.insert_one({**doc})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Código já existe")
+    publicar("equipamentos", "criado", doc)
+    agenda_alertas.atualizar_entidade("equipamento", doc)
     return equipamento
 
 @api_router.put("/equipamentos/{equipamento_id}")
-async def update_equipamento(equipamento_id: str, data: EquipamentoCreate, user=Depends(get_current_user)):
-    existing = await db.equipamentos.find_one({"id": equipamento_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Equipamento não encontrado")
-    
-    await db.equipamentos.update_one({"id": equipamento_id}, {"$set": data.model_dump()})
-    return await db.equipamentos.find_one({"id": equipamento_id}, {"_id": 0})
+async def update_equipamento(equipamento_id: str, data: EquipamentoCreate, response: Response,
+                             if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    doc = await versioned_update(db.equipamentos, equipamento_id, data.model_dump(), if_match, response,
+                                 "Equipamento não encontrado", "Código já existe")
+    agenda_alertas.atualizar_entidade("equipamento", doc)
+    return doc
+
+@api_router.patch("/equipamentos/{equipamento_id}")
+async def patch_equipamento(equipamento_id: str, data: EquipamentoUpdate, response: Response,
+                            if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    doc = await versioned_update(db.equipamentos, equipamento_id, data.model_dump(exclude_unset=True), if_match, response,
+                                 "Equipamento não encontrado", "Código já existe")
+    agenda_alertas.atualizar_entidade("equipamento", doc)
+    return doc
 
 @api_router.delete("/equipamentos/{equipamento_id}")
 async def delete_equipamento(equipamento_id: str, user=Depends(get_current_user)):
-    result = await db.equipamentos.delete_one({"id": equipamento_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Equipamento não encontrado")
+    await delete_recurso("equipamento", equipamento_id, "Equipamento não encontrado")
     return {"message": "Equipamento eliminado"}
 
 # ==================== VIATURA ROUTES ====================
@@ -416,10 +1029,11 @@ async def get_viaturas(user=Depends(get_current_user)):
     return items
 
 @api_router.get("/viaturas/{viatura_id}")
-async def get_viatura(viatura_id: str, user=Depends(get_current_user)):
+async def get_viatura(viatura_id: str, response: Response, user=Depends(get_current_user)):
     item = await db.viaturas.find_one({"id": viatura_id}, {"_id": 0})
     if not item:
         raise HTTPException(status_code=404, detail="Viatura não encontrada")
+    set_etag(response, item)
     
     obra = None
     if item.get("obra_id"):
@@ -444,62 +1058,193 @@ async def get_viatura(viatura_id: str, user=Depends(get_current_user)):
     
     return {"viatura": item, "obra_atual": obra, "historico": movimentos, "km_historico": km_movimentos}
 
+@api_router.get("/viaturas/{viatura_id}/km")
+async def get_viatura_km(viatura_id: str, limite: int = 100, user=Depends(get_current_user)):
+    """Odómetro, km por obra e mês, registos com lacunas e últimos registos de km de uma viatura"""
+    viatura = await db.viaturas.find_one({"id": viatura_id}, {"_id": 0, "id": 1, "matricula": 1, "km_atual": 1})
+    if not viatura:
+        raise HTTPException(status_code=404, detail="Viatura não encontrada")
+    limite = max(1, min(limite, 1000))
+    
+    por_obra_mes = await km_por_viatura_obra_mes({"viatura_id": viatura_id})
+    obras = await lookup_by_ids(db.obras, [linha["obra_id"] for linha in por_obra_mes], {"codigo": 1, "nome": 1})
+    for linha in por_obra_mes:
+        linha["obra_codigo"] = obras.get(linha["obra_id"], {}).get("codigo", "")
+    
+    registos = await db.movimentos_viaturas.find({"viatura_id": viatura_id}, {"_id": 0}).sort("created_at", -1).to_list(limite)
+    descontinuidades = await db.movimentos_viaturas.find(
+        {"viatura_id": viatura_id, "lacuna_km": {"$gt": 0}}, {"_id": 0}
+    ).sort("created_at", -1).to_list(limite)
+    return {
+        "viatura_id": viatura_id,
+        "matricula": viatura.get("matricula", ""),
+        "km_atual": viatura.get("km_atual"),
+        "km_total": round(sum(linha["km"] for linha in por_obra_mes), 1),
+        "lacunas_km": round(sum(linha["lacunas_km"] for linha in por_obra_mes), 1),
+        "por_obra_mes": por_obra_mes,
+        "descontinuidades": descontinuidades,
+        "registos": registos
+    }
+
 @api_router.post("/viaturas")
 async def create_viatura(data: ViaturaCreate, user=Depends(get_current_user)):
-    existing = await db.viaturas.find_one({"matricula": data.matricula}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Matrícula já existe")
-    
     viatura = Viatura(**data.model_dump())
-    await db.viaturas.insert_one(viatura.model_dump())
+    doc = {**com_chaves_pesquisa("viaturas", viatura.model_dump()), **await sync_stamp()}
+    try:
+        await db.viaturas.insert_one({**doc})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Matrícula já existe")
+    publicar("viaturas", "criado", doc)
+    agenda_alertas.atualizar_entidade("viatura", doc)
     return viatura
 
 @api_router.put("/viaturas/{viatura_id}")
-async def update_viatura(viatura_id: str, data: ViaturaCreate, user=Depends(get_current_user)):
-    existing = await db.viaturas.find_one({"id": viatura_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Viatura não encontrada")
-    
-    await db.viaturas.update_one({"id": viatura_id}, {"$set": data.model_dump()})
-    return await db.viaturas.find_one({"id": viatura_id}, {"_id": 0})
+async def update_viatura(viatura_id: str, data: ViaturaCreate, response: Response,
+                         if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    doc = await versioned_update(db.viaturas, viatura_id, data.model_dump(), if_match, response,
+                                 "Viatura não encontrada", "Matrícula já existe")
+    agenda_alertas.atualizar_entidade("viatura", doc)
+    return doc
+
+@api_router.patch("/viaturas/{viatura_id}")
+async def patch_viatura(viatura_id: str, data: ViaturaUpdate, response: Response,
+                        if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    doc = await versioned_update(db.viaturas, viatura_id, data.model_dump(exclude_unset=True), if_match, response,
+                                 "Viatura não encontrada", "Matrícula já existe")
+    agenda_alertas.atualizar_entidade("viatura", doc)
+    return doc
 
 @api_router.delete("/viaturas/{viatura_id}")
 async def delete_viatura(viatura_id: str, user=Depends(get_current_user)):
-    result = await db.viaturas.delete_one({"id": viatura_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Viatura não encontrada")
+    await delete_recurso("viatura", viatura_id, "Viatura não encontrada")
     return {"message": "Viatura eliminada"}
 
 # ==================== MATERIAL ROUTES ====================
+# abaixo_minimo and deficit are derived from stock_atual/stock_minimo on every write
+# that touches either, so the low-stock set is read from a partial index.
+ESTADO_STOCK = {"$set": {
+    "abaixo_minimo": {"$and": [{"$gt": ["$stock_minimo", 0]}, {"$lte": ["$stock_atual", "$stock_minimo"]}]},
+    "deficit": {"$max": [0, {"$subtract": ["$stock_minimo", "$stock_atual"]}]}
+}}
+FILTRO_ABAIXO_MINIMO = {"abaixo_minimo": True}
+
+def estado_stock(stock_atual: float, stock_minimo: float) -> dict:
+    """Campos derivados de um material novo (mesma regra que ESTADO_STOCK)"""
+    return {"abaixo_minimo": stock_minimo > 0 and stock_atual <= stock_minimo,
+            "deficit": max(0, stock_minimo - stock_atual)}
+
+def movimentos_saldo_inicial(materiais: list) -> list:
+    """Movimentos SALDO_INICIAL que levam ao ledger o stock com que os materiais foram criados"""
+    return [MovimentoStock(
+        material_id=m["id"],
+        tipo_movimento="Entrada" if m["stock_atual"] > 0 else "Saida",
+        quantidade=abs(m["stock_atual"]),
+        documento="SALDO_INICIAL",
+        observacoes="Saldo inicial do material",
+        data_hora=m["created_at"]
+    ).model_dump() for m in materiais if m.get("stock_atual")]
+
 @api_router.get("/materiais")
 async def get_materiais(user=Depends(get_current_user)):
     return await db.materiais.find({}, {"_id": 0}).to_list(1000)
 
+@api_router.get("/materiais/abaixo-minimo")
+async def get_materiais_abaixo_minimo(limite: int = 200, user=Depends(get_current_user)):
+    """Materiais com stock igual ou inferior ao mínimo, por défice decrescente (lista de reposição)"""
+    limite = max(1, min(limite, 1000))
+    return await db.materiais.find(FILTRO_ABAIXO_MINIMO, {"_id": 0}).sort([("deficit", -1), ("codigo", 1)]).to_list(limite)
+
+@api_router.get("/materiais/reconciliacao")
+async def get_reconciliacao_stock(user=Depends(get_current_user)):
+    """Relatório de divergências entre stock_atual e o ledger (sem alterações)"""
+    return await reconcile_stock()
+
+@api_router.post("/materiais/reconciliacao")
+async def post_reconciliacao_stock(corrigir: bool = False, user=Depends(get_current_user)):
+    """Executa a reconciliação, guarda o relatório e, com corrigir=true, cria os movimentos de ajuste"""
+    return await run_stock_reconciliation(corrigir, "manual", user.get("name", ""))
+
+@api_router.get("/materiais/stock-em")
+async def get_stock_em(data: str, material_id: Optional[str] = None, user=Depends(get_current_user)):
+    """Stock de cada material numa data (fim do dia para 'YYYY-MM-DD'), calculado a partir do ledger"""
+    instante = parse_data_param(data, fim_do_dia=True)
+    estado = await stock_em(instante, material_id)
+    
+    query = {"id": material_id} if material_id else {}
+    materiais = await db.materiais.find(query, {"_id": 0, "id": 1, "codigo": 1, "descricao": 1, "unidade": 1}).to_list(None)
+    return {
+        "data": instante.isoformat(),
+        "snapshot_base": estado["base"],
+        "movimentos_aplicados": estado["movimentos_aplicados"],
+        "materiais": [{**m, "stock": estado["saldos"].get(m["id"], 0)} for m in materiais]
+    }
+
+@api_router.get("/materiais/previsao")
+async def get_previsao_consumo(apenas_repor: bool = False, recalcular: bool = False, user=Depends(get_current_user)):
+    """Consumo diário, variabilidade, dias de cobertura e ponto de encomenda sugerido por material.
+    
+    Servido a partir do último cálculo do job de previsão; recalcular=true calcula agora.
+    """
+    execucao = None
+    if recalcular or not await db.previsoes_consumo.estimated_document_count():
+        execucao = await atualizar_previsao_consumo()
+    previsoes = await db.previsoes_consumo.find({"repor": True} if apenas_repor else {}, {"_id": 0}).to_list(None)
+    previsoes.sort(key=lambda p: (p["dias_cobertura"] is None, p["dias_cobertura"] or 0, p["codigo"]))
+    return {
+        "calculado_em": previsoes[0]["calculado_em"] if previsoes else None,
+        "parametros": {
+            "janela_dias": FORECAST_WINDOW_DAYS,
+            "historico_dias": FORECAST_HISTORY_DAYS,
+            "prazo_reposicao_dias": FORECAST_LEAD_TIME_DAYS,
+            "z_nivel_servico": FORECAST_SERVICE_Z
+        },
+        "execucao": execucao,
+        "materiais": previsoes
+    }
+
 @api_router.post("/materiais")
 async def create_material(data: MaterialCreate, user=Depends(get_current_user)):
-    existing = await db.materiais.find_one({"codigo": data.codigo}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Código já existe")
+    material = Material(**data.model_dump(), **estado_stock(data.stock_atual, data.stock_minimo))
+    doc = {**com_chaves_pesquisa("materiais", material.model_dump()), **await sync_stamp()}
+    # The opening stock is booked in the ledger too, so balances at a date include it
+    saldo_inicial = await sync_stamp_many(movimentos_saldo_inicial([doc]))
     
-    material = Material(**data.model_dump())
-    await db.materiais.insert_one(material.model_dump())
+    async def registar(session):
+        await db.materiais.insert_one({**doc}, session=session)
+        if saldo_inicial:
+            await db.movimentos_stock.insert_many([{**m} for m in saldo_inicial], session=session)
+            await update_rollups(saldo_inicial, session=session)
+    
+    try:
+        await run_transaction(registar)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Código já existe")
+    publicar("materiais", "criado", doc)
+    for movimento in saldo_inicial:
+        publicar("movimentos_stock", "criado", movimento)
     return material
 
 @api_router.put("/materiais/{material_id}")
-async def update_material(material_id: str, data: MaterialCreate, user=Depends(get_current_user)):
-    existing = await db.materiais.find_one({"id": material_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Material não encontrado")
-    
-    await db.materiais.update_one({"id": material_id}, {"$set": data.model_dump()})
-    return await db.materiais.find_one({"id": material_id}, {"_id": 0})
+async def update_material(material_id: str, data: MaterialBase, response: Response,
+                          if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    return await versioned_update(db.materiais, material_id, data.model_dump(), if_match, response,
+                                  "Material não encontrado", "Código já existe", [ESTADO_STOCK])
+
+@api_router.patch("/materiais/{material_id}")
+async def patch_material(material_id: str, data: MaterialUpdate, response: Response,
+                         if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    changes = data.model_dump(exclude_unset=True)
+    derivados = [ESTADO_STOCK] if "stock_minimo" in changes else None
+    return await versioned_update(db.materiais, material_id, changes, if_match, response,
+                                  "Material não encontrado", "Código já existe", derivados)
 
 @api_router.get("/materiais/{material_id}")
-async def get_material_detail(material_id: str, user=Depends(get_current_user)):
+async def get_material_detail(material_id: str, response: Response, user=Depends(get_current_user)):
     """Get material with movement history"""
     material = await db.materiais.find_one({"id": material_id}, {"_id": 0})
     if not material:
         raise HTTPException(status_code=404, detail="Material não encontrado")
+    set_etag(response, material)
     
     # Get movement history
     historico = await db.movimentos_stock.find(
@@ -511,9 +1256,24 @@ async def get_material_detail(material_id: str, user=Depends(get_current_user)):
 
 @api_router.delete("/materiais/{material_id}")
 async def delete_material(material_id: str, user=Depends(get_current_user)):
-    result = await db.materiais.delete_one({"id": material_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Material não encontrado")
+    async def cascade(session):
+        material = await db.materiais.find_one_and_delete({"id": material_id}, projection={"_id": 0}, session=session)
+        if not material:
+            raise HTTPException(status_code=404, detail="Material não encontrado")
+        await write_tombstones("materiais", [material_id], session=session)
+        await db.previsoes_consumo.delete_one({"material_id": material_id}, session=session)
+        
+        # Keep the ledger readable: reports fall back to these fields once the material is gone
+        await db.movimentos_stock.update_many({"material_id": material_id}, {"$set": {
+            "material_eliminado": True,
+            "material_codigo": material.get("codigo", ""),
+            "material_descricao": material.get("descricao", ""),
+            "material_unidade": material.get("unidade", "un"),
+            **await sync_stamp()
+        }}, session=session)
+    
+    await run_transaction(cascade)
+    publicar("materiais", "eliminado", {"id": material_id})
     return {"message": "Material eliminado"}
 
 # ==================== OBRA ROUTES ====================
@@ -522,10 +1282,11 @@ async def get_obras(user=Depends(get_current_user)):
     return await db.obras.find({}, {"_id": 0}).to_list(1000)
 
 @api_router.get("/obras/{obra_id}")
-async def get_obra(obra_id: str, user=Depends(get_current_user)):
+async def get_obra(obra_id: str, response: Response, user=Depends(get_current_user)):
     obra = await db.obras.find_one({"id": obra_id}, {"_id": 0})
     if not obra:
         raise HTTPException(status_code=404, detail="Obra não encontrada")
+    set_etag(response, obra)
     
     equipamentos = await db.equipamentos.find({"obra_id": obra_id}, {"_id": 0}).to_list(1000)
     viaturas = await db.viaturas.find({"obra_id": obra_id}, {"_id": 0}).to_list(1000)
@@ -534,35 +1295,249 @@ async def get_obra(obra_id: str, user=Depends(get_current_user)):
 
 @api_router.post("/obras")
 async def create_obra(data: ObraCreate, user=Depends(get_current_user)):
-    existing = await db.obras.find_one({"codigo": data.codigo}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Código já existe")
-    
     obra = Obra(**data.model_dump())
-    await db.obras.insert_one(obra.model_dump())
+    doc = {**com_chaves_pesquisa("obras", obra.model_dump()), **await sync_stamp()}
+    try:
+        await db.obras.insert_one({**doc})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Código já existe")
+    publicar("obras", "criado", doc)
     return obra
 
+async def atualizar_obra(obra_id: str, changes: dict, if_match: Optional[str], response: Response):
+    """Atualização versionada de uma obra; voltar ao estado Ativa reabre uma obra encerrada"""
+    reabrir = changes.get("estado") == "Ativa"
+    if reabrir:
+        # Clearing encerrada_em lets the obra be closed again
+        changes = {**changes, "encerrada_em": None}
+    doc = await versioned_update(db.obras, obra_id, changes, if_match, response, "Obra não encontrada", "Código já existe")
+    if reabrir:
+        # The frozen report stays for the record but no longer describes the obra
+        await db.relatorios_obra_final.update_one({"obra_id": obra_id, "reaberta_em": None},
+                                                  {"$set": {"reaberta_em": datetime.now(timezone.utc)}})
+    return doc
+
 @api_router.put("/obras/{obra_id}")
-async def update_obra(obra_id: str, data: ObraCreate, user=Depends(get_current_user)):
-    existing = await db.obras.find_one({"id": obra_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Obra não encontrada")
-    
-    await db.obras.update_one({"id": obra_id}, {"$set": data.model_dump()})
-    return await db.obras.find_one({"id": obra_id}, {"_id": 0})
+async def update_obra(obra_id: str, data: ObraCreate, response: Response,
+                      if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    return await atualizar_obra(obra_id, data.model_dump(), if_match, response)
+
+@api_router.patch("/obras/{obra_id}")
+async def patch_obra(obra_id: str, data: ObraUpdate, response: Response,
+                     if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    return await atualizar_obra(obra_id, data.model_dump(exclude_unset=True), if_match, response)
 
 @api_router.delete("/obras/{obra_id}")
 async def delete_obra(obra_id: str, user=Depends(get_current_user)):
-    result = await db.obras.delete_one({"id": obra_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Obra não encontrada")
+    async def cascade(session):
+        obra = await db.obras.find_one_and_delete({"id": obra_id}, projection={"_id": 0}, session=session)
+        if not obra:
+            raise HTTPException(status_code=404, detail="Obra não encontrada")
+        await write_tombstones("obras", [obra_id], session=session)
+        
+        # Close every open assignment with a Devolução, in bulk
+        equipamentos = await db.equipamentos.find({"obra_id": obra_id}, {"_id": 0, "id": 1, "obra_id": 1}, session=session).to_list(None)
+        viaturas = await db.viaturas.find({"obra_id": obra_id}, {"_id": 0, "id": 1, "obra_id": 1}, session=session).to_list(None)
+        observacoes = "Devolução automática: obra eliminada"
+        devolucoes = [movimento_devolucao(e, "equipamento", observacoes).model_dump() for e in equipamentos]
+        devolucoes += [movimento_devolucao(v, "viatura", observacoes).model_dump() for v in viaturas]
+        devolucoes = await sync_stamp_many(devolucoes)
+        if devolucoes:
+            await db.movimentos.insert_many(devolucoes, session=session)
+            await update_rollups(devolucoes, session=session)
+            await update_atribuicoes(devolucoes, session=session)
+        await db.equipamentos.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None, **await sync_stamp()}, "$inc": {"version": 1}},
+                                          session=session)
+        await db.viaturas.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None, **await sync_stamp()}, "$inc": {"version": 1}},
+                                      session=session)
+        
+        # Mark the history as orphaned, keeping the obra identification
+        orfao = {"obra_eliminada": True, "obra_codigo": obra.get("codigo", ""), "obra_nome": obra.get("nome", "")}
+        for ledger in (db.movimentos, db.movimentos_stock, db.movimentos_viaturas):
+            await ledger.update_many({"obra_id": obra_id}, {"$set": {**orfao, **await sync_stamp()}}, session=session)
+        await db.reservas.delete_many({"obra_id": obra_id}, session=session)
+        await db.relatorios_obra_final.delete_many({"obra_id": obra_id}, session=session)
     
-    # Remove obra association from resources
-    await db.equipamentos.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None}})
-    await db.viaturas.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None}})
+    await run_transaction(cascade)
+    reservas_index.remover_obra(obra_id)
+    publicar("obras", "eliminado", {"id": obra_id})
     return {"message": "Obra eliminada"}
 
+@api_router.post("/obras/{obra_id}/encerrar")
+async def encerrar_obra(obra_id: str, data: EncerrarObraRequest, user=Depends(get_current_user)):
+    """Encerrar obra: devolve todos os recursos e congela o relatório final"""
+    if data.estado == "Ativa":
+        raise HTTPException(status_code=400, detail="Estado de encerramento inválido")
+    
+    async def encerrar(session):
+        agora = datetime.now(timezone.utc)
+        obra = await db.obras.find_one_and_update(
+            {"id": obra_id, "encerrada_em": None},
+            {"$set": {"estado": data.estado, "encerrada_em": agora, **await sync_stamp()}, "$inc": {"version": 1}},
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER, session=session
+        )
+        if not obra:
+            if await db.obras.count_documents({"id": obra_id}, limit=1, session=session):
+                raise HTTPException(status_code=400, detail="Obra já encerrada")
+            raise HTTPException(status_code=404, detail="Obra não encontrada")
+        
+        equipamentos = await db.equipamentos.find({"obra_id": obra_id}, {"_id": 0}, session=session).to_list(None)
+        viaturas = await db.viaturas.find({"obra_id": obra_id}, {"_id": 0}, session=session).to_list(None)
+        observacoes = data.observacoes or "Devolução por encerramento da obra"
+        devolucoes = [movimento_devolucao(e, "equipamento", observacoes, data.responsavel_devolveu).model_dump() for e in equipamentos]
+        devolucoes += [movimento_devolucao(v, "viatura", observacoes, data.responsavel_devolveu).model_dump() for v in viaturas]
+        devolucoes = await sync_stamp_many(devolucoes)
+        if devolucoes:
+            await db.movimentos.insert_many(devolucoes, session=session)
+            await update_rollups(devolucoes, session=session)
+            await update_atribuicoes(devolucoes, session=session)
+        await db.equipamentos.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None, **await sync_stamp()}, "$inc": {"version": 1}},
+                                          session=session)
+        await db.viaturas.update_many({"obra_id": obra_id}, {"$set": {"obra_id": None, **await sync_stamp()}, "$inc": {"version": 1}},
+                                      session=session)
+        await db.reservas.delete_many({"obra_id": obra_id}, session=session)
+        
+        relatorio = await build_relatorio_obra(obra, session=session)
+        relatorio["recursos_devolvidos"] = {"equipamentos": equipamentos, "viaturas": viaturas}
+        snapshot = {
+            "id": str(uuid.uuid4()),
+            "obra_id": obra_id,
+            "encerrada_em": agora,
+            "encerrada_por": user.get("name", ""),
+            "relatorio": relatorio
+        }
+        # Closing a reopened obra replaces the report of the previous closure
+        await db.relatorios_obra_final.replace_one({"obra_id": obra_id}, {**snapshot}, upsert=True, session=session)
+        return obra, snapshot
+    
+    obra, snapshot = await run_transaction(encerrar)
+    reservas_index.remover_obra(obra_id)
+    publicar("obras", "atualizado", obra)
+    return {
+        "message": "Obra encerrada",
+        "equipamentos_devolvidos": len(snapshot["relatorio"]["recursos_devolvidos"]["equipamentos"]),
+        "viaturas_devolvidas": len(snapshot["relatorio"]["recursos_devolvidos"]["viaturas"]),
+        "relatorio_final": snapshot
+    }
+
+async def relatorio_final_em_vigor(obra: dict) -> Optional[dict]:
+    """Relatório congelado do encerramento atual; uma obra ativa (ou reaberta) não tem nenhum"""
+    if not obra.get("encerrada_em"):
+        return None
+    return await db.relatorios_obra_final.find_one({"obra_id": obra["id"], "reaberta_em": None}, {"_id": 0})
+
+@api_router.get("/obras/{obra_id}/relatorio-final")
+async def get_relatorio_final_obra(obra_id: str, user=Depends(get_current_user)):
+    obra = await db.obras.find_one({"id": obra_id}, {"_id": 0, "id": 1, "encerrada_em": 1})
+    if not obra:
+        raise HTTPException(status_code=404, detail="Obra não encontrada")
+    snapshot = await relatorio_final_em_vigor(obra)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Obra sem relatório final")
+    return snapshot
+
+# Timeline sources: (fonte, collection, timestamp field), merged newest first by (data, fonte, id)
+TIMELINE_FONTES = [
+    ("ativos", "movimentos", "created_at"),
+    ("stock", "movimentos_stock", "data_hora"),
+    ("viaturas", "movimentos_viaturas", "created_at"),
+]
+
+class _Desc:
+    """Chave invertida para usar o heapq (min-heap) numa fusão por ordem decrescente"""
+    __slots__ = ("chave",)
+    
+    def __init__(self, chave):
+        self.chave = chave
+    
+    def __lt__(self, other):
+        return self.chave > other.chave
+
+def encode_timeline_cursor(chave: tuple) -> str:
+    data, fonte, doc_id = chave
+    data = data.isoformat() if isinstance(data, datetime) else data
+    return base64.urlsafe_b64encode(json.dumps([data, fonte, doc_id]).encode()).decode()
+
+def decode_timeline_cursor(cursor: str) -> tuple:
+    try:
+        data, fonte, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    instante = parse_ts(data)
+    if instante is None:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return db_ts(instante), fonte, doc_id
+
+def timeline_query(obra_id: str, fonte: str, campo: str, apos: Optional[tuple]) -> dict:
+    """Linhas de uma fonte estritamente depois (na ordem decrescente) da chave apos"""
+    query = {"obra_id": obra_id}
+    if apos:
+        data, fonte_apos, doc_id = apos
+        if fonte < fonte_apos:
+            query[campo] = {"$lte": data}
+        elif fonte > fonte_apos:
+            query[campo] = {"$lt": data}
+        else:
+            query["$or"] = [{campo: {"$lt": data}}, {campo: data, "id": {"$lt": doc_id}}]
+    return query
+
+async def merge_timeline(obra_id: str, limite: int, apos: Optional[tuple]) -> list:
+    """Fusão k-way dos três ledgers, lendo no máximo limite + 1 linhas de cada cursor"""
+    cursores, heap = {}, []
+    for fonte, nome, campo in TIMELINE_FONTES:
+        cursor = db[nome].find(timeline_query(obra_id, fonte, campo, apos), {"_id": 0}) \
+            .sort([(campo, -1), ("id", -1)]).limit(limite + 1).batch_size(limite + 1)
+        cursores[fonte] = (cursor, campo)
+    
+    async def avancar(fonte):
+        cursor, campo = cursores[fonte]
+        doc = await anext(cursor, None)
+        if doc is not None:
+            heapq.heappush(heap, (_Desc((doc.get(campo), fonte, doc["id"])), doc))
+    
+    for fonte in cursores:
+        await avancar(fonte)
+    pagina = []
+    while heap and len(pagina) <= limite:
+        chave, doc = heapq.heappop(heap)
+        pagina.append((chave.chave, doc))
+        await avancar(chave.chave[1])
+    return pagina
+
+@api_router.get("/obras/{obra_id}/timeline")
+async def get_obra_timeline(obra_id: str, limite: int = 50, cursor: Optional[str] = None, user=Depends(get_current_user)):
+    """Atividade da obra (ativos, stock e viaturas) por ordem cronológica inversa, paginada por cursor"""
+    if not await db.obras.count_documents({"id": obra_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Obra não encontrada")
+    limite = max(1, min(limite, 200))
+    pagina = await merge_timeline(obra_id, limite, decode_timeline_cursor(cursor) if cursor else None)
+    proximo = encode_timeline_cursor(pagina[limite - 1][0]) if len(pagina) > limite else None
+    pagina = pagina[:limite]
+    
+    docs = [doc for _, doc in pagina]
+    equipamentos = await lookup_by_ids(db.equipamentos, [d["recurso_id"] for d in docs if d.get("tipo_recurso") == "equipamento"],
+                                       {"codigo": 1, "descricao": 1})
+    viaturas = await lookup_by_ids(db.viaturas, [d.get("recurso_id") or d.get("viatura_id") for d in docs
+                                                 if d.get("tipo_recurso") == "viatura" or "viatura_id" in d],
+                                   {"matricula": 1, "marca": 1, "modelo": 1})
+    materiais = await lookup_by_ids(db.materiais, [d.get("material_id") for d in docs], {"codigo": 1, "descricao": 1, "unidade": 1})
+    
+    items = []
+    for (data, fonte, _), doc in pagina:
+        item = {"fonte": fonte, "data": data, **doc}
+        if fonte == "ativos":
+            item["recurso"] = (equipamentos if doc.get("tipo_recurso") == "equipamento" else viaturas).get(doc["recurso_id"])
+        elif fonte == "stock":
+            item["material"] = materiais.get(doc["material_id"]) or material_eliminado(doc)
+        else:
+            item["viatura"] = viaturas.get(doc["viatura_id"])
+        items.append(item)
+    return {"items": items, "proximo_cursor": proximo}
+
 # ==================== MOVIMENTO (Atribuição) ROUTES ====================
+def id_movimento(data) -> dict:
+    return {"id": data.id_cliente} if data.id_cliente else {}
+
 @api_router.post("/movimentos/atribuir")
 async def atribuir_recurso(data: AtribuirRecursoRequest, user=Depends(get_current_user)):
     """Atribuir equipamento ou viatura a uma obra"""
@@ -580,6 +1555,17 @@ async def atribuir_recurso(data: AtribuirRecursoRequest, user=Depends(get_curren
             detail=f"Este recurso já está atribuído à obra: {obra_atual['nome'] if obra_atual else 'Desconhecida'}"
         )
     
+    # A reservation covering the assignment date belongs to its obra
+    instante = parse_ts(data.data_levantamento) or datetime.now(timezone.utc)
+    reserva = next((r for r in reservas_index.conflitos(data.recurso_id, instante, instante + timedelta(seconds=1))
+                    if r["obra_id"] != data.obra_id), None)
+    if reserva:
+        obra_reserva = await db.obras.find_one({"id": reserva["obra_id"]}, {"_id": 0, "nome": 1})
+        raise HTTPException(
+            status_code=400,
+            detail=f"Este recurso está reservado para a obra: {obra_reserva['nome'] if obra_reserva else 'Desconhecida'}"
+        )
+    
     # Create movement record
     movimento = Movimento(
         recurso_id=data.recurso_id,
@@ -587,13 +1573,26 @@ async def atribuir_recurso(data: AtribuirRecursoRequest, user=Depends(get_curren
         tipo_movimento="Saida",
         obra_id=data.obra_id,
         responsavel_levantou=data.responsavel_levantou,
-        data_levantamento=data.data_levantamento or datetime.now(timezone.utc).isoformat(),
-        observacoes=data.observacoes
+        data_levantamento=data.data_levantamento or datetime.now(timezone.utc),
+        observacoes=data.observacoes,
+        **id_movimento(data)
     )
-    await db.movimentos.insert_one(movimento.model_dump())
+    doc = {**movimento.model_dump(), **await sync_stamp()}
+    try:
+        await db.movimentos.insert_one(doc)
+    except DuplicateKeyError:
+        return {"message": "Recurso atribuído com sucesso", "movimento_id": movimento.id}
+    await update_rollups([doc])
+    await update_atribuicoes([doc])
     
     # Update resource
-    await collection.update_one({"id": data.recurso_id}, {"$set": {"obra_id": data.obra_id}})
+    carimbo = await sync_stamp()
+    atualizado = await collection.find_one_and_update(
+        {"id": data.recurso_id}, {"$set": {"obra_id": data.obra_id, **carimbo}, "$inc": {"version": 1}},
+        projection={"_id": 0, "version": 1}, return_document=ReturnDocument.AFTER
+    )
+    publicar("movimentos", "criado", doc)
+    publicar(f"{data.tipo_recurso}s", "atualizado", {"id": data.recurso_id, "obra_id": data.obra_id, **(atualizado or {}), **carimbo})
     
     return {"message": "Recurso atribuído com sucesso", "movimento_id": movimento.id}
 
@@ -606,6 +1605,15 @@ async def devolver_recurso(data: DevolverRecursoRequest, user=Depends(get_curren
     if not recurso:
         raise HTTPException(status_code=404, detail="Recurso não encontrado")
     
+    # A return can't end the open assignment before it started
+    data_devolucao = data.data_devolucao or datetime.now(timezone.utc)
+    aberta = await db.atribuicoes.find_one({"recurso_id": data.recurso_id, "fim": None}, {"_id": 0, "inicio": 1})
+    if aberta and data_devolucao < parse_ts(aberta["inicio"]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"A data de devolução é anterior ao levantamento ({parse_ts(aberta['inicio']).date().isoformat()})"
+        )
+    
     # Create movement record
     movimento = Movimento(
         recurso_id=data.recurso_id,
@@ -613,13 +1621,26 @@ async def devolver_recurso(data: DevolverRecursoRequest, user=Depends(get_curren
         tipo_movimento="Devolucao",
         obra_id=recurso.get("obra_id"),
         responsavel_devolveu=data.responsavel_devolveu,
-        data_devolucao=data.data_devolucao or datetime.now(timezone.utc).isoformat(),
-        observacoes=data.observacoes
+        data_devolucao=data_devolucao,
+        observacoes=data.observacoes,
+        **id_movimento(data)
     )
-    await db.movimentos.insert_one(movimento.model_dump())
+    doc = {**movimento.model_dump(), **await sync_stamp()}
+    try:
+        await db.movimentos.insert_one(doc)
+    except DuplicateKeyError:
+        return {"message": "Recurso devolvido com sucesso", "movimento_id": movimento.id}
+    await update_rollups([doc])
+    await update_atribuicoes([doc])
     
     # Remove obra association
-    await collection.update_one({"id": data.recurso_id}, {"$set": {"obra_id": None}})
+    carimbo = await sync_stamp()
+    atualizado = await collection.find_one_and_update(
+        {"id": data.recurso_id}, {"$set": {"obra_id": None, **carimbo}, "$inc": {"version": 1}},
+        projection={"_id": 0, "version": 1}, return_document=ReturnDocument.AFTER
+    )
+    publicar("movimentos", "criado", doc)
+    publicar(f"{data.tipo_recurso}s", "atualizado", {"id": data.recurso_id, "obra_id": None, **(atualizado or {}), **carimbo})
     
     return {"message": "Recurso devolvido com sucesso", "movimento_id": movimento.id}
 
@@ -634,17 +1655,31 @@ async def get_movimentos_stock(user=Depends(get_current_user)):
 
 @api_router.post("/movimentos/stock")
 async def create_movimento_stock(data: MovimentoStockCreate, user=Depends(get_current_user)):
-    movimento = MovimentoStock(**data.model_dump())
-    await db.movimentos_stock.insert_one(movimento.model_dump())
+    movimento = MovimentoStock(**data.model_dump(), **id_movimento(data))
+    doc = {**movimento.model_dump(), **await sync_stamp()}
+    variacao = data.quantidade if data.tipo_movimento == "Entrada" else -data.quantidade
+    carimbo = await sync_stamp()
     
-    material = await db.materiais.find_one({"id": data.material_id}, {"_id": 0})
+    async def registar(session):
+        # Ledger and stock_atual change together, so a snapshot read never sees only one of them
+        await db.movimentos_stock.insert_one({**doc}, session=session)
+        await update_rollups([doc], session=session)
+        return await db.materiais.find_one_and_update(
+            {"id": data.material_id},
+            [{"$set": {"stock_atual": {"$add": [{"$ifNull": ["$stock_atual", 0]}, variacao]},
+                       "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}, **carimbo}}, ESTADO_STOCK],
+            projection={"_id": 0, "stock_atual": 1, "abaixo_minimo": 1, "deficit": 1, "version": 1},
+            return_document=ReturnDocument.AFTER, session=session
+        )
+    
+    try:
+        material = await run_transaction(registar)
+    except DuplicateKeyError:
+        # Replayed offline movement: already applied, including the stock change
+        return await db.movimentos_stock.find_one({"id": movimento.id}, {"_id": 0})
     if material:
-        new_stock = material.get("stock_atual", 0)
-        if data.tipo_movimento == "Entrada":
-            new_stock += data.quantidade
-        else:
-            new_stock -= data.quantidade
-        await db.materiais.update_one({"id": data.material_id}, {"$set": {"stock_atual": new_stock}})
+        publicar("materiais", "atualizado", {"id": data.material_id, **material, **carimbo})
+    publicar("movimentos_stock", "criado", doc)
     
     return movimento
 
@@ -655,73 +1690,886 @@ async def get_movimentos_viaturas(user=Depends(get_current_user)):
 
 @api_router.post("/movimentos/viaturas")
 async def create_movimento_viatura(data: MovimentoViaturaCreate, user=Depends(get_current_user)):
-    movimento = MovimentoViatura(**data.model_dump())
-    await db.movimentos_viaturas.insert_one(movimento.model_dump())
-    return movimento
-
-# ==================== ALERTS ROUTES ====================
-@api_router.get("/alerts/check")
-async def check_alerts(user=Depends(get_current_user)):
-    viaturas = await db.viaturas.find({"ativa": True}, {"_id": 0}).to_list(1000)
-    today = datetime.now(timezone.utc).date()
-    alerts = []
+    """Regista uma deslocação e avança o odómetro da viatura.
     
-    for v in viaturas:
-        for field, tipo in [("data_vistoria", "vistoria"), ("data_seguro", "seguro")]:
-            if v.get(field):
-                try:
-                    date = datetime.fromisoformat(v[field].replace("Z", "+00:00")).date()
-                    days_until = (date - today).days
-                    if days_until <= ALERT_DAYS_BEFORE:
-                        alerts.append({
-                            "viatura_id": v["id"],
-                            "matricula": v["matricula"],
-                            "marca": v.get("marca", ""),
-                            "modelo": v.get("modelo", ""),
-                            "tipo_alerta": tipo,
-                            "data_expiracao": date.strftime("%d/%m/%Y"),
-                            "dias_restantes": days_until
-                        })
-                except:
-                    pass
-    
-    return {"alerts": alerts, "total": len(alerts)}
-
-@api_router.post("/alerts/send")
-async def send_alerts(user=Depends(get_current_user)):
-    if not ALERT_EMAIL or not resend.api_key:
-        raise HTTPException(status_code=400, detail="Configuração de email incompleta")
+    O km inicial tem de continuar o odómetro: abaixo dele o registo é rejeitado (409), acima
+    fica guardado com a lacuna sinalizada. Sem km inicial, parte do odómetro atual.
+    Um registo sem km (ambos a 0) não mexe no odómetro.
+    """
+    movimento = MovimentoViatura(**data.model_dump(), **id_movimento(data))
+    if movimento.km_inicial < 0 or movimento.km_final < 0:
+        raise HTTPException(status_code=400, detail="Os km não podem ser negativos")
+    if movimento.km_inicial and movimento.km_final < movimento.km_inicial:
+        raise HTTPException(status_code=400, detail="Km final inferior ao km inicial")
     
-    check_result = await check_alerts(user)
-    alerts = check_result["alerts"]
+    com_km = movimento.km_inicial > 0 or movimento.km_final > 0
+    carimbo = await sync_stamp()
     
-    if not alerts:
-        return {"status": "success", "message": "Não há alertas para enviar", "alerts_count": 0}
+    async def registar(session):
+        # No shared state is mutated: with_transaction may run this more than once
+        if not com_km:
+            if not await db.viaturas.count_documents({"id": data.viatura_id}, limit=1, session=session):
+                raise HTTPException(status_code=404, detail="Viatura não encontrada")
+            doc = {**movimento.model_dump(), **await sync_stamp()}
+            await db.movimentos_viaturas.insert_one({**doc}, session=session)
+            return movimento, doc, None
+        
+        # Compare-and-set in the same round trip that reads the odometer: it only advances
+        # when this trip continues it (without km inicial, when it does not go backwards)
+        limite = movimento.km_inicial or movimento.km_final
+        viatura = await db.viaturas.find_one_and_update(
+            {"id": data.viatura_id, "$or": [{"km_atual": None}, {"km_atual": {"$lte": limite}}]},
+            {"$set": {"km_atual": movimento.km_final, **carimbo}, "$inc": {"version": 1}},
+            projection={"_id": 0, "km_atual": 1, "version": 1}, session=session
+        )
+        if viatura is None:
+            # Only the failure path reads again, to tell a replay, a missing vehicle and a conflict apart
+            if data.id_cliente:
+                existente = await db.movimentos_viaturas.find_one({"id": movimento.id}, {"_id": 0}, session=session)
+                if existente:
+                    return existente, None, None  # replayed offline movement: the odometer already moved
+            atual = await db.viaturas.find_one({"id": data.viatura_id}, {"_id": 0, "km_atual": 1}, session=session)
+            if not atual:
+                raise HTTPException(status_code=404, detail="Viatura não encontrada")
+            anterior = atual.get("km_atual")
+            if anterior is None or anterior <= limite:
+                raise HTTPException(status_code=409, detail="O odómetro da viatura foi alterado entretanto. Tente novamente.")
+            if not movimento.km_inicial:
+                raise HTTPException(status_code=400, detail="Km final inferior ao km inicial")
+            raise HTTPException(status_code=409, detail=f"Km inicial ({movimento.km_inicial:.0f}) inferior ao odómetro da viatura ({anterior:.0f})")
+        
+        anterior = viatura.get("km_atual")
+        inicial = movimento.km_inicial or (anterior or 0)
+        lacuna = inicial - anterior if anterior is not None else 0
+        registo = movimento.model_copy(update={
+            "km_inicial": inicial,
+            "km_anterior": anterior,
+            "lacuna_km": lacuna if lacuna > ODOMETER_GAP_TOLERANCE_KM else 0
+        })
+        doc = {**registo.model_dump(), **await sync_stamp()}
+        await db.movimentos_viaturas.insert_one({**doc}, session=session)
+        return registo, doc, viatura.get("version", 0) + 1
     
     try:
-        await send_alert_email(alerts)
-        return {"status": "success", "message": f"Email enviado com {len(alerts)} alerta(s)", "alerts_count": len(alerts)}
-    except Exception as e:
-        error_msg = str(e)
-        if "verify a domain" in error_msg.lower():
-            raise HTTPException(status_code=400, detail=f"Para enviar emails para {ALERT_EMAIL}, precisa de verificar o domínio em resend.com/domains")
-        raise HTTPException(status_code=500, detail=f"Erro ao enviar email: {error_msg}")
+        movimento, doc, versao = await run_transaction(registar)
+    except DuplicateKeyError:
+        return await db.movimentos_viaturas.find_one({"id": movimento.id}, {"_id": 0})
+    if doc is None:
+        return movimento
+    publicar("movimentos_viaturas", "criado", doc)
+    if com_km:
+        publicar("viaturas", "atualizado", {"id": data.viatura_id, "km_atual": movimento.km_final,
+                                            "version": versao, **carimbo})
+        await agenda_alertas.registar_km(data.viatura_id, movimento.km_final)
+    return movimento
 
-# ==================== IMPORT/EXPORT ROUTES ====================
-@api_router.post("/import/excel")
-async def import_excel(file: UploadFile = File(...), user=Depends(get_current_user)):
-    """Import data from Excel file"""
-    if not file.filename.endswith(('.xlsx', '.xls')):
-        raise HTTPException(status_code=400, detail="Apenas ficheiros Excel são permitidos")
+# ==================== MOVIMENTOS OFFLINE ====================
+# tipo -> (request model, handler, ledger holding the movement)
+LOTE_TIPOS = {
+    "stock": (MovimentoStockCreate, create_movimento_stock, "movimentos_stock"),
+    "atribuir": (AtribuirRecursoRequest, atribuir_recurso, "movimentos"),
+    "devolver": (DevolverRecursoRequest, devolver_recurso, "movimentos"),
+    "viatura": (MovimentoViaturaCreate, create_movimento_viatura, "movimentos_viaturas"),
+}
+
+@api_router.post("/movimentos/lote")
+async def replay_movimentos_lote(data: LoteMovimentosRequest, user=Depends(get_current_user)):
+    """Aplica, por ordem, movimentos registados offline.
     
-    content = await file.read()
-    wb = load_workbook(BytesIO(content))
-    imported = {"equipamentos": 0, "viaturas": 0, "materiais": 0, "obras": 0}
+    Cada item traz o id gerado no dispositivo, que passa a ser o id do movimento: um item
+    já aplicado é devolvido como duplicado. Um item rejeitado não impede os seguintes.
+    """
+    if len(data.itens) > 500:
+        raise HTTPException(status_code=400, detail="Máximo de 500 movimentos por lote")
     
-    # Import Equipamentos
-    if "Equipamentos" in wb.sheetnames or "Equipamento" in wb.sheetnames:
-        ws = wb["Equipamentos"] if "Equipamentos" in wb.sheetnames else wb["Equipamento"]
+    resultados = []
+    for item in data.itens:
+        resultado = {"id_cliente": item.id_cliente, "tipo": item.tipo}
+        if item.tipo not in LOTE_TIPOS:
+            resultados.append({**resultado, "estado": "erro", "status": 400, "detail": "Tipo de movimento inválido"})
+            continue
+        modelo, handler, ledger = LOTE_TIPOS[item.tipo]
+        if await db[ledger].count_documents({"id": item.id_cliente}, limit=1):
+            resultados.append({**resultado, "estado": "duplicado", "status": 200})
+            continue
+        try:
+            pedido = modelo(**{**item.dados, "id_cliente": item.id_cliente})
+            resposta = await handler(pedido, user=user)
+        except ValidationError as e:
+            resultados.append({**resultado, "estado": "erro", "status": 422, "detail": e.errors(include_url=False)})
+            continue
+        except HTTPException as e:
+            estado = "conflito" if e.status_code in (400, 409, 412) else "erro"
+            resultados.append({**resultado, "estado": estado, "status": e.status_code, "detail": e.detail})
+            continue
+        if item.registado_em:
+            await db[ledger].update_one({"id": item.id_cliente},
+                                        {"$set": {"registado_offline_em": item.registado_em, **await sync_stamp()}})
+        resultados.append({**resultado, "estado": "criado", "status": 200,
+                           "resposta": resposta.model_dump() if isinstance(resposta, BaseModel) else resposta})
+    
+    return {
+        "resultados": resultados,
+        "criados": sum(r["estado"] == "criado" for r in resultados),
+        "duplicados": sum(r["estado"] == "duplicado" for r in resultados),
+        "conflitos": sum(r["estado"] == "conflito" for r in resultados),
+        "erros": sum(r["estado"] == "erro" for r in resultados)
+    }
+
+# ==================== RESERVAS ====================
+class IntervalTree:
+    """Árvore de intervalos semiabertos [inicio, fim): treap ordenada por (inicio, chave),
+    em que cada nó guarda o maior fim da sua subárvore para podar as pesquisas."""
+    
+    class _No:
+        __slots__ = ("ordem", "inicio", "fim", "chave", "prioridade", "max_fim", "esq", "dir")
+        
+        def __init__(self, inicio, fim, chave):
+            self.ordem = (inicio, chave)
+            self.inicio, self.fim, self.chave = inicio, fim, chave
+            self.prioridade = random.random()
+            self.max_fim = fim
+            self.esq = self.dir = None
+    
+    def __init__(self):
+        self.raiz = None
+        self.tamanho = 0
+    
+    @staticmethod
+    def _atualizar(no):
+        no.max_fim = no.fim
+        if no.esq and no.esq.max_fim > no.max_fim:
+            no.max_fim = no.esq.max_fim
+        if no.dir and no.dir.max_fim > no.max_fim:
+            no.max_fim = no.dir.max_fim
+        return no
+    
+    def _dividir(self, no, ordem, inclusivo=False):
+        """Divide em (nós < ordem, nós >= ordem); inclusivo põe também == ordem à esquerda"""
+        if no is None:
+            return None, None
+        if no.ordem < ordem or (inclusivo and no.ordem == ordem):
+            no.dir, direita = self._dividir(no.dir, ordem, inclusivo)
+            return self._atualizar(no), direita
+        esquerda, no.esq = self._dividir(no.esq, ordem, inclusivo)
+        return esquerda, self._atualizar(no)
+    
+    def _juntar(self, a, b):
+        if a is None or b is None:
+            return a or b
+        if a.prioridade > b.prioridade:
+            a.dir = self._juntar(a.dir, b)
+            return self._atualizar(a)
+        b.esq = self._juntar(a, b.esq)
+        return self._atualizar(b)
+    
+    def inserir(self, inicio, fim, chave):
+        no = self._No(inicio, fim, chave)
+        esquerda, direita = self._dividir(self.raiz, no.ordem)
+        self.raiz = self._juntar(self._juntar(esquerda, no), direita)
+        self.tamanho += 1
+    
+    def remover(self, inicio, chave):
+        esquerda, resto = self._dividir(self.raiz, (inicio, chave))
+        removido, direita = self._dividir(resto, (inicio, chave), inclusivo=True)
+        self.raiz = self._juntar(esquerda, direita)
+        if removido is not None:
+            self.tamanho -= 1
+    
+    def sobrepostos(self, inicio, fim) -> list:
+        """Chaves dos intervalos que intersetam [inicio, fim)"""
+        resultado, pilha = [], [self.raiz]
+        while pilha:
+            no = pilha.pop()
+            if no is None or no.max_fim <= inicio:
+                continue
+            pilha.append(no.esq)
+            if no.inicio < fim:
+                if no.fim > inicio:
+                    resultado.append(no.chave)
+                pilha.append(no.dir)
+        return resultado
+
+
+class ReservasIndex:
+    """Reservas ativas em memória, uma árvore de intervalos por recurso.
+    
+    Reconstruído a partir da coleção reservas no arranque e mantido a cada escrita,
+    para que conflitos e disponibilidade não precisem de ir à base de dados.
+    
+    Pressupõe um único processo (um worker do uvicorn): as escritas feitas noutro processo
+    só aparecem aqui no próximo arranque. A garantia de não haver reservas sobrepostas não
+    depende dele — create/update voltam a verificar na base de dados, na transação que grava.
+    """
+    
+    def __init__(self):
+        self.arvores = {}
+        self.reservas = {}
+    
+    def adicionar(self, reserva: dict):
+        reserva = {**reserva, "_inicio": parse_ts(reserva["inicio"]), "_fim": parse_ts(reserva["fim"])}
+        self.reservas[reserva["id"]] = reserva
+        self.arvores.setdefault(reserva["recurso_id"], IntervalTree()).inserir(reserva["_inicio"], reserva["_fim"], reserva["id"])
+    
+    def remover(self, reserva_id: str) -> Optional[dict]:
+        reserva = self.reservas.pop(reserva_id, None)
+        if reserva:
+            arvore = self.arvores[reserva["recurso_id"]]
+            arvore.remover(reserva["_inicio"], reserva_id)
+            if not arvore.tamanho:
+                del self.arvores[reserva["recurso_id"]]
+        return reserva
+    
+    def remover_recurso(self, recurso_id: str):
+        for reserva_id in [r["id"] for r in self.reservas.values() if r["recurso_id"] == recurso_id]:
+            self.remover(reserva_id)
+    
+    def remover_obra(self, obra_id: str):
+        for reserva_id in [r["id"] for r in self.reservas.values() if r["obra_id"] == obra_id]:
+            self.remover(reserva_id)
+    
+    def conflitos(self, recurso_id: str, inicio: datetime, fim: datetime, ignorar: Optional[str] = None) -> list:
+        arvore = self.arvores.get(recurso_id)
+        if arvore is None:
+            return []
+        return [self.reservas[chave] for chave in arvore.sobrepostos(inicio, fim) if chave != ignorar]
+    
+    async def carregar(self):
+        self.arvores, self.reservas = {}, {}
+        # Finished reservations can no longer conflict with anything
+        async for reserva in db.reservas.find({"fim": {"$gt": db_ts(datetime.now(timezone.utc))}}, {"_id": 0}):
+            self.adicionar(reserva)
+        return len(self.reservas)
+
+reservas_index = ReservasIndex()
+
+def publico(reserva: dict) -> dict:
+    return {k: v for k, v in reserva.items() if not k.startswith("_")}
+
+def validar_periodo_reserva(inicio_raw: str, fim_raw: str):
+    inicio, fim = parse_data_param(inicio_raw), parse_data_param(fim_raw, fim_do_dia=True)
+    if fim <= inicio:
+        raise HTTPException(status_code=400, detail="A data de fim tem de ser posterior à data de início")
+    if fim <= datetime.now(timezone.utc):
+        raise HTTPException(status_code=400, detail="Não é possível reservar no passado")
+    return inicio, fim
+
+async def erro_conflito(conflito: dict, session=None) -> HTTPException:
+    obra = await db.obras.find_one({"id": conflito["obra_id"]}, {"_id": 0, "nome": 1}, session=session)
+    return HTTPException(
+        status_code=400,
+        detail=f"Recurso já reservado para a obra {obra['nome'] if obra else 'Desconhecida'} "
+               f"de {parse_ts(conflito['inicio']).date().isoformat()} a {parse_ts(conflito['fim']).date().isoformat()}"
+    )
+
+async def verificar_conflitos(recurso_id: str, inicio: datetime, fim: datetime, ignorar: Optional[str] = None):
+    conflitos = reservas_index.conflitos(recurso_id, inicio, fim, ignorar)
+    if conflitos:
+        raise await erro_conflito(min(conflitos, key=lambda r: r["_inicio"]))
+
+async def gravar_reserva(recurso_id: str, inicio: datetime, fim: datetime, gravar, ignorar: Optional[str] = None):
+    """Verifica sobreposições na base de dados e grava com gravar(session) na mesma transação.
+    
+    O índice em memória só vê as reservas deste processo; aqui a verificação vale entre workers.
+    Todas as escritas de reservas de um recurso incrementam o mesmo documento em reservas_guardas,
+    pelo que duas transações concorrentes entram em conflito e a repetida já vê a outra reserva.
+    Numa instância standalone não há transações e a verificação fica sujeita a corridas entre processos.
+    """
+    async def registar(session):
+        await db.reservas_guardas.update_one({"recurso_id": recurso_id}, {"$inc": {"seq": 1}},
+                                             upsert=True, session=session)
+        query = {"recurso_id": recurso_id, "inicio": {"$lt": db_ts(fim)}, "fim": {"$gt": db_ts(inicio)}}
+        if ignorar:
+            query["id"] = {"$ne": ignorar}
+        conflito = await db.reservas.find_one(query, {"_id": 0}, sort=[("inicio", 1)], session=session)
+        if conflito:
+            raise await erro_conflito(conflito, session)
+        return await gravar(session)
+    return await run_transaction(registar)
+
+@api_router.get("/reservas")
+async def get_reservas(recurso_id: Optional[str] = None, obra_id: Optional[str] = None,
+                       incluir_terminadas: bool = False, user=Depends(get_current_user)):
+    query = {}
+    if recurso_id:
+        query["recurso_id"] = recurso_id
+    if obra_id:
+        query["obra_id"] = obra_id
+    if not incluir_terminadas:
+        query["fim"] = {"$gt": db_ts(datetime.now(timezone.utc))}
+    return await db.reservas.find(query, {"_id": 0}).sort("inicio", 1).to_list(1000)
+
+@api_router.get("/reservas/disponibilidade")
+async def get_disponibilidade(inicio: str, fim: str, tipo_recurso: str = "equipamento",
+                              categoria: Optional[str] = None, user=Depends(get_current_user)):
+    """Recursos ativos sem reservas no período (equipamentos filtrados por categoria)"""
+    data_inicio, data_fim = parse_data_param(inicio), parse_data_param(fim, fim_do_dia=True)
+    if data_fim <= data_inicio:
+        raise HTTPException(status_code=400, detail="A data de fim tem de ser posterior à data de início")
+    
+    if tipo_recurso == "equipamento":
+        query = {"ativo": True}
+        if categoria:
+            query["categoria"] = categoria
+        projection = {"_id": 0, "id": 1, "codigo": 1, "descricao": 1, "categoria": 1, "obra_id": 1}
+        recursos = await db.equipamentos.find(query, projection).to_list(None)
+    else:
+        projection = {"_id": 0, "id": 1, "matricula": 1, "marca": 1, "modelo": 1, "obra_id": 1}
+        recursos = await db.viaturas.find({"ativa": True}, projection).to_list(None)
+    
+    disponiveis, reservados = [], []
+    for recurso in recursos:
+        conflitos = reservas_index.conflitos(recurso["id"], data_inicio, data_fim)
+        if conflitos:
+            reservados.append({**recurso, "reservas": [publico(r) for r in conflitos]})
+        else:
+            disponiveis.append(recurso)
+    return {"inicio": data_inicio.isoformat(), "fim": data_fim.isoformat(),
+            "disponiveis": disponiveis, "reservados": reservados}
+
+@api_router.post("/reservas")
+async def create_reserva(data: ReservaCreate, user=Depends(get_current_user)):
+    collection = db.equipamentos if data.tipo_recurso == "equipamento" else db.viaturas
+    if not await collection.count_documents({"id": data.recurso_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Recurso não encontrado")
+    if not await db.obras.count_documents({"id": data.obra_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Obra não encontrada")
+    inicio, fim = validar_periodo_reserva(data.inicio, data.fim)
+    await verificar_conflitos(data.recurso_id, inicio, fim)
+    
+    # No await between the conflict check and claiming the slot, so concurrent requests see it
+    reserva = Reserva(**{**data.model_dump(), "inicio": db_ts(inicio), "fim": db_ts(fim)})
+    reservas_index.adicionar(reserva.model_dump())
+    try:
+        await gravar_reserva(data.recurso_id, inicio, fim,
+                             lambda session: db.reservas.insert_one(reserva.model_dump(), session=session))
+    except Exception:
+        reservas_index.remover(reserva.id)
+        raise
+    publicar("reservas", "criado", reserva.model_dump())
+    return reserva
+
+async def atualizar_reserva(reserva_id: str, atual: dict, changes: dict, if_match: Optional[str], response: Response):
+    if changes.get("obra_id") and not await db.obras.count_documents({"id": changes["obra_id"]}, limit=1):
+        raise HTTPException(status_code=404, detail="Obra não encontrada")
+    inicio, fim = validar_periodo_reserva(changes.get("inicio", atual["inicio"]), changes.get("fim", atual["fim"]))
+    changes["inicio"], changes["fim"] = db_ts(inicio), db_ts(fim)
+    await verificar_conflitos(atual["recurso_id"], inicio, fim, ignorar=reserva_id)
+    
+    anterior = reservas_index.remover(reserva_id)
+    reservas_index.adicionar({**atual, **changes})
+    try:
+        return await gravar_reserva(
+            atual["recurso_id"], inicio, fim,
+            lambda session: versioned_update(db.reservas, reserva_id, changes, if_match, response,
+                                             "Reserva não encontrada", session=session),
+            ignorar=reserva_id)
+    except Exception:
+        reservas_index.remover(reserva_id)
+        if anterior:
+            reservas_index.adicionar(publico(anterior))
+        raise
+
+@api_router.put("/reservas/{reserva_id}")
+async def update_reserva(reserva_id: str, data: ReservaCreate, response: Response,
+                         if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    """Substitui a reserva inteira; o recurso não muda (para outro recurso, cria-se outra reserva)"""
+    atual = await db.reservas.find_one({"id": reserva_id}, {"_id": 0})
+    if not atual:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    if (data.recurso_id, data.tipo_recurso) != (atual["recurso_id"], atual["tipo_recurso"]):
+        raise HTTPException(status_code=400, detail="O recurso de uma reserva não pode ser alterado")
+    return await atualizar_reserva(reserva_id, atual, data.model_dump(exclude={"recurso_id", "tipo_recurso"}),
+                                   if_match, response)
+
+@api_router.patch("/reservas/{reserva_id}")
+async def patch_reserva(reserva_id: str, data: ReservaUpdate, response: Response,
+                        if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    atual = await db.reservas.find_one({"id": reserva_id}, {"_id": 0})
+    if not atual:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    return await atualizar_reserva(reserva_id, atual, data.model_dump(exclude_unset=True), if_match, response)
+
+@api_router.delete("/reservas/{reserva_id}")
+async def delete_reserva(reserva_id: str, user=Depends(get_current_user)):
+    reserva = await db.reservas.find_one_and_delete({"id": reserva_id}, projection={"_id": 0})
+    if not reserva:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    reservas_index.remover(reserva_id)
+    publicar("reservas", "eliminado", {"id": reserva_id})
+    return {"message": "Reserva eliminada"}
+
+# ==================== SYNC ROUTES ====================
+@api_router.get("/sync")
+async def sync_changes(since: int = 0, collections: Optional[str] = None, limite: int = 500,
+                       user=Depends(get_current_user)):
+    """Documentos alterados e eliminados desde o seq indicado, por coleção.
+    
+    O cliente guarda o seq devolvido e envia-o no pedido seguinte. Os documentos podem
+    repetir-se entre respostas (aplicar por id); com mais=true há ainda alterações por ler.
+    """
+    nomes = collections.split(",") if collections else SYNC_COLLECTIONS
+    invalidas = [nome for nome in nomes if nome not in SYNC_COLLECTIONS]
+    if invalidas:
+        raise HTTPException(status_code=400, detail=f"Coleção inválida: {', '.join(invalidas)}")
+    limite = max(1, min(limite, 5000))
+    
+    async def ler(collection, query):
+        docs = await collection.find(query, {"_id": 0}).sort("seq", 1).to_list(limite + 1)
+        if len(docs) <= limite:
+            return docs, None
+        # Never split a group of documents stamped with the same seq (bulk updates)
+        docs = docs[:limite]
+        ultimo = docs[-1]["seq"]
+        vistos = {d["id"] for d in docs if d["seq"] == ultimo}
+        docs += [d for d in await collection.find({**query, "seq": ultimo}, {"_id": 0}).to_list(None) if d["id"] not in vistos]
+        return docs, ultimo
+    
+    alterados, eliminados, cortes, todos = {}, {}, [], []
+    for nome in nomes:
+        docs, corte = await ler(db[nome], {"seq": {"$gt": since}})
+        alterados[nome] = docs
+        todos += docs
+        if corte is not None:
+            cortes.append(corte)
+    tombstones, corte = await ler(db.tombstones, {"seq": {"$gt": since}, "colecao": {"$in": nomes}})
+    if corte is not None:
+        cortes.append(corte)
+    todos += tombstones
+    for tombstone in tombstones:
+        eliminados.setdefault(tombstone["colecao"], []).append(tombstone["id"])
+    
+    # Writes stamped less than SYNC_SETTLE_SECONDS ago may still have lower seqs in flight,
+    # so the cursor only moves past settled stamps; the rest is sent again next time.
+    limiar = datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    assentes = [d["seq"] for d in todos if (parse_ts(d.get("updated_at")) or limiar) <= limiar]
+    seq = max(assentes, default=since)
+    if cortes:
+        seq = min(seq, min(cortes))
+    return {"seq": max(seq, since), "mais": bool(cortes) and seq > since,
+            "alterados": alterados, "eliminados": eliminados}
+
+# ==================== EVENTS ====================
+class EventBus:
+    """Pub/sub em processo: cada cliente SSE tem uma fila limitada.
+    
+    Um cliente que não consome a tempo perde os eventos em fila e recebe um evento
+    'reset', para voltar a sincronizar por /sync em vez de atrasar os restantes.
+    """
+    
+    def __init__(self, tamanho_fila: int = EVENTS_QUEUE_SIZE):
+        self.tamanho_fila = tamanho_fila
+        self.filas = set()
+    
+    def subscrever(self) -> asyncio.Queue:
+        fila = asyncio.Queue(maxsize=self.tamanho_fila)
+        self.filas.add(fila)
+        return fila
+    
+    def cancelar(self, fila: asyncio.Queue):
+        self.filas.discard(fila)
+    
+    def publicar(self, evento: dict):
+        for fila in self.filas:
+            try:
+                fila.put_nowait(evento)
+            except asyncio.QueueFull:
+                while not fila.empty():
+                    fila.get_nowait()
+                fila.put_nowait({"colecao": None, "acao": "reset"})
+
+event_bus = EventBus()
+
+def evento(colecao: str, acao: str, doc: dict) -> dict:
+    doc = {k: v for k, v in doc.items() if k != "_id"}
+    return {"colecao": colecao, "acao": acao, "id": doc.get("id"), "seq": doc.get("seq"), "doc": doc}
+
+def publicar(colecao: str, acao: str, doc: dict):
+    """Publica uma alteração; com EVENTS_SOURCE=changestream os eventos vêm do change stream"""
+    if EVENTS_SOURCE != "changestream":
+        event_bus.publicar(evento(colecao, acao, doc))
+
+async def change_stream_loop():
+    """Publica no bus local as escritas de todos os workers (requer replica set)"""
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": SYNC_COLLECTIONS + ["tombstones", "reservas"]},
+        "operationType": {"$in": ["insert", "update", "replace"]}
+    }}]
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    doc = change.get("fullDocument") or {}
+                    if change["ns"]["coll"] == "tombstones":
+                        event_bus.publicar(evento(doc["colecao"], "eliminado", doc))
+                    else:
+                        acao = "criado" if change["operationType"] == "insert" else "atualizado"
+                        event_bus.publicar(evento(change["ns"]["coll"], acao, doc))
+        except asyncio.CancelledError:
+            raise
+        except PyMongoError:
+            logger.exception("Change stream interrupted, reconnecting")
+            await asyncio.sleep(5)
+
+def sse(evento: dict) -> str:
+    linhas = []
+    if evento.get("seq") is not None:
+        linhas.append(f"id: {evento['seq']}")
+    linhas.append(f"event: {evento['acao']}")
+    linhas.append(f"data: {json.dumps(jsonable_encoder(evento))}")
+    return "\n".join(linhas) + "\n\n"
+
+@api_router.get("/events")
+async def stream_events(request: Request, token: Optional[str] = None,
+                        credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))):
+    """Stream SSE das alterações. O EventSource do browser não envia cabeçalhos, daí ?token="""
+    if credentials:
+        token = credentials.credentials
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    await user_from_token(token)
+    
+    fila = event_bus.subscrever()
+    
+    async def gerar():
+        try:
+            yield "retry: 5000\n\n"
+            if request.headers.get("last-event-id"):
+                # Events may have been missed while disconnected: catch up through /sync
+                yield sse({"colecao": None, "acao": "reset", "seq": None})
+            while True:
+                try:
+                    yield sse(await asyncio.wait_for(fila.get(), EVENTS_HEARTBEAT_SECONDS))
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+        finally:
+            event_bus.cancelar(fila)
+    
+    return StreamingResponse(gerar(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ==================== ALERT RULES ====================
+# entidade -> (collection, active flag)
+ENTIDADES_ALERTA = {
+    "viatura": ("viaturas", "ativa"),
+    "equipamento": ("equipamentos", "ativo"),
+}
+CAMPO_REGRA = re.compile(r"^[a-z][a-z0-9_]*$")
+
+REGRAS_PADRAO = [
+    {"id": "viatura-vistoria", "nome": "Vistoria", "tipo_alerta": "vistoria", "entidade": "viatura", "campo": "data_vistoria"},
+    {"id": "viatura-seguro", "nome": "Seguro", "tipo_alerta": "seguro", "entidade": "viatura", "campo": "data_seguro"},
+    {"id": "viatura-tacografo", "nome": "Calibração do tacógrafo", "tipo_alerta": "tacografo", "entidade": "viatura",
+     "campo": "data_tacografo"},
+    {"id": "equipamento-inspecao", "nome": "Inspeção", "tipo_alerta": "inspecao", "entidade": "equipamento",
+     "campo": "data_inspecao"},
+    {"id": "viatura-revisao", "nome": "Revisão", "tipo_alerta": "revisao", "entidade": "viatura", "tipo": "km",
+     "campo": "km_ultima_revisao", "intervalo_km": 15000, "antecedencia_km": 1000},
+]
+
+def validar_regra(regra: dict):
+    if regra["entidade"] not in ENTIDADES_ALERTA:
+        raise HTTPException(status_code=400, detail="Entidade inválida")
+    if regra["tipo"] not in ("data", "km"):
+        raise HTTPException(status_code=400, detail="Tipo de regra inválido")
+    if not CAMPO_REGRA.match(regra["campo"]):
+        raise HTTPException(status_code=400, detail="Campo inválido")
+    if regra["tipo"] == "km" and (regra["entidade"] != "viatura" or regra["intervalo_km"] <= 0):
+        raise HTTPException(status_code=400, detail="As regras por km aplicam-se a viaturas e precisam de um intervalo positivo")
+
+def avaliar_regra(regra: dict, doc: dict, km_atual: Optional[float]) -> Optional[tuple]:
+    """(instante a partir do qual o alerta está ativo, alerta) de uma regra num documento, ou None"""
+    _, ativo = ENTIDADES_ALERTA[regra["entidade"]]
+    if not doc.get(ativo, True):
+        return None
+    alerta = {"regra_id": regra["id"], "tipo_alerta": regra["tipo_alerta"], "nome": regra["nome"],
+              "entidade": regra["entidade"], "entidade_id": doc["id"]}
+    if regra["entidade"] == "viatura":
+        alerta.update(identificacao=doc.get("matricula", ""), descricao=f"{doc.get('marca', '')} {doc.get('modelo', '')}".strip(),
+                      viatura_id=doc["id"], matricula=doc.get("matricula", ""), marca=doc.get("marca", ""), modelo=doc.get("modelo", ""))
+    else:
+        alerta.update(identificacao=doc.get("codigo", ""), descricao=doc.get("descricao", ""), equipamento_id=doc["id"])
+    
+    if regra["tipo"] == "data":
+        vencimento = parse_ts(doc.get(regra["campo"]))
+        if vencimento is None:
+            return None
+        vencimento = vencimento.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        return vencimento - timedelta(days=regra.get("antecedencia_dias", ALERT_DAYS_BEFORE)), {**alerta, "vencimento": vencimento}
+    
+    base = doc.get(regra["campo"])
+    if km_atual is None or base is None:
+        return None  # never recorded: counting from km 0 would flag every vehicle as overdue
+    limite = base + regra["intervalo_km"]
+    if km_atual < limite - regra.get("antecedencia_km", 0):
+        return None
+    # Km rules have no date: once the threshold is reached they are due from now on
+    return datetime.now(timezone.utc), {**alerta, "km_atual": km_atual, "km_limite": limite}
+
+class AgendaAlertas:
+    """Alertas das regras em memória, por (regra, entidade).
+    
+    Os que ainda não estão ativos ficam numa min-heap pelo instante em que passam a estar,
+    pelo que o próximo a vencer está sempre no topo; os já ativos ficam num dicionário.
+    Construída no arranque e atualizada a cada escrita nas entidades, nas regras ou nos km.
+    
+    Pressupõe um único processo (um worker do uvicorn): as escritas feitas noutro processo
+    só aparecem aqui depois de carregar() (arranque ou importação). Os alertas são derivados
+    dos documentos guardados, pelo que um desfasamento não perde dados, apenas atrasa alertas.
+    """
+    
+    def __init__(self):
+        self.heap = []  # [instante, ordem, chave, alerta]; alerta None = entrada removida
+        self.pendentes = {}
+        self.ativos = {}
+        self.regras = {}
+        self.km = {}
+        self.ordem = itertools.count()
+    
+    def agendar(self, chave: tuple, instante: datetime, alerta: dict):
+        self.remover(chave)
+        if instante <= datetime.now(timezone.utc):
+            self.ativos[chave] = (instante, alerta)
+            return
+        entrada = [instante, next(self.ordem), chave, alerta]
+        self.pendentes[chave] = entrada
+        heapq.heappush(self.heap, entrada)
+    
+    def remover(self, chave: tuple):
+        self.ativos.pop(chave, None)
+        entrada = self.pendentes.pop(chave, None)
+        if entrada:
+            entrada[-1] = None  # lazy deletion; compacted once removed entries dominate
+            if len(self.heap) > 2 * len(self.pendentes) + 64:
+                self.heap = [e for e in self.heap if e[-1] is not None]
+                heapq.heapify(self.heap)
+    
+    def avancar(self):
+        """Passa a ativos os alertas cujo instante já chegou (O(log n) cada)"""
+        agora = datetime.now(timezone.utc)
+        while self.heap and (self.heap[0][-1] is None or self.heap[0][0] <= agora):
+            instante, _, chave, alerta = heapq.heappop(self.heap)
+            if alerta is not None:
+                del self.pendentes[chave]
+                self.ativos[chave] = (instante, alerta)
+    
+    def proximo(self) -> Optional[tuple]:
+        """(instante, alerta) do próximo alerta a ficar ativo"""
+        self.avancar()
+        return (self.heap[0][0], self.heap[0][-1]) if self.heap else None
+    
+    def alertas(self) -> list:
+        self.avancar()
+        return [alerta for _, alerta in sorted(self.ativos.values(), key=lambda e: e[0])]
+    
+    def avaliar(self, regra: dict, doc: dict):
+        chave = (regra["id"], doc["id"])
+        agendado = avaliar_regra(regra, doc, self.km.get(doc["id"]))
+        if agendado:
+            self.agendar(chave, *agendado)
+        else:
+            self.remover(chave)
+    
+    def atualizar_entidade(self, entidade: str, doc: dict):
+        for regra in self.regras.values():
+            if regra["entidade"] == entidade:
+                self.avaliar(regra, doc)
+    
+    def remover_entidade(self, entidade_id: str):
+        for chave in [c for c in [*self.ativos, *self.pendentes] if c[1] == entidade_id]:
+            self.remover(chave)
+    
+    def remover_regra(self, regra_id: str):
+        self.regras.pop(regra_id, None)
+        for chave in [c for c in [*self.ativos, *self.pendentes] if c[0] == regra_id]:
+            self.remover(chave)
+    
+    async def atualizar_regra(self, regra: dict):
+        self.remover_regra(regra["id"])
+        if not regra.get("ativa", True):
+            return
+        self.regras[regra["id"]] = regra
+        nome, ativo = ENTIDADES_ALERTA[regra["entidade"]]
+        async for doc in db[nome].find({ativo: True}, {"_id": 0, "foto": 0}):
+            self.avaliar(regra, doc)
+    
+    async def registar_km(self, viatura_id: str, km: float):
+        if km <= self.km.get(viatura_id, 0):
+            return
+        self.km[viatura_id] = km
+        if any(r["tipo"] == "km" for r in self.regras.values()):
+            viatura = await db.viaturas.find_one({"id": viatura_id}, {"_id": 0, "foto": 0})
+            if viatura:
+                self.atualizar_entidade("viatura", viatura)
+    
+    async def carregar(self):
+        self.__init__()
+        self.regras = {r["id"]: r async for r in db.regras_alerta.find({"ativa": True}, {"_id": 0})}
+        self.km = {v["id"]: v["km_atual"] async for v in db.viaturas.find(
+            {"km_atual": {"$ne": None}}, {"_id": 0, "id": 1, "km_atual": 1})}
+        for entidade, (nome, ativo) in ENTIDADES_ALERTA.items():
+            if any(r["entidade"] == entidade for r in self.regras.values()):
+                async for doc in db[nome].find({ativo: True}, {"_id": 0, "foto": 0}):
+                    self.atualizar_entidade(entidade, doc)
+        return len(self.ativos) + len(self.pendentes)
+
+agenda_alertas = AgendaAlertas()
+
+async def seed_regras_alerta():
+    """Cria uma vez as regras equivalentes aos alertas fixos anteriores (e as novas por omissão)"""
+    if await db.migrations.find_one({"_id": "regras_alerta"}):
+        return 0
+    docs = [RegraAlerta(**regra).model_dump() for regra in REGRAS_PADRAO]
+    criadas = await insert_many_ignoring_duplicates(db.regras_alerta, docs)
+    await db.migrations.update_one({"_id": "regras_alerta"}, {"$set": {"em": datetime.now(timezone.utc)}}, upsert=True)
+    return criadas
+
+async def clear_km_revisao_default() -> int:
+    """km_ultima_revisao chegou a ser guardado como 0 por omissão; passa a None (nunca registado)"""
+    if await db.migrations.find_one({"_id": "km_ultima_revisao"}):
+        return 0
+    resultado = await db.viaturas.update_many({"km_ultima_revisao": 0}, {"$set": {"km_ultima_revisao": None}})
+    await db.migrations.update_one({"_id": "km_ultima_revisao"}, {"$set": {"em": datetime.now(timezone.utc)}}, upsert=True)
+    return resultado.modified_count
+
+def alerta_publico(alerta: dict, hoje) -> dict:
+    resultado = {k: v for k, v in alerta.items() if k != "vencimento"}
+    if "vencimento" in alerta:
+        resultado["data_expiracao"] = alerta["vencimento"].strftime("%d/%m/%Y")
+        resultado["dias_restantes"] = (alerta["vencimento"].date() - hoje).days
+    else:
+        resultado["data_expiracao"] = None
+        resultado["dias_restantes"] = None
+        resultado["km_restantes"] = alerta["km_limite"] - alerta["km_atual"]
+    return resultado
+
+def alertas_ativos() -> list:
+    hoje = datetime.now(timezone.utc).date()
+    return [alerta_publico(a, hoje) for a in agenda_alertas.alertas()]
+
+@api_router.get("/alerts/regras")
+async def get_regras_alerta(user=Depends(get_current_user)):
+    return await db.regras_alerta.find({}, {"_id": 0}).sort("nome", 1).to_list(1000)
+
+@api_router.post("/alerts/regras")
+async def create_regra_alerta(data: RegraAlertaCreate, user=Depends(get_current_user)):
+    regra = RegraAlerta(**data.model_dump())
+    validar_regra(regra.model_dump())
+    await db.regras_alerta.insert_one(regra.model_dump())
+    await agenda_alertas.atualizar_regra(regra.model_dump())
+    return regra
+
+@api_router.put("/alerts/regras/{regra_id}")
+async def update_regra_alerta(regra_id: str, data: RegraAlertaUpdate, response: Response,
+                              if_match: Optional[str] = Header(None), user=Depends(get_current_user)):
+    changes = data.model_dump(exclude_unset=True)
+    atual = await db.regras_alerta.find_one({"id": regra_id}, {"_id": 0})
+    if not atual:
+        raise HTTPException(status_code=404, detail="Regra não encontrada")
+    validar_regra({**atual, **changes})
+    regra = await versioned_update(db.regras_alerta, regra_id, changes, if_match, response, "Regra não encontrada")
+    await agenda_alertas.atualizar_regra(regra)
+    return regra
+
+@api_router.delete("/alerts/regras/{regra_id}")
+async def delete_regra_alerta(regra_id: str, user=Depends(get_current_user)):
+    result = await db.regras_alerta.delete_one({"id": regra_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Regra não encontrada")
+    agenda_alertas.remover_regra(regra_id)
+    return {"message": "Regra eliminada"}
+
+# ==================== ALERTS ROUTES ====================
+@api_router.get("/alerts/check")
+async def check_alerts(user=Depends(get_current_user)):
+    alerts = alertas_ativos()
+    proximo = agenda_alertas.proximo()
+    return {
+        "alerts": alerts,
+        "total": len(alerts),
+        "proximo": {"ativo_em": proximo[0].isoformat(), "nome": proximo[1]["nome"],
+                    "identificacao": proximo[1]["identificacao"]} if proximo else None
+    }
+
+def chave_notificacao(alerta: dict) -> str:
+    """Identifica uma ocorrência de alerta: volta a ser notificada se mudar o prazo ou passar a expirada"""
+    restantes = alerta["dias_restantes"] if alerta["dias_restantes"] is not None else alerta["km_restantes"]
+    prazo = alerta["data_expiracao"] or f"{alerta['km_limite']:.0f}km"
+    return f"{alerta['regra_id']}:{alerta['entidade_id']}:{prazo}:{'expirado' if restantes < 0 else 'a_expirar'}"
+
+async def enfileirar_resumo_alertas() -> Optional[tuple]:
+    """Põe na outbox um email com os alertas ativos ainda não notificados; devolve (mensagem, total) ou None"""
+    alertas = alertas_ativos()
+    if not alertas or not ALERT_EMAIL:
+        return None
+    
+    async def registar(session):
+        agora = datetime.now(timezone.utc)
+        novos = []
+        for alerta in alertas:
+            marcado = await db.alertas_notificados.update_one(
+                {"_id": chave_notificacao(alerta)}, {"$setOnInsert": {"notificado_em": agora}}, upsert=True, session=session
+            )
+            if marcado.upserted_id is not None:
+                novos.append(alerta)
+        if not novos:
+            return None
+        mensagem = await enfileirar_email([ALERT_EMAIL], f"⚠️ Alertas de Viaturas e Equipamentos - {len(novos)} alerta(s)",
+                                          TEMPLATE_ALERTAS.render(alertas=novos), "alertas", session=session)
+        return mensagem, len(novos)
+    
+    return await run_transaction(registar)
+
+async def alert_digest_loop():
+    """Resumo diário dos alertas novos, à hora ALERT_DIGEST_HOUR (UTC)"""
+    while True:
+        agora = datetime.now(timezone.utc)
+        proximo = agora.replace(hour=ALERT_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+        if proximo <= agora:
+            proximo += timedelta(days=1)
+        await asyncio.sleep((proximo - agora).total_seconds())
+        try:
+            if resumo := await enfileirar_resumo_alertas():
+                logger.info(f"Queued alert digest with {resumo[1]} alert(s)")
+                outbox_acordar.set()
+        except Exception:
+            logger.exception("Alert digest job failed")
+
+@api_router.post("/alerts/send")
+async def send_alerts(user=Depends(get_current_user)):
+    if not ALERT_EMAIL or not email_transport.configurado():
+        raise HTTPException(status_code=400, detail="Configuração de email incompleta")
+    
+    resumo = await enfileirar_resumo_alertas()
+    if not resumo:
+        return {"status": "success", "message": "Não há alertas novos para enviar", "alerts_count": 0}
+    
+    mensagem, total = resumo
+    outbox_acordar.set()
+    return {"status": "success", "message": f"Email com {total} alerta(s) em fila de envio", "alerts_count": total,
+            "outbox_id": mensagem["id"]}
+
+@api_router.get("/alerts/outbox")
+async def get_email_outbox(estado: Optional[str] = None, user=Depends(get_current_user)):
+    query = {"estado": estado} if estado else {}
+    return await db.email_outbox.find(query, {"_id": 0, "html": 0}).sort("criado_em", -1).to_list(100)
+
+# ==================== IMPORT/EXPORT ROUTES ====================
+@api_router.post("/import/excel")
+async def import_excel(file: UploadFile = File(...), user=Depends(get_current_user)):
+    """Import data from Excel file"""
+    if not file.filename.endswith(('.xlsx', '.xls')):
+        raise HTTPException(status_code=400, detail="Apenas ficheiros Excel são permitidos")
+    
+    content = await file.read()
+    wb = load_workbook(BytesIO(content))
+    imported = {"equipamentos": 0, "viaturas": 0, "materiais": 0, "obras": 0}
+    
+    # Import Equipamentos
+    if "Equipamentos" in wb.sheetnames or "Equipamento" in wb.sheetnames:
+        ws = wb["Equipamentos"] if "Equipamentos" in wb.sheetnames else wb["Equipamento"]
         headers = [cell.value for cell in ws[1]]
+        docs = []
         
         for row in ws.iter_rows(min_row=2, values_only=True):
             if not row[0]:
@@ -731,10 +2579,6 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
             if not codigo:
                 continue
             
-            existing = await db.equipamentos.find_one({"codigo": codigo})
-            if existing:
-                continue
-            
             equipamento = Equipamento(
                 codigo=codigo,
                 descricao=str(data.get("Descricao", data.get("descricao", data.get("Descrição", "")))),
@@ -745,13 +2589,16 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
                 estado_conservacao=str(data.get("Estado_Conservacao", data.get("estado_conservacao", data.get("Estado", "Bom"))) or "Bom"),
                 ativo=str(data.get("Ativo", data.get("ativo", "Sim"))).lower() in ["sim", "true", "1", "yes"]
             )
-            await db.equipamentos.insert_one(equipamento.model_dump())
-            imported["equipamentos"] += 1
+            docs.append(com_chaves_pesquisa("equipamentos", equipamento.model_dump()))
+        
+        # Existing codes are skipped by the unique index instead of a lookup per row
+        imported["equipamentos"] = await insert_many_ignoring_duplicates(db.equipamentos, await sync_stamp_many(docs))
     
     # Import Viaturas
     if "Viaturas" in wb.sheetnames or "Viatura" in wb.sheetnames:
         ws = wb["Viaturas"] if "Viaturas" in wb.sheetnames else wb["Viatura"]
         headers = [cell.value for cell in ws[1]]
+        docs = []
         
         for row in ws.iter_rows(min_row=2, values_only=True):
             if not row[0]:
@@ -761,10 +2608,6 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
             if not matricula:
                 continue
             
-            existing = await db.viaturas.find_one({"matricula": matricula})
-            if existing:
-                continue
-            
             viatura = Viatura(
                 matricula=matricula,
                 marca=str(data.get("Marca", data.get("marca", "")) or ""),
@@ -772,13 +2615,15 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
                 combustivel=str(data.get("Combustivel", data.get("combustivel", data.get("Combustível", "Gasoleo"))) or "Gasoleo"),
                 ativa=str(data.get("Ativa", data.get("ativa", "Sim"))).lower() in ["sim", "true", "1", "yes"]
             )
-            await db.viaturas.insert_one(viatura.model_dump())
-            imported["viaturas"] += 1
+            docs.append(com_chaves_pesquisa("viaturas", viatura.model_dump()))
+        
+        imported["viaturas"] = await insert_many_ignoring_duplicates(db.viaturas, await sync_stamp_many(docs))
     
     # Import Materiais
     if "Materiais" in wb.sheetnames or "Material" in wb.sheetnames:
         ws = wb["Materiais"] if "Materiais" in wb.sheetnames else wb["Material"]
         headers = [cell.value for cell in ws[1]]
+        docs = []
         
         for row in ws.iter_rows(min_row=2, values_only=True):
             if not row[0]:
@@ -788,23 +2633,30 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
             if not codigo:
                 continue
             
-            existing = await db.materiais.find_one({"codigo": codigo})
-            if existing:
-                continue
-            
             material = Material(
                 codigo=codigo,
                 descricao=str(data.get("Descricao", data.get("descricao", data.get("Descrição", ""))) or ""),
                 unidade=str(data.get("Unidade", data.get("unidade", "unidade")) or "unidade"),
-                stock_minimo=float(data.get("Stock_Minimo", data.get("stock_minimo", 0)) or 0)
+                stock_atual=float(data.get("Stock_Atual", data.get("stock_atual", data.get("Stock Atual", 0))) or 0),
+                stock_minimo=float(data.get("Stock_Minimo", data.get("stock_minimo", data.get("Stock Mínimo", 0))) or 0)
             )
-            await db.materiais.insert_one(material.model_dump())
-            imported["materiais"] += 1
+            material = material.model_copy(update=estado_stock(material.stock_atual, material.stock_minimo))
+            docs.append(com_chaves_pesquisa("materiais", material.model_dump()))
+        
+        imported["materiais"] = await insert_many_ignoring_duplicates(db.materiais, await sync_stamp_many(docs))
+        # Opening stock of the rows actually inserted (existing codes were skipped)
+        inseridos = await db.materiais.find({"id": {"$in": [d["id"] for d in docs if d["stock_atual"]]}},
+                                            {"_id": 0, "id": 1, "stock_atual": 1, "created_at": 1}).to_list(None)
+        saldo_inicial = await sync_stamp_many(movimentos_saldo_inicial(inseridos))
+        if saldo_inicial:
+            await db.movimentos_stock.insert_many([{**m} for m in saldo_inicial])
+            await update_rollups(saldo_inicial)
     
     # Import Obras
     if "Obras" in wb.sheetnames or "Obra" in wb.sheetnames:
         ws = wb["Obras"] if "Obras" in wb.sheetnames else wb["Obra"]
         headers = [cell.value for cell in ws[1]]
+        docs = []
         
         for row in ws.iter_rows(min_row=2, values_only=True):
             if not row[0]:
@@ -814,18 +2666,20 @@ async def import_excel(file: UploadFile = File(...), user=Depends(get_current_us
             if not codigo:
                 continue
             
-            existing = await db.obras.find_one({"codigo": codigo})
-            if existing:
-                continue
-            
             obra = Obra(
                 codigo=codigo,
                 nome=str(data.get("Nome", data.get("nome", "")) or ""),
                 estado=str(data.get("Estado", data.get("estado", "Ativa")) or "Ativa")
             )
-            await db.obras.insert_one(obra.model_dump())
-            imported["obras"] += 1
+            docs.append(com_chaves_pesquisa("obras", obra.model_dump()))
+        
+        imported["obras"] = await insert_many_ignoring_duplicates(db.obras, await sync_stamp_many(docs))
     
+    for colecao, total in imported.items():
+        if total:
+            publicar(colecao, "importado", {"total": total})
+    if imported["equipamentos"] or imported["viaturas"]:
+        await agenda_alertas.carregar()
     return {"message": "Importação concluída", "imported": imported}
 
 @api_router.get("/export/excel")
@@ -849,7 +2703,8 @@ async def export_excel(user=Depends(get_current_user)):
     ws.append(["Matrícula", "Marca", "Modelo", "Combustível", "Data Vistoria", "Data Seguro", "Ativa"])
     for v in viaturas:
         ws.append([v.get("matricula"), v.get("marca"), v.get("modelo"), v.get("combustivel"),
-                   v.get("data_vistoria"), v.get("data_seguro"), "Sim" if v.get("ativa") else "Não"])
+                   *[d.date() if (d := parse_ts(v.get(f))) else None for f in ("data_vistoria", "data_seguro")],
+                   "Sim" if v.get("ativa") else "Não"])
     
     ws = wb.create_sheet("Materiais")
     ws.append(["Código", "Descrição", "Unidade", "Stock Atual", "Stock Mínimo", "Ativo"])
@@ -918,36 +2773,38 @@ async def export_pdf(user=Depends(get_current_user)):
 async def get_summary(user=Depends(get_current_user)):
     equipamentos = await db.equipamentos.find({}, {"_id": 0}).to_list(1000)
     viaturas = await db.viaturas.find({}, {"_id": 0}).to_list(1000)
-    materiais = await db.materiais.find({}, {"_id": 0}).to_list(1000)
+    totais_materiais = await db.materiais.aggregate([
+        {"$group": {"_id": None, "total": {"$sum": 1}, "stock_total": {"$sum": "$stock_atual"}}}
+    ]).to_list(1)
+    totais_materiais = totais_materiais[0] if totais_materiais else {"total": 0, "stock_total": 0}
     obras = await db.obras.find({}, {"_id": 0}).to_list(1000)
     
     alerts = []
-    today = datetime.now(timezone.utc).date()
-    
-    for v in viaturas:
-        for field, tipo, msg in [("data_vistoria", "vistoria", "Vistoria"), ("data_seguro", "seguro", "Seguro")]:
-            if v.get(field):
-                try:
-                    date = datetime.fromisoformat(v[field].replace("Z", "+00:00")).date()
-                    days_until = (date - today).days
-                    if days_until <= ALERT_DAYS_BEFORE:
-                        alerts.append({
-                            "type": tipo,
-                            "item": f"{v['marca']} {v['modelo']} ({v['matricula']})",
-                            "message": f"{msg} em {days_until} dias" if days_until >= 0 else f"{msg} expirado",
-                            "urgent": days_until < 0
-                        })
-                except:
-                    pass
+    for alerta in alertas_ativos():
+        msg = alerta["nome"]
+        if alerta["dias_restantes"] is not None:
+            restantes = alerta["dias_restantes"]
+            message = f"{msg} em {restantes} dias" if restantes >= 0 else f"{msg} expirado"
+        else:
+            restantes = alerta["km_restantes"]
+            message = f"{msg} em {restantes:.0f} km" if restantes >= 0 else f"{msg} em atraso ({-restantes:.0f} km)"
+        alerts.append({
+            "type": alerta["tipo_alerta"],
+            "item": f"{alerta['descricao']} ({alerta['identificacao']})",
+            "message": message,
+            "urgent": restantes < 0
+        })
     
-    for m in materiais:
-        if m.get("stock_atual", 0) <= m.get("stock_minimo", 0) and m.get("stock_minimo", 0) > 0:
-            alerts.append({
-                "type": "stock",
-                "item": f"{m['codigo']} - {m['descricao']}",
-                "message": f"Stock baixo: {m.get('stock_atual', 0)} {m.get('unidade', 'un')}",
-                "urgent": m.get("stock_atual", 0) == 0
-            })
+    abaixo_minimo = db.materiais.find(
+        FILTRO_ABAIXO_MINIMO, {"_id": 0, "codigo": 1, "descricao": 1, "stock_atual": 1, "unidade": 1}
+    ).sort([("deficit", -1), ("codigo", 1)])
+    async for m in abaixo_minimo:
+        alerts.append({
+            "type": "stock",
+            "item": f"{m['codigo']} - {m['descricao']}",
+            "message": f"Stock baixo: {m.get('stock_atual', 0)} {m.get('unidade', 'un')}",
+            "urgent": m.get("stock_atual", 0) == 0
+        })
     
     return {
         "equipamentos": {
@@ -961,8 +2818,8 @@ async def get_summary(user=Depends(get_current_user)):
             "em_obra": len([v for v in viaturas if v.get("obra_id")])
         },
         "materiais": {
-            "total": len(materiais),
-            "stock_total": sum(m.get("stock_atual", 0) for m in materiais)
+            "total": totais_materiais["total"],
+            "stock_total": totais_materiais["stock_total"]
         },
         "obras": {
             "total": len(obras),
@@ -971,80 +2828,1331 @@ async def get_summary(user=Depends(get_current_user)):
         "alerts": alerts
     }
 
-# ==================== RELATÓRIOS AVANÇADOS ====================
-@api_router.get("/relatorios/movimentos")
-async def get_relatorio_movimentos(
+# ==================== KPIs ====================
+class CacheTTL:
+    """Cache em memória (por processo) com expiração por entrada e tamanho máximo"""
+    
+    def __init__(self, segundos: float, maximo: int = 256):
+        self.segundos = segundos
+        self.maximo = maximo
+        self.entradas = OrderedDict()
+    
+    def obter(self, chave):
+        entrada = self.entradas.get(chave)
+        if entrada is None:
+            return None
+        if entrada[0] < time.monotonic():
+            del self.entradas[chave]
+            return None
+        return entrada[1]
+    
+    def guardar(self, chave, valor):
+        self.entradas[chave] = (time.monotonic() + self.segundos, valor)
+        self.entradas.move_to_end(chave)
+        while len(self.entradas) > self.maximo:
+            self.entradas.popitem(last=False)
+
+kpi_cache = CacheTTL(KPI_CACHE_SECONDS)
+
+# Km travelled by one movimentos_viaturas entry
+KM_PERCORRIDOS = {"$max": [0, {"$subtract": [{"$ifNull": ["$km_final", 0]}, {"$ifNull": ["$km_inicial", 0]}]}]}
+
+def _soma_se(campo: str, valor: str, quantidade="$quantidade"):
+    return {"$sum": {"$cond": [{"$eq": [f"${campo}", valor]}, quantidade, 0]}}
+
+# Each metric: ledger, indexed date field and the values summed per bucket
+KPI_METRICAS = {
+    "movimentos": ("movimentos", "created_at", {
+        "total": {"$sum": 1},
+        "saidas": _soma_se("tipo_movimento", "Saida", 1),
+        "devolucoes": _soma_se("tipo_movimento", "Devolucao", 1)
+    }),
+    "stock": ("movimentos_stock", "data_hora", {
+        "movimentos": {"$sum": 1},
+        "entradas": _soma_se("tipo_movimento", "Entrada"),
+        "saidas": _soma_se("tipo_movimento", "Saida")
+    }),
+    "km": ("movimentos_viaturas", "created_at", {
+        "km": {"$sum": KM_PERCORRIDOS},
+        "registos": {"$sum": 1}
+    }),
+    "atribuicoes": ("atribuicoes", "inicio", {
+        "total": {"$sum": 1},
+        "equipamentos": _soma_se("tipo_recurso", "equipamento", 1),
+        "viaturas": _soma_se("tipo_recurso", "viatura", 1)
+    }),
+}
+# granularidade -> ($dateTrunc unit, pandas frequency, default span)
+KPI_GRANULARIDADES = {
+    "dia": ("day", "D", timedelta(days=30)),
+    "semana": ("week", "W-MON", timedelta(weeks=12)),
+    "mes": ("month", "MS", timedelta(days=365)),
+}
+KPI_MAX_PONTOS = 1000
+
+def inicio_balde(instante: datetime, granularidade: str) -> datetime:
+    """Início (UTC) do dia, semana (segunda-feira) ou mês que contém o instante"""
+    dia = instante.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularidade == "semana":
+        return dia - timedelta(days=dia.weekday())
+    if granularidade == "mes":
+        return dia.replace(day=1)
+    return dia
+
+async def serie_kpi(metrica: str, granularidade: str, de: datetime, ate: datetime, obra_id: Optional[str]) -> dict:
+    colecao, campo, valores = KPI_METRICAS[metrica]
+    unidade, frequencia, _ = KPI_GRANULARIDADES[granularidade]
+    truncar = {"date": f"${campo}", "unit": unidade, "timezone": "UTC"}
+    if unidade == "week":
+        truncar["startOfWeek"] = "monday"
+    query = {campo: {"$gte": db_ts(de), "$lt": db_ts(ate)}}
+    if obra_id:
+        query["obra_id"] = obra_id
+    pipeline = [{"$match": query}, {"$group": {"_id": {"$dateTrunc": truncar}, **valores}}]
+    grupos = {pd.Timestamp(g["_id"]): g async for g in db[colecao].aggregate(pipeline)}
+    
+    # Dense series: buckets without movements are zeros, so charts need no gap handling
+    serie = []
+    for balde in pd.date_range(start=inicio_balde(de, granularidade), end=ate, freq=frequencia, inclusive="left"):
+        grupo = grupos.get(balde, {})
+        serie.append({"periodo": balde.isoformat(), **{nome: grupo.get(nome, 0) for nome in valores}})
+    totais = {nome: sum(ponto[nome] for ponto in serie) for nome in valores}
+    return {"serie": serie, "totais": totais}
+
+@api_router.get("/kpis/serie")
+async def get_kpis_serie(
+    response: Response,
+    metric: str = "movimentos",
+    granularidade: str = "dia",
+    de: Optional[str] = None,
+    ate: Optional[str] = None,
     obra_id: Optional[str] = None,
-    mes: Optional[int] = None,
-    ano: Optional[int] = None,
-    tipo_recurso: Optional[str] = None,
     user=Depends(get_current_user)
 ):
-    """Relatório de movimentos de equipamentos e viaturas filtrado por obra e período"""
-    # Build query filter
-    query = {}
+    """Séries temporais de indicadores (movimentos, stock, km, atribuições) por dia, semana ou mês.
+    
+    metric aceita várias métricas separadas por vírgulas, para um gráfico carregar tudo num pedido.
+    """
+    metricas = [m.strip() for m in metric.split(",") if m.strip()]
+    invalidas = [m for m in metricas if m not in KPI_METRICAS]
+    if not metricas or invalidas:
+        raise HTTPException(status_code=400, detail=f"Métrica inválida. Use: {', '.join(KPI_METRICAS)}")
+    if granularidade not in KPI_GRANULARIDADES:
+        raise HTTPException(status_code=400, detail="Granularidade inválida (dia, semana ou mes)")
+    
+    chave = (tuple(metricas), granularidade, de, ate, obra_id)
+    resultado = kpi_cache.obter(chave)
+    if resultado is not None:
+        response.headers["X-Cache"] = "HIT"
+        return resultado
+    
+    data_ate = parse_data_param(ate, fim_do_dia=True) if ate else datetime.now(timezone.utc)
+    data_de = parse_data_param(de) if de else data_ate - KPI_GRANULARIDADES[granularidade][2]
+    if data_ate <= data_de:
+        raise HTTPException(status_code=400, detail="Intervalo de datas inválido")
+    pontos = (data_ate - inicio_balde(data_de, granularidade)).days / {"dia": 1, "semana": 7, "mes": 28}[granularidade]
+    if pontos > KPI_MAX_PONTOS:
+        raise HTTPException(status_code=400, detail="Intervalo demasiado longo para esta granularidade")
+    
+    series = await asyncio.gather(*(serie_kpi(m, granularidade, data_de, data_ate, obra_id) for m in metricas))
+    resultado = {
+        "granularidade": granularidade,
+        "de": data_de.isoformat(),
+        "ate": data_ate.isoformat(),
+        "obra_id": obra_id,
+        "metricas": dict(zip(metricas, series))
+    }
+    kpi_cache.guardar(chave, resultado)
+    response.headers["X-Cache"] = "MISS"
+    return resultado
+
+# ==================== PESQUISA ====================
+PESQUISA_MAX_RESULTADOS = 50
+
+async def pesquisar_colecao(colecao: str, q: str, termos: list, limite: int) -> list:
+    """Resultados de uma coleção: índice de texto e prefixo das chaves, com a relevância combinada"""
+    tipo, codigos, textos = PESQUISA[colecao]
+    projecao = {"_id": 0, "id": 1, **{campo: 1 for campo in codigos + textos}}
+    # Anchored regexes on the multikey index scan only the matching key range; terms are [0-9a-z] only
+    prefixo = {"$and": [{"chaves_pesquisa": re.compile(f"^{termo}")} for termo in termos]}
+    if len(termos) > 1:
+        prefixo = {"$or": [prefixo, {"chaves_pesquisa": re.compile(f"^{''.join(termos)}")}]}
+    por_texto, por_prefixo = await asyncio.gather(
+        db[colecao].find({"$text": {"$search": q}}, {**projecao, "relevancia": {"$meta": "textScore"}})
+                   .sort([("relevancia", {"$meta": "textScore"})]).limit(limite).to_list(limite),
+        db[colecao].find(prefixo, projecao).limit(limite).to_list(limite)
+    )
+    
+    documentos = {doc["id"]: doc for doc in por_texto}
+    for doc in por_prefixo:
+        documentos.setdefault(doc["id"], {**doc, "relevancia": 0.0})
+    compacto = "".join(termos)
+    prefixos = {doc["id"] for doc in por_prefixo}
+    resultados = []
+    for doc in documentos.values():
+        chaves = [compactar(doc.get(campo)) for campo in codigos]
+        if compacto in chaves:
+            bonus, correspondencia = 10, "codigo"
+        elif any(chave.startswith(compacto) for chave in chaves):
+            bonus, correspondencia = 5, "prefixo"
+        elif doc["id"] in prefixos:
+            bonus, correspondencia = 1, "prefixo"
+        else:
+            bonus, correspondencia = 0, "texto"
+        resultados.append({"tipo": tipo, **doc, "relevancia": round(doc["relevancia"] + bonus, 3),
+                           "correspondencia": correspondencia})
+    return resultados
+
+@api_router.get("/pesquisa")
+async def pesquisa_global(q: str = "", tipos: Optional[str] = None, limite: int = 20, user=Depends(get_current_user)):
+    """Pesquisa em equipamentos, viaturas, materiais e obras, sem distinguir acentos nem maiúsculas.
+    
+    Junta o índice de texto (palavras, em português) com o prefixo de códigos, matrículas e
+    palavras; devolve os resultados ordenados por relevância, cada um com o seu tipo.
+    """
+    inicio = time.perf_counter()
+    limite = max(1, min(limite, PESQUISA_MAX_RESULTADOS))
+    tipos_validos = {tipo: colecao for colecao, (tipo, _, _) in PESQUISA.items()}
+    pedidos = [t.strip() for t in tipos.split(",") if t.strip()] if tipos else list(tipos_validos)
+    if any(t not in tipos_validos for t in pedidos):
+        raise HTTPException(status_code=400, detail=f"Tipo inválido (tipos: {', '.join(tipos_validos)})")
+    
+    termos = re.findall(r"[0-9a-z]+", normalizar(q))
+    if not termos:
+        return {"q": q, "resultados": [], "total": 0}
+    por_colecao = await asyncio.gather(*(pesquisar_colecao(tipos_validos[t], q, termos, limite) for t in pedidos))
+    resultados = sorted(itertools.chain.from_iterable(por_colecao), key=lambda r: -r["relevancia"])[:limite]
+    return {"q": q, "resultados": resultados, "total": len(resultados),
+            "segundos": round(time.perf_counter() - inicio, 4)}
+
+# ==================== INGESTÃO DE VIAGENS ====================
+INGEST_MAX_ERROS = 100  # linhas inválidas detalhadas na resposta
+
+def chave_matricula(matricula: str) -> str:
+    """Matrícula sem separadores nem minúsculas ('aa-00-bb' e 'AA 00 BB' são a mesma viatura)"""
+    return re.sub(r"[^0-9A-Z]", "", matricula.upper())
+
+viaturas_por_matricula = CacheTTL(INGEST_CACHE_SECONDS, 1)
+
+async def mapa_matriculas(recarregar: bool = False) -> dict:
+    """chave_matricula -> viatura_id, lido de uma vez e guardado em cache"""
+    mapa = None if recarregar else viaturas_por_matricula.obter("mapa")
+    if mapa is None:
+        mapa = {chave_matricula(v["matricula"]): v["id"]
+                async for v in db.viaturas.find({}, {"_id": 0, "id": 1, "matricula": 1})}
+        viaturas_por_matricula.guardar("mapa", mapa)
+    return mapa
+
+async def linhas_pedido(request: Request):
+    """Linhas do corpo à medida que chegam (sem o carregar todo em memória), numeradas a partir de 1"""
+    resto = b""
+    numero = 0
+    async for bloco in request.stream():
+        *linhas, resto = (resto + bloco).split(b"\n")
+        for linha in linhas:
+            numero += 1
+            yield numero, linha.rstrip(b"\r")
+    if resto.strip():
+        yield numero + 1, resto.rstrip(b"\r")
+
+async def registos_csv(request: Request):
+    """(linha, valores, erro) por registo CSV não vazio. Um campo entre aspas pode ter quebras de
+    linha: o registo só termina quando as aspas estão equilibradas."""
+    registo, inicio, aspas = [], 0, 0
+    async for numero, linha in linhas_pedido(request):
+        try:
+            texto = linha.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            yield numero, None, "Linha não está em UTF-8"
+            registo, aspas = [], 0
+            continue
+        if not registo:
+            if not texto.strip():
+                continue
+            inicio = numero
+        registo.append(texto + "\n")
+        aspas += texto.count('"')
+        if aspas % 2 == 0:
+            yield inicio, next(csv.reader(registo)), None
+            registo, aspas = [], 0
+    if registo:
+        yield inicio, None, "Aspas por fechar"
+
+async def ler_viagens(request: Request, formato: str):
+    """(linha, viagem, erros) por cada registo; viagem é None quando o registo é inválido"""
+    if formato == "ndjson":
+        async for numero, linha in linhas_pedido(request):
+            if not linha.strip():
+                continue
+            try:
+                yield numero, VIAGEM_ADAPTER.validate_json(linha), None
+            except ValidationError as e:
+                yield numero, None, e.errors(include_url=False)
+        return
+
+    cabecalho = None
+    async for numero, valores, erro in registos_csv(request):
+        if erro:
+            yield numero, None, [{"msg": erro}]
+            continue
+        if cabecalho is None:
+            cabecalho = [c.strip().lower() for c in valores]
+            continue
+        try:
+            viagem = VIAGEM_ADAPTER.validate_python(
+                {campo: valor for campo, valor in zip(cabecalho, valores) if valor != ""})
+        except ValidationError as e:
+            yield numero, None, e.errors(include_url=False)
+            continue
+        yield numero, viagem, None
+
+async def gravar_viagens(docs: list, odometros: dict) -> list:
+    """Insere um bloco de viagens; devolve as inseridas (as repetidas são rejeitadas pelo índice único)"""
+    docs.sort(key=lambda d: (d["viatura_id"], d["created_at"]))
+    novas = list({d["viatura_id"] for d in docs} - odometros.keys())
+    if novas:
+        async for viatura in db.viaturas.find({"id": {"$in": novas}}, {"_id": 0, "id": 1, "km_atual": 1}):
+            odometros[viatura["id"]] = viatura.get("km_atual")
+    for doc in docs:
+        # Trips are flagged against the running odometer, never rejected: telemetry backfills history
+        anterior = odometros.get(doc["viatura_id"])
+        lacuna = doc["km_inicial"] - anterior if anterior is not None else 0
+        doc["km_anterior"] = anterior
+        doc["lacuna_km"] = lacuna if lacuna > ODOMETER_GAP_TOLERANCE_KM else 0
+        if anterior is None or doc["km_final"] > anterior:
+            odometros[doc["viatura_id"]] = doc["km_final"]
+    
+    docs = await sync_stamp_many(docs)
+    try:
+        await db.movimentos_viaturas.insert_many(docs, ordered=False)
+        repetidas = set()
+    except BulkWriteError as e:
+        erros = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in erros):
+            raise
+        repetidas = {err["index"] for err in erros}
+    return [doc for i, doc in enumerate(docs) if i not in repetidas]
+
+@api_router.post("/movimentos/viaturas/ingest")
+async def ingest_viagens(request: Request, formato: Optional[str] = None, user=Depends(get_current_user)):
+    """Importa viagens de telemetria em NDJSON ou CSV (cabeçalho: matricula, data, km_inicial, km_final,
+    condutor, obra_codigo, observacoes).
+    
+    O corpo é lido e gravado em blocos à medida que chega. Linhas inválidas ou de matrículas
+    desconhecidas são reportadas sem travar as restantes; uma viagem já importada (mesma viatura,
+    data e km) é contada como duplicada. O odómetro de cada viatura avança para o maior km final.
+    """
+    inicio = time.perf_counter()
+    formato = formato or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato inválido (ndjson ou csv)")
+    
+    ingestao_id = str(uuid.uuid4())
+    matriculas = await mapa_matriculas()
+    recarregado = False
+    obras = {o["codigo"]: o["id"] async for o in db.obras.find({}, {"_id": 0, "id": 1, "codigo": 1})}
+    odometros = {}
+    km_finais = {}
+    lote = []
+    recebidas = inseridas = invalidas = lacunas = 0
+    erros = []
+    
+    def invalida(numero, detalhe):
+        nonlocal invalidas
+        invalidas += 1
+        if len(erros) < INGEST_MAX_ERROS:
+            erros.append({"linha": numero, "erros": detalhe})
     
+    async def gravar():
+        nonlocal inseridas, lacunas
+        for doc in await gravar_viagens(lote, odometros):
+            inseridas += 1
+            lacunas += doc["lacuna_km"] > 0
+            km_finais[doc["viatura_id"]] = max(km_finais.get(doc["viatura_id"], 0), doc["km_final"])
+        lote.clear()
+    
+    async for numero, viagem, detalhe in ler_viagens(request, formato):
+        recebidas += 1
+        if viagem is None:
+            invalida(numero, detalhe)
+            continue
+        if viagem.data is None:
+            invalida(numero, [{"loc": ["data"], "msg": "Data em falta"}])
+            continue
+        if viagem.km_inicial < 0 or viagem.km_final < viagem.km_inicial:
+            invalida(numero, [{"loc": ["km_final"], "msg": "Km negativos ou km final inferior ao inicial"}])
+            continue
+        chave = chave_matricula(viagem.matricula)
+        if chave not in matriculas and not recarregado:
+            # A vehicle created after the cache was filled: reload once per request
+            matriculas = await mapa_matriculas(recarregar=True)
+            recarregado = True
+        if chave not in matriculas:
+            invalida(numero, [{"loc": ["matricula"], "msg": f"Viatura não encontrada: {viagem.matricula}"}])
+            continue
+        if viagem.obra_codigo and viagem.obra_codigo not in obras:
+            invalida(numero, [{"loc": ["obra_codigo"], "msg": f"Obra não encontrada: {viagem.obra_codigo}"}])
+            continue
+        
+        lote.append({
+            "id": str(uuid.uuid4()),
+            "viatura_id": matriculas[chave],
+            "obra_id": obras.get(viagem.obra_codigo),
+            "condutor": viagem.condutor,
+            "km_inicial": viagem.km_inicial,
+            "km_final": viagem.km_final,
+            "data": viagem.data.date().isoformat(),
+            "observacoes": viagem.observacoes,
+            "created_at": viagem.data,
+            "ingestao_id": ingestao_id
+        })
+        if len(lote) >= INGEST_CHUNK_SIZE:
+            await gravar()
+    if lote:
+        await gravar()
+    
+    for viatura_id, km in km_finais.items():
+        carimbo = await sync_stamp()
+        viatura = await db.viaturas.find_one_and_update(
+            {"id": viatura_id, "$or": [{"km_atual": None}, {"km_atual": {"$lt": km}}]},
+            {"$set": {"km_atual": km, **carimbo}, "$inc": {"version": 1}},
+            projection={"_id": 0, "version": 1}, return_document=ReturnDocument.AFTER)
+        if viatura:
+            publicar("viaturas", "atualizado", {"id": viatura_id, "km_atual": km, **viatura, **carimbo})
+            await agenda_alertas.registar_km(viatura_id, km)
+    if inseridas:
+        publicar("movimentos_viaturas", "importado", {"total": inseridas})
+    
+    segundos = time.perf_counter() - inicio
+    logger.info(f"Ingest {ingestao_id}: {recebidas} trips in {segundos:.2f}s ({inseridas} inserted)")
+    return {
+        "ingestao_id": ingestao_id,
+        "formato": formato,
+        "recebidas": recebidas,
+        "inseridas": inseridas,
+        "duplicadas": recebidas - invalidas - inseridas,
+        "invalidas": invalidas,
+        "erros": erros,
+        "lacunas": lacunas,
+        "segundos": round(segundos, 3),
+        "viagens_por_segundo": round(recebidas / segundos, 1) if segundos else None
+    }
+
+# ==================== ROLLUPS MENSAIS ====================
+# One document per (tipo, obra_id, chave, periodo): chave is the material_id for
+# stock rollups and the tipo_recurso for equipment/vehicle movement rollups.
+def periodo_de(value) -> str:
+    """Período yyyy-mm de uma data do ledger"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m")
+    return str(value)[:7]
+
+def periodo_expr(field: str):
+    return {"$dateToString": {"format": "%Y-%m", "date": f"${field}", "timezone": "UTC"}}
+
+def rollup_op(mov: dict) -> UpdateOne:
+    """Incremento do rollup mensal correspondente a um movimento de stock ou de ativos"""
+    if "material_id" in mov:
+        entrada = mov.get("tipo_movimento") == "Entrada"
+        quantidade = mov.get("quantidade", 0)
+        key = {"tipo": "stock", "obra_id": mov.get("obra_id"), "chave": mov["material_id"],
+               "periodo": periodo_de(mov["data_hora"])}
+        inc = {
+            "entradas": quantidade if entrada else 0,
+            "saidas": 0 if entrada else quantidade,
+            "n_entradas": int(entrada),
+            "n_saidas": int(not entrada)
+        }
+        return UpdateOne(key, {"$inc": inc}, upsert=True)
+    
+    saida = mov.get("tipo_movimento") == "Saida"
+    key = {"tipo": "ativos", "obra_id": mov.get("obra_id"), "chave": mov["tipo_recurso"],
+           "periodo": periodo_de(mov["created_at"])}
+    return UpdateOne(key, {"$inc": {"saidas": int(saida), "devolucoes": int(not saida)},
+                           "$addToSet": {"recursos": mov["recurso_id"]}}, upsert=True)
+
+async def update_rollups(movimentos: list, session=None):
+    if movimentos:
+        await db.rollups_mensais.bulk_write([rollup_op(m) for m in movimentos], ordered=False, session=session)
+
+def rollup_match(tipo: str, obra_id: Optional[str], mes: Optional[int], ano: Optional[int]) -> dict:
+    match = {"tipo": tipo}
     if obra_id:
-        query["obra_id"] = obra_id
+        match["obra_id"] = obra_id
+    if mes and ano:
+        match["periodo"] = f"{ano:04d}-{mes:02d}"
+    elif ano:
+        match["periodo"] = {"$gte": f"{ano:04d}-01", "$lte": f"{ano:04d}-12"}
+    return match
+
+async def rollup_totais_ativos(obra_id: Optional[str], mes: Optional[int], ano: Optional[int],
+                               tipo_recurso: Optional[str] = None, session=None) -> dict:
+    match = rollup_match("ativos", obra_id, mes, ano)
+    if tipo_recurso:
+        match["chave"] = tipo_recurso
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$chave", "saidas": {"$sum": "$saidas"}, "devolucoes": {"$sum": "$devolucoes"},
+                    "recursos": {"$push": "$recursos"}}},
+        {"$project": {"saidas": 1, "devolucoes": 1, "recursos": {"$size": {"$reduce": {
+            "input": "$recursos", "initialValue": [], "in": {"$setUnion": ["$$value", "$$this"]}
+        }}}}}
+    ]
+    totais = {"saidas": 0, "devolucoes": 0, "equipamentos_movidos": 0, "viaturas_movidas": 0}
+    async for group in db.rollups_mensais.aggregate(pipeline, session=session):
+        totais["saidas"] += group["saidas"]
+        totais["devolucoes"] += group["devolucoes"]
+        if group["_id"] == "equipamento":
+            totais["equipamentos_movidos"] = group["recursos"]
+        elif group["_id"] == "viatura":
+            totais["viaturas_movidas"] = group["recursos"]
+    return totais
+
+async def rollup_totais_stock(obra_id: Optional[str], mes: Optional[int], ano: Optional[int], session=None) -> dict:
+    """Totais de stock por material_id"""
+    pipeline = [
+        {"$match": rollup_match("stock", obra_id, mes, ano)},
+        {"$group": {"_id": "$chave", "entradas": {"$sum": "$entradas"}, "saidas": {"$sum": "$saidas"},
+                    "n_entradas": {"$sum": "$n_entradas"}, "n_saidas": {"$sum": "$n_saidas"}}}
+    ]
+    return {group["_id"]: group async for group in db.rollups_mensais.aggregate(pipeline, session=session)}
+
+async def rebuild_rollups() -> int:
+    """Recalcula todos os rollups a partir dos ledgers e substitui a coleção.
+    
+    Só pode correr sem escritas: um $inc de update_rollups entre a agregação e a troca de
+    coleções cairia na coleção antiga e perdia-se. Corre no arranque, com a coleção vazia e
+    antes de servir pedidos, e em 'python manage.py rebuild-rollups --api-parada'.
+    """
+    entrada = {"$eq": ["$tipo_movimento", "Entrada"]}
+    stock = await db.movimentos_stock.aggregate([
+        {"$group": {
+            "_id": {"obra_id": "$obra_id", "chave": "$material_id", "periodo": periodo_expr("data_hora")},
+            "entradas": {"$sum": {"$cond": [entrada, "$quantidade", 0]}},
+            "saidas": {"$sum": {"$cond": [entrada, 0, "$quantidade"]}},
+            "n_entradas": {"$sum": {"$cond": [entrada, 1, 0]}},
+            "n_saidas": {"$sum": {"$cond": [entrada, 0, 1]}}
+        }},
+        {"$project": {"_id": 0, "tipo": {"$literal": "stock"}, "obra_id": "$_id.obra_id", "chave": "$_id.chave", "periodo": "$_id.periodo",
+                      "entradas": 1, "saidas": 1, "n_entradas": 1, "n_saidas": 1}}
+    ], allowDiskUse=True).to_list(None)
+    saida = {"$eq": ["$tipo_movimento", "Saida"]}
+    ativos = await db.movimentos.aggregate([
+        {"$group": {
+            "_id": {"obra_id": "$obra_id", "chave": "$tipo_recurso", "periodo": periodo_expr("created_at")},
+            "saidas": {"$sum": {"$cond": [saida, 1, 0]}},
+            "devolucoes": {"$sum": {"$cond": [saida, 0, 1]}},
+            "recursos": {"$addToSet": "$recurso_id"}
+        }},
+        {"$project": {"_id": 0, "tipo": {"$literal": "ativos"}, "obra_id": "$_id.obra_id", "chave": "$_id.chave", "periodo": "$_id.periodo",
+                      "saidas": 1, "devolucoes": 1, "recursos": 1}}
+    ], allowDiskUse=True).to_list(None)
+    
+    docs = stock + ativos
+    if not docs:
+        await db.rollups_mensais.delete_many({})
+        return 0
+    # Build aside and swap in, so readers never see a half-built collection
+    rebuild = db.rollups_mensais_rebuild
+    await rebuild.drop()
+    await rebuild.insert_many(docs)
+    _, keys, options = next(spec for spec in COMPOUND_INDEXES if spec[0] == "rollups_mensais")
+    await rebuild.create_index(keys, **options)
+    await rebuild.rename("rollups_mensais", dropTarget=True)
+    return len(docs)
+
+# Date fields stored as BSON dates; documents written before hold ISO strings
+DATE_FIELDS = {
+    "equipamentos": ["created_at", "updated_at", "data_inspecao"],
+    "viaturas": ["created_at", "updated_at", "data_vistoria", "data_seguro", "data_tacografo"],
+    "materiais": ["created_at", "updated_at"],
+    "obras": ["created_at", "updated_at", "encerrada_em"],
+    "movimentos": ["created_at", "updated_at", "data_levantamento", "data_devolucao", "registado_offline_em"],
+    "movimentos_stock": ["data_hora", "updated_at", "registado_offline_em"],
+    "movimentos_viaturas": ["created_at", "updated_at", "registado_offline_em"],
+    "tombstones": ["updated_at"],
+    "atribuicoes": ["inicio", "fim"],
+    "reservas": ["inicio", "fim", "created_at"],
+    "stock_snapshots": ["data", "created_at"],
+    "relatorios_obra_final": ["encerrada_em"],
+    "users": ["created_at"],
+}
+
+async def migrate_bson_dates(lote: int = 1000) -> int:
+    """Converte as datas guardadas como texto ISO em datas BSON; devolve o número de campos convertidos.
+    
+    O marcador guarda os campos já convertidos: um campo acrescentado a DATE_FIELDS é
+    convertido no arranque seguinte.
+    """
+    marcador = await db.migrations.find_one({"_id": "bson_dates"}) or {}
+    convertidos = set(marcador.get("campos", []))
+    todos = [f"{nome}.{campo}" for nome, campos in DATE_FIELDS.items() for campo in campos]
+    if convertidos.issuperset(todos):
+        return 0
+    total = 0
+    for nome, campos in DATE_FIELDS.items():
+        for campo in campos:
+            if f"{nome}.{campo}" in convertidos:
+                continue
+            cursor = db[nome].find({campo: {"$type": "string"}}, {"_id": 1, campo: 1})
+            while batch := await cursor.to_list(lote):
+                ops = []
+                for doc in batch:
+                    valor = parse_ts(doc[campo])
+                    if valor is None and doc[campo].strip():
+                        logger.warning(f"{nome}.{campo} = {doc[campo]!r} is not a date; left unchanged (_id {doc['_id']})")
+                        continue
+                    ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {campo: valor}}))
+                if ops:
+                    await db[nome].bulk_write(ops, ordered=False)
+                    total += len(ops)
+    await db.migrations.update_one({"_id": "bson_dates"}, {"$set": {"em": datetime.now(timezone.utc), "campos": todos}}, upsert=True)
+    return total
+
+async def backfill_km_atual() -> int:
+    """Odómetro das viaturas anteriores ao campo: o maior km final registado"""
+    sem_odometro = [v["id"] async for v in db.viaturas.find({"km_atual": {"$exists": False}}, {"_id": 0, "id": 1})]
+    if not sem_odometro:
+        return 0
+    maximos = {g["_id"]: g["km"] async for g in db.movimentos_viaturas.aggregate([
+        {"$match": {"viatura_id": {"$in": sem_odometro}}},
+        {"$group": {"_id": "$viatura_id", "km": {"$max": "$km_final"}}}
+    ])}
+    ops = [UpdateOne({"id": vid, "km_atual": {"$exists": False}}, {"$set": {"km_atual": maximos.get(vid) or None}})
+           for vid in sem_odometro]
+    await db.viaturas.bulk_write(ops, ordered=False)
+    return sum(1 for vid in sem_odometro if maximos.get(vid))
+
+async def backfill_saldos_iniciais() -> int:
+    """Saldo inicial no ledger dos materiais criados antes de o stock inicial ser registado.
+    
+    O saldo é a diferença entre stock_atual e o ledger, datado da criação do material (ou do
+    seu primeiro movimento, se anterior). Os snapshots de stock já tirados a partir dessa data
+    são corrigidos com o mesmo valor.
+    """
+    if await db.migrations.find_one({"_id": "saldos_iniciais"}):
+        return 0
+    ledger = {g["_id"]: g async for g in db.movimentos_stock.aggregate([
+        {"$group": {"_id": "$material_id", "saldo": {"$sum": SIGNED_QUANTIDADE}, "primeiro": {"$min": "$data_hora"},
+                    "saldos_iniciais": {"$sum": {"$cond": [{"$eq": ["$documento", "SALDO_INICIAL"]}, 1, 0]}}}}
+    ], allowDiskUse=True)}
+    materiais = []
+    async for material in db.materiais.find({}, {"_id": 0, "id": 1, "stock_atual": 1, "created_at": 1}):
+        grupo = ledger.get(material["id"], {})
+        if grupo.get("saldos_iniciais"):
+            continue
+        diferenca = round((material.get("stock_atual") or 0) - grupo.get("saldo", 0), 6)
+        datas = [d for d in (parse_ts(material.get("created_at")), parse_ts(grupo.get("primeiro"))) if d]
+        materiais.append({"id": material["id"], "stock_atual": diferenca,
+                          "created_at": min(datas) if datas else datetime.now(timezone.utc)})
+    
+    saldo_inicial = await sync_stamp_many(movimentos_saldo_inicial(materiais))
+    if saldo_inicial:
+        await db.movimentos_stock.insert_many([{**m} for m in saldo_inicial])
+        await update_rollups(saldo_inicial)
+        await db.stock_snapshots.bulk_write([
+            UpdateMany({"data": {"$gte": db_ts(m["data_hora"])}},
+                       {"$inc": {f"saldos.{m['material_id']}": m["quantidade"] if m["tipo_movimento"] == "Entrada" else -m["quantidade"]}})
+            for m in saldo_inicial
+        ], ordered=False)
+    await db.migrations.update_one({"_id": "saldos_iniciais"}, {"$set": {"em": datetime.now(timezone.utc)}}, upsert=True)
+    return len(saldo_inicial)
+
+async def purge_idempotency_credentials() -> int:
+    """Remove respostas guardadas antes da lista de caminhos idempotentes que contêm tokens de acesso"""
+    com_token = [r["_id"] async for r in db.idempotency.find({"estado": "concluido"}, {"corpo": 1})
+                 if b'"access_token"' in bytes(r.get("corpo") or b"")]
+    if com_token:
+        await db.idempotency.delete_many({"_id": {"$in": com_token}})
+    return len(com_token)
+
+async def backfill_chaves_pesquisa() -> int:
+    """Chaves de pesquisa dos documentos anteriores ao campo"""
+    total = 0
+    for colecao, (_, codigos, textos) in PESQUISA.items():
+        ops = [UpdateOne({"id": doc["id"]}, {"$set": {"chaves_pesquisa": chaves_pesquisa(colecao, doc)}})
+               async for doc in db[colecao].find({"chaves_pesquisa": {"$exists": False}},
+                                                 {"_id": 0, "id": 1, **{campo: 1 for campo in codigos + textos}})]
+        if ops:
+            await db[colecao].bulk_write(ops, ordered=False)
+        total += len(ops)
+    return total
+
+async def run_migrations():
+    """Migrações idempotentes executadas no arranque"""
+    # Before the rollup rebuild: its monthly periods come from $dateToString
+    if convertidas := await migrate_bson_dates():
+        logger.info(f"Converted {convertidas} ISO string date(s) to BSON dates")
+    if not await db.rollups_mensais.estimated_document_count() and (
+            await db.movimentos.estimated_document_count() or await db.movimentos_stock.estimated_document_count()):
+        logger.info(f"Built {await rebuild_rollups()} monthly rollups from the ledgers")
+    if not await db.atribuicoes.estimated_document_count() and await db.movimentos.estimated_document_count():
+        logger.info(f"Built {await rebuild_atribuicoes()} assignment intervals from movimentos")
+    # After the rollup rebuild, which would otherwise count these movements twice
+    if saldos := await backfill_saldos_iniciais():
+        logger.info(f"Booked the opening stock of {saldos} material(s) in the ledger")
+    if stamped := await backfill_sync_stamps():
+        logger.info(f"Stamped {stamped} existing document(s) for /sync")
+    if regras := await seed_regras_alerta():
+        logger.info(f"Created {regras} default alert rule(s)")
+    if sem_revisao := await clear_km_revisao_default():
+        logger.info(f"Cleared the default km_ultima_revisao of {sem_revisao} viatura(s)")
+    if odometros := await backfill_km_atual():
+        logger.info(f"Set the odometer of {odometros} viatura(s) from the km ledger")
+    if credenciais := await purge_idempotency_credentials():
+        logger.info(f"Removed {credenciais} stored auth response(s) from the idempotency cache")
+    if chaves := await backfill_chaves_pesquisa():
+        logger.info(f"Derived search keys for {chaves} document(s)")
+    resultado = await db.materiais.update_many({"abaixo_minimo": {"$exists": False}}, [ESTADO_STOCK])
+    if resultado.modified_count:
+        logger.info(f"Derived the low-stock flag for {resultado.modified_count} material(s)")
+
+# ==================== STOCK SNAPSHOTS ====================
+# Each snapshot holds the ledger balance of every material at an interval boundary
+# (movements with data_hora < data), so a point-in-time lookup only replays the
+# movements since the nearest earlier snapshot.
+def snapshot_boundary(instant: datetime, intervalo: str = None) -> datetime:
+    """Último limite de intervalo (início do dia ou do mês, UTC) <= instant"""
+    dia = instant.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return dia.replace(day=1) if (intervalo or STOCK_SNAPSHOT_INTERVAL) == "mes" else dia
+
+def next_snapshot_boundary(boundary: datetime, intervalo: str = None) -> datetime:
+    if (intervalo or STOCK_SNAPSHOT_INTERVAL) == "mes":
+        return boundary.replace(year=boundary.year + 1, month=1) if boundary.month == 12 else boundary.replace(month=boundary.month + 1)
+    return boundary + timedelta(days=1)
+
+SIGNED_QUANTIDADE = {"$cond": [{"$eq": ["$tipo_movimento", "Entrada"]}, "$quantidade", {"$multiply": [-1, "$quantidade"]}]}
+
+async def ledger_deltas(desde: Optional[datetime], ate: datetime, material_id: Optional[str] = None):
+    """Variação de stock por material nos movimentos com desde <= data_hora < ate"""
+    match = {"data_hora": {"$lt": db_ts(ate)}}
+    if desde:
+        match["data_hora"]["$gte"] = db_ts(desde)
+    if material_id:
+        match["material_id"] = material_id
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$material_id", "delta": {"$sum": SIGNED_QUANTIDADE}, "movimentos": {"$sum": 1}}}
+    ]
+    deltas, movimentos = {}, 0
+    async for group in db.movimentos_stock.aggregate(pipeline):
+        deltas[group["_id"]] = group["delta"]
+        movimentos += group["movimentos"]
+    return deltas, movimentos
+
+async def latest_stock_snapshot(ate: datetime) -> Optional[dict]:
+    return await db.stock_snapshots.find_one({"data": {"$lte": db_ts(ate)}}, {"_id": 0}, sort=[("data", -1)])
+
+async def stock_em(instante: datetime, material_id: Optional[str] = None) -> dict:
+    """Saldos do ledger no instante dado: snapshot anterior mais os movimentos desde então"""
+    base = await latest_stock_snapshot(instante)
+    saldos = dict(base["saldos"]) if base else {}
+    if material_id:
+        saldos = {material_id: saldos.get(material_id, 0)}
+    deltas, movimentos = await ledger_deltas(parse_ts(base["data"]) if base else None, instante, material_id)
+    for mat_id, delta in deltas.items():
+        saldos[mat_id] = saldos.get(mat_id, 0) + delta
+    return {"base": base["data"] if base else None, "movimentos_aplicados": movimentos, "saldos": saldos}
+
+async def take_stock_snapshot(data: datetime) -> dict:
+    existing = await db.stock_snapshots.find_one({"data": db_ts(data)}, {"_id": 0})
+    if existing:
+        return existing
+    estado = await stock_em(data)
+    snapshot = {
+        "id": str(uuid.uuid4()),
+        "data": db_ts(data),
+        "intervalo": STOCK_SNAPSHOT_INTERVAL,
+        "saldos": estado["saldos"],
+        "created_at": db_ts(datetime.now(timezone.utc))
+    }
+    try:
+        await db.stock_snapshots.insert_one({**snapshot})
+    except DuplicateKeyError:
+        pass  # another worker took the same snapshot
+    return snapshot
+
+async def take_due_stock_snapshots(limite: int = 400) -> int:
+    """Tira os snapshots em falta até ao limite de intervalo mais recente"""
+    atual = snapshot_boundary(datetime.now(timezone.utc))
+    ultimo = await latest_stock_snapshot(atual)
+    proximo = next_snapshot_boundary(snapshot_boundary(parse_ts(ultimo["data"]))) if ultimo else atual
+    tirados = 0
+    while proximo <= atual and tirados < limite:
+        await take_stock_snapshot(proximo)
+        proximo = next_snapshot_boundary(proximo)
+        tirados += 1
+    return tirados
+
+async def stock_snapshot_loop():
+    while True:
+        try:
+            tirados = await take_due_stock_snapshots()
+            if tirados:
+                logger.info(f"Took {tirados} stock snapshot(s)")
+        except Exception:
+            logger.exception("Stock snapshot job failed")
+        agora = datetime.now(timezone.utc)
+        espera = (next_snapshot_boundary(snapshot_boundary(agora)) - agora).total_seconds()
+        await asyncio.sleep(max(espera, 0) + 5)
+
+# ==================== RECONCILIAÇÃO DE STOCK ====================
+async def ler_ledger_e_stock(material_ids: Optional[list] = None, session=None):
+    """Saldo do ledger e stock_atual de cada material (de todos, ou só dos indicados)"""
+    filtro = {"material_id": {"$in": material_ids}} if material_ids is not None else {}
+    saldos = {
+        group["_id"]: group["saldo"]
+        async for group in db.movimentos_stock.aggregate(
+            [{"$match": filtro}, {"$group": {"_id": "$material_id", "saldo": {"$sum": SIGNED_QUANTIDADE}}}],
+            allowDiskUse=True, session=session
+        )
+    }
+    materiais = await db.materiais.find(
+        {"id": {"$in": material_ids}} if material_ids is not None else {},
+        {"_id": 0, "id": 1, "codigo": 1, "descricao": 1, "unidade": 1, "stock_atual": 1}, session=session
+    ).to_list(None)
+    return saldos, materiais
+
+def divergencias_stock(saldos: dict, materiais: list) -> list:
+    divergencias = []
+    for material in materiais:
+        stock_atual = material.get("stock_atual", 0) or 0
+        saldo = saldos.get(material["id"], 0)
+        diferenca = round(stock_atual - saldo, 6)
+        if diferenca:
+            divergencias.append({
+                "material_id": material["id"],
+                "codigo": material.get("codigo", ""),
+                "descricao": material.get("descricao", ""),
+                "unidade": material.get("unidade", "un"),
+                "stock_atual": stock_atual,
+                "saldo_ledger": saldo,
+                "diferenca": diferenca
+            })
+    return divergencias
+
+async def reconcile_stock(corrigir: bool = False, origem: str = "manual", responsavel: str = "") -> dict:
+    """Compara stock_atual com o saldo do ledger de todos os materiais.
+    
+    Os dois lados são lidos no mesmo instante (transação com leitura snapshot), senão um
+    movimento gravado entre as duas leituras pareceria uma divergência e, com corrigir, seria
+    contado duas vezes. Numa instância standalone, sem transações, só ficam as divergências
+    que uma segunda leitura dos mesmos materiais confirma.
+    
+    Com corrigir=True, cria movimentos de ajuste para que o ledger volte a bater certo com
+    stock_atual (assumido como a contagem física); stock_atual não é alterado.
+    """
+    if await transactions_supported():
+        async with await client.start_session() as session:
+            async with session.start_transaction(read_concern=ReadConcern("snapshot")):
+                saldos, materiais = await ler_ledger_e_stock(session=session)
+        divergencias = divergencias_stock(saldos, materiais)
+    else:
+        saldos, materiais = await ler_ledger_e_stock()
+        divergencias = divergencias_stock(saldos, materiais)
+        if divergencias:
+            confirmadas = {(d["material_id"], d["diferenca"]) for d in divergencias_stock(
+                *await ler_ledger_e_stock([d["material_id"] for d in divergencias]))}
+            divergencias = [d for d in divergencias if (d["material_id"], d["diferenca"]) in confirmadas]
+    
+    ajustes = []
+    if corrigir and divergencias:
+        ajustes = [MovimentoStock(
+            material_id=d["material_id"],
+            tipo_movimento="Entrada" if d["diferenca"] > 0 else "Saida",
+            quantidade=abs(d["diferenca"]),
+            documento="RECONCILIACAO",
+            responsavel=responsavel,
+            observacoes="Ajuste de reconciliação do ledger com o stock atual"
+        ).model_dump() for d in divergencias]
+        ajustes = await sync_stamp_many(ajustes)
+        carimbo = await sync_stamp()
+        
+        async def gravar(session):
+            await db.movimentos_stock.insert_many([{**a} for a in ajustes], session=session)
+            await update_rollups(ajustes, session=session)
+            # The adjusted ledger is part of the material's state: an edit form read before it is stale
+            await db.materiais.update_many({"id": {"$in": [d["material_id"] for d in divergencias]}},
+                                           {"$set": carimbo, "$inc": {"version": 1}}, session=session)
+        
+        await run_transaction(gravar)
+        for ajuste in ajustes:
+            publicar("movimentos_stock", "criado", ajuste)
+    
+    return {
+        "id": str(uuid.uuid4()),
+        "data": datetime.now(timezone.utc).isoformat(),
+        "origem": origem,
+        "materiais_verificados": len(materiais),
+        "total_divergencias": len(divergencias),
+        "ajustes_criados": len(ajustes),
+        "divergencias": divergencias
+    }
+
+async def run_stock_reconciliation(corrigir: bool = False, origem: str = "manual", responsavel: str = "") -> dict:
+    relatorio = await reconcile_stock(corrigir, origem, responsavel)
+    await db.reconciliacoes_stock.insert_one({**relatorio})
+    if relatorio["total_divergencias"]:
+        logger.warning(f"Stock reconciliation found {relatorio['total_divergencias']} material(s) with drift")
+    return relatorio
+
+# ==================== UTILIZAÇÃO ====================
+NS_POR_DIA = 86_400 * 10**9
+
+def assignment_intervals(recurso: np.ndarray, tempo: np.ndarray, saida: np.ndarray, fim_aberto: int):
+    """Emparelha eventos Saída/Devolução em intervalos de atribuição.
     
+    Cada Saída abre um intervalo que termina no evento seguinte do mesmo recurso (Devolução
+    ou nova Saída); sem evento seguinte o intervalo fica aberto até fim_aberto.
+    Devolve (índices das Saídas nos arrays de entrada, início, fim, aberto).
+    """
+    ordem = np.lexsort((tempo, recurso))
+    r, t = recurso[ordem], tempo[ordem]
+    seguinte_mesmo = np.zeros(len(r), dtype=bool)
+    seguinte_mesmo[:-1] = r[1:] == r[:-1]
+    fim = np.full(len(r), fim_aberto, dtype=np.int64)
+    fim[:-1] = np.where(seguinte_mesmo[:-1], t[1:], fim_aberto)
+    e_saida = saida[ordem]
+    return ordem[e_saida], t[e_saida], fim[e_saida], ~seguinte_mesmo[e_saida]
+
+def month_edges(de: datetime, ate: datetime) -> pd.DatetimeIndex:
+    inicio = pd.Timestamp(de).tz_convert("UTC").normalize().replace(day=1)
+    meses = pd.date_range(start=inicio, end=ate, freq="MS")
+    return meses.append(pd.DatetimeIndex([meses[-1] + pd.offsets.MonthBegin(1)]))
+
+async def load_assignment_events(tipo_recurso: Optional[str], ate: datetime) -> pd.DataFrame:
+    """Lê os eventos Saída/Devolução ordenados por recurso num único cursor (todo o histórico até ate)"""
+    query = {"tipo_movimento": {"$in": ["Saida", "Devolucao"]}, "created_at": {"$lt": db_ts(ate)}}
     if tipo_recurso:
         query["tipo_recurso"] = tipo_recurso
+    colunas = ["recurso_id", "tipo_recurso", "tipo_movimento", "obra_id", "data_levantamento", "data_devolucao", "created_at"]
+    projection = {"_id": 0, **{campo: 1 for campo in colunas}}
+    cursor = db.movimentos.find(query, projection).sort([("recurso_id", 1), ("created_at", 1)]).batch_size(10000)
+    eventos = pd.DataFrame(await cursor.to_list(None), columns=colunas)
+    propria = eventos["data_levantamento"].where(eventos["tipo_movimento"] == "Saida", eventos["data_devolucao"])
+    eventos["data"] = pd.to_datetime(propria.where(propria.notna() & (propria != ""), eventos["created_at"]),
+                                     utc=True, format="ISO8601", errors="coerce")
+    return eventos.drop(columns=["data_levantamento", "data_devolucao", "created_at"]).dropna(subset=["data"])
+
+async def load_assignment_intervals(tipo_recurso: Optional[str], de: datetime, ate: datetime) -> pd.DataFrame:
+    """Intervalos de atribuição que se sobrepõem a [de, ate), filtrados na base de dados"""
+    query = {"inicio": {"$lt": db_ts(ate)}, "$or": [{"fim": None}, {"fim": {"$gt": db_ts(de)}}]}
+    if tipo_recurso:
+        query["tipo_recurso"] = tipo_recurso
+    colunas = ["recurso_id", "tipo_recurso", "obra_id", "inicio", "fim"]
+    projection = {"_id": 0, **{campo: 1 for campo in colunas}}
+    intervalos = pd.DataFrame(await db.atribuicoes.find(query, projection).to_list(None), columns=colunas)
+    intervalos["inicio"] = pd.to_datetime(intervalos["inicio"], utc=True)
+    intervalos["fim"] = pd.to_datetime(intervalos["fim"], utc=True)
+    return intervalos
+
+def compute_utilizacao(intervalos: pd.DataFrame, de: datetime, ate: datetime, agora: datetime) -> pd.DataFrame:
+    """Dias de atribuição por (recurso, obra, mês) dentro de [de, ate)"""
+    colunas = ["intervalo", "recurso_id", "tipo_recurso", "obra_id", "mes", "dias", "aberto"]
+    if intervalos.empty:
+        return pd.DataFrame(columns=colunas)
+    
+    # Open intervals end at the earlier of 'ate' and now
+    inicio = intervalos["inicio"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    aberto = intervalos["fim"].isna().to_numpy()
+    fim = np.where(aberto, pd.Timestamp(min(agora, ate)).value,
+                   intervalos["fim"].to_numpy(dtype="datetime64[ns]").astype(np.int64))
+    
+    # Overlap of every interval with every month of the window, in one broadcast
+    edges = month_edges(de, ate)
+    edges_ns = edges.tz_convert("UTC").tz_localize(None).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    lo = np.maximum(edges_ns[:-1], pd.Timestamp(de).value)
+    hi = np.minimum(edges_ns[1:], pd.Timestamp(ate).value)
+    overlap = np.minimum(fim[:, None], hi[None, :]) - np.maximum(inicio[:, None], lo[None, :])
+    linha, mes = np.nonzero(overlap > 0)
+    
+    origem = intervalos.iloc[linha]
+    return pd.DataFrame({
+        "intervalo": linha,
+        "recurso_id": origem["recurso_id"].to_numpy(),
+        "tipo_recurso": origem["tipo_recurso"].to_numpy(),
+        "obra_id": origem["obra_id"].to_numpy(),
+        "mes": edges[:-1].strftime("%Y-%m").to_numpy()[mes],
+        "dias": overlap[linha, mes] / NS_POR_DIA,
+        "aberto": aberto[linha]
+    }, columns=colunas)
+
+def dias_por_tipo(df: pd.DataFrame, index: list) -> list:
+    """Soma os dias por index com colunas dias_equipamento e dias_viatura"""
+    if df.empty:
+        return []
+    tabela = df.pivot_table(index=index, columns="tipo_recurso", values="dias", aggfunc="sum", fill_value=0)
+    tabela = tabela.reindex(columns=["equipamento", "viatura"], fill_value=0).round(2).reset_index()
+    tabela = tabela.rename(columns={"equipamento": "dias_equipamento", "viatura": "dias_viatura"})
+    tabela.columns.name = None
+    return tabela.to_dict(orient="records")
+
+@api_router.get("/relatorios/utilizacao")
+async def get_relatorio_utilizacao(
+    de: Optional[str] = None,
+    ate: Optional[str] = None,
+    obra_id: Optional[str] = None,
+    tipo_recurso: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    """Dias-equipamento e dias-viatura por obra, por recurso e por mês (intervalos Saída→Devolução)"""
+    inicio_calculo = time.perf_counter()
+    agora = datetime.now(timezone.utc)
+    data_de = parse_data_param(de) if de else datetime(agora.year, 1, 1, tzinfo=timezone.utc)
+    data_ate = parse_data_param(ate, fim_do_dia=True) if ate else agora
+    if data_ate <= data_de:
+        raise HTTPException(status_code=400, detail="Intervalo de datas inválido")
+    
+    intervalos = await load_assignment_intervals(tipo_recurso, data_de, data_ate)
+    df = compute_utilizacao(intervalos, data_de, data_ate, agora)
+    if obra_id:
+        df = df[df["obra_id"] == obra_id]
+    
+    obras = await lookup_by_ids(db.obras, df["obra_id"].unique(), {"codigo": 1, "nome": 1})
+    equipamentos = await lookup_by_ids(db.equipamentos, df.loc[df["tipo_recurso"] == "equipamento", "recurso_id"].unique(),
+                                       {"codigo": 1, "descricao": 1})
+    viaturas = await lookup_by_ids(db.viaturas, df.loc[df["tipo_recurso"] == "viatura", "recurso_id"].unique(),
+                                   {"matricula": 1, "marca": 1, "modelo": 1})
+    
+    por_obra = dias_por_tipo(df, ["obra_id"])
+    for linha in por_obra:
+        obra = obras.get(linha["obra_id"], {})
+        linha["obra_codigo"] = obra.get("codigo", "")
+        linha["obra_nome"] = obra.get("nome", "")
+    
+    por_recurso = []
+    if not df.empty:
+        agrupado = df.groupby(["recurso_id", "tipo_recurso", "obra_id"], as_index=False)["dias"].sum().round(2)
+        for linha in agrupado.to_dict(orient="records"):
+            if linha["tipo_recurso"] == "equipamento":
+                recurso = equipamentos.get(linha["recurso_id"], {})
+                linha["recurso_codigo"] = recurso.get("codigo", "")
+                linha["recurso_descricao"] = recurso.get("descricao", "")
+            else:
+                recurso = viaturas.get(linha["recurso_id"], {})
+                linha["recurso_codigo"] = recurso.get("matricula", "")
+                linha["recurso_descricao"] = f"{recurso.get('marca', '')} {recurso.get('modelo', '')}".strip()
+            linha["obra_codigo"] = obras.get(linha["obra_id"], {}).get("codigo", "")
+            por_recurso.append(linha)
+    
+    return {
+        "periodo": {"de": data_de.isoformat(), "ate": data_ate.isoformat()},
+        "por_obra": por_obra,
+        "por_recurso": por_recurso,
+        "por_mes": dias_por_tipo(df, ["mes", "obra_id"]),
+        "estatisticas": {
+            "intervalos_lidos": len(intervalos),
+            "intervalos": int(df["intervalo"].nunique()),
+            "intervalos_abertos": int(df.loc[df["aberto"].astype(bool), "intervalo"].nunique()),
+            "dias_equipamento": round(float(df.loc[df["tipo_recurso"] == "equipamento", "dias"].sum()), 2),
+            "dias_viatura": round(float(df.loc[df["tipo_recurso"] == "viatura", "dias"].sum()), 2),
+            "segundos": round(time.perf_counter() - inicio_calculo, 3)
+        }
+    }
+
+# ==================== PREVISÃO DE CONSUMO ====================
+# Daily Saída totals of every material form one (day x material) matrix; rolling
+# statistics over its columns give all consumptions, variabilities and reorder
+# points in a single pass. Only complete UTC days are used.
+async def load_consumo_diario(desde: datetime, ate: datetime) -> pd.DataFrame:
+    """Quantidade saída por (material, dia) em [desde, ate), somada na base de dados"""
+    pipeline = [
+        {"$match": {"tipo_movimento": "Saida", "documento": {"$nin": ["RECONCILIACAO", "SALDO_INICIAL"]},
+                    "data_hora": {"$gte": db_ts(desde), "$lt": db_ts(ate)}}},
+        {"$group": {
+            "_id": {"material_id": "$material_id",
+                    "dia": {"$dateToString": {"format": "%Y-%m-%d", "date": "$data_hora", "timezone": "UTC"}}},
+            "quantidade": {"$sum": "$quantidade"}
+        }}
+    ]
+    colunas = {"material_id": [], "dia": [], "quantidade": []}
+    async for grupo in db.movimentos_stock.aggregate(pipeline, allowDiskUse=True):
+        colunas["material_id"].append(grupo["_id"]["material_id"])
+        colunas["dia"].append(grupo["_id"]["dia"])
+        colunas["quantidade"].append(grupo["quantidade"])
+    consumo = pd.DataFrame(colunas)
+    consumo["dia"] = pd.to_datetime(consumo["dia"], format="%Y-%m-%d")
+    return consumo
+
+def compute_previsao(consumo: pd.DataFrame, materiais: pd.DataFrame, dias: pd.DatetimeIndex,
+                     janela: int, prazo: float, z: float) -> pd.DataFrame:
+    """Estatísticas de consumo e ponto de encomenda de todos os materiais (colunas de materiais, linhas de dias)"""
+    matriz = (consumo.pivot_table(index="dia", columns="material_id", values="quantidade", aggfunc="sum")
+              if not consumo.empty else pd.DataFrame())
+    matriz = matriz.reindex(index=dias, columns=materiais["id"]).fillna(0.0)
+    
+    recentes = matriz.iloc[-janela:]
+    media = recentes.mean().to_numpy()
+    desvio = np.nan_to_num(recentes.std(ddof=1).to_numpy()) if len(recentes) > 1 else np.zeros(len(media))
+    stock = materiais["stock_atual"].to_numpy(dtype=float)
+    
+    com_consumo = media > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cobertura = np.where(com_consumo, np.maximum(stock, 0) / media, np.nan)
+        variacao = np.where(com_consumo, desvio / media, np.nan)
+    seguranca = z * desvio * np.sqrt(prazo)
+    ponto = media * prazo + seguranca
+    repor = com_consumo & (stock <= ponto)
+    
+    return pd.DataFrame({
+        "material_id": materiais["id"].to_numpy(),
+        "consumo_medio_diario": media,
+        "consumo_pico_diario": matriz.max().to_numpy(),
+        "desvio_diario": desvio,
+        "coeficiente_variacao": variacao,
+        "dias_com_saidas": (recentes > 0).sum().to_numpy(),
+        "dias_cobertura": cobertura,
+        "stock_seguranca": seguranca,
+        "ponto_encomenda": ponto,
+        "quantidade_sugerida": np.where(repor, np.maximum(ponto + media * janela - stock, 0), 0.0),
+        "repor": repor,
+        "rever_minimo": com_consumo & (ponto > materiais["stock_minimo"].to_numpy(dtype=float))
+    })
+
+async def atualizar_previsao_consumo() -> dict:
+    """Recalcula e guarda a previsão de consumo de todos os materiais"""
+    inicio_calculo = time.perf_counter()
+    agora = datetime.now(timezone.utc)
+    agora = agora.replace(microsecond=agora.microsecond // 1000 * 1000)  # BSON dates keep milliseconds
+    hoje = pd.Timestamp(agora).tz_localize(None).normalize()
+    dias = pd.date_range(end=hoje - pd.Timedelta(days=1), periods=FORECAST_HISTORY_DAYS, freq="D")
+    
+    consumo = await load_consumo_diario(dias[0].tz_localize("UTC").to_pydatetime(), hoje.tz_localize("UTC").to_pydatetime())
+    materiais = pd.DataFrame(await db.materiais.find(
+        {}, {"_id": 0, "id": 1, "codigo": 1, "descricao": 1, "unidade": 1, "stock_atual": 1, "stock_minimo": 1}
+    ).to_list(None), columns=["id", "codigo", "descricao", "unidade", "stock_atual", "stock_minimo"])
+    materiais[["stock_atual", "stock_minimo"]] = materiais[["stock_atual", "stock_minimo"]].fillna(0)
+    
+    previsao = compute_previsao(consumo, materiais, dias, FORECAST_WINDOW_DAYS, FORECAST_LEAD_TIME_DAYS, FORECAST_SERVICE_Z)
+    numericas = previsao.select_dtypes("float").columns
+    previsao[numericas] = previsao[numericas].round(3)
+    previsao = previsao.astype(object).where(previsao.notna(), None)
+    
+    ops = []
+    for material, linha in zip(materiais.to_dict(orient="records"), previsao.to_dict(orient="records")):
+        doc = {**linha, "codigo": material["codigo"], "descricao": material["descricao"],
+               "unidade": material["unidade"] or "un", "stock_atual": material["stock_atual"],
+               "stock_minimo": material["stock_minimo"], "calculado_em": agora}
+        ops.append(ReplaceOne({"material_id": doc["material_id"]}, doc, upsert=True))
+    if ops:
+        await db.previsoes_consumo.bulk_write(ops, ordered=False)
+    await db.previsoes_consumo.delete_many({"calculado_em": {"$ne": agora}})
+    
+    execucao = {
+        "materiais": len(ops),
+        "consumos_diarios": len(consumo),
+        "a_repor": int(previsao["repor"].sum()) if ops else 0,
+        "segundos": round(time.perf_counter() - inicio_calculo, 3)
+    }
+    logger.info(f"Consumption forecast for {execucao['materiais']} material(s) in {execucao['segundos']}s")
+    return execucao
+
+# ==================== ATRIBUIÇÕES ====================
+# One document per assignment interval: fim is None while the resource is still at
+# the obra. Maintained on every Saída/Devolução so point-in-time questions are a
+# single index lookup on (recurso_id, inicio, fim) or (obra_id, inicio).
+def inicio_movimento(mov: dict) -> datetime:
+    """Instante em que um movimento Saída/Devolução produz efeito"""
+    campo = "data_levantamento" if mov.get("tipo_movimento") == "Saida" else "data_devolucao"
+    return parse_ts(mov.get(campo)) or parse_ts(mov["created_at"])
+
+def atribuicao_ops(mov: dict) -> list:
+    """Fecha o intervalo em aberto do recurso e, numa Saída, abre o seguinte"""
+    instante = db_ts(inicio_movimento(mov))
+    # Never before the interval's start: a backdated event closes it with zero length
+    ops = [UpdateMany({"recurso_id": mov["recurso_id"], "fim": None}, [{"$set": {"fim": {"$max": ["$inicio", instante]}}}])]
+    if mov.get("tipo_movimento") == "Saida":
+        ops.append(InsertOne({
+            "id": str(uuid.uuid4()),
+            "recurso_id": mov["recurso_id"],
+            "tipo_recurso": mov["tipo_recurso"],
+            "obra_id": mov.get("obra_id"),
+            "inicio": instante,
+            "fim": None
+        }))
+    return ops
+
+async def update_atribuicoes(movimentos: list, session=None):
+    ops = [op for mov in movimentos for op in atribuicao_ops(mov)]
+    if ops:
+        await db.atribuicoes.bulk_write(ops, ordered=True, session=session)
+
+def atribuicao_em(instante: datetime) -> dict:
+    """Filtro dos intervalos que contêm o instante"""
+    ts = db_ts(instante)
+    return {"inicio": {"$lte": ts}, "$or": [{"fim": None}, {"fim": {"$gt": ts}}]}
+
+async def rebuild_atribuicoes() -> int:
+    """Recalcula os intervalos de atribuição a partir do histórico de movimentos"""
+    agora = datetime.now(timezone.utc)
+    eventos = await load_assignment_events(None, agora + timedelta(days=1))
+    docs = []
+    if not eventos.empty:
+        recurso, _ = pd.factorize(eventos["recurso_id"])
+        tempo = eventos["data"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        saida = (eventos["tipo_movimento"] == "Saida").to_numpy()
+        idx, inicio, fim, aberto = assignment_intervals(recurso, tempo, saida, 0)
+        origem = eventos.iloc[idx]
+        for linha, ini, fi, em_aberto in zip(origem.itertuples(index=False), inicio, fim, aberto):
+            docs.append({
+                "id": str(uuid.uuid4()),
+                "recurso_id": linha.recurso_id,
+                "tipo_recurso": linha.tipo_recurso,
+                "obra_id": linha.obra_id,
+                "inicio": db_ts(pd.Timestamp(int(ini), tz="UTC").to_pydatetime()),
+                "fim": None if em_aberto else db_ts(pd.Timestamp(int(fi), tz="UTC").to_pydatetime())
+            })
+    if not docs:
+        await db.atribuicoes.delete_many({})
+        return 0
+    # Same build-aside-and-swap as the rollups
+    rebuild = db.atribuicoes_rebuild
+    await rebuild.drop()
+    await rebuild.insert_many(docs)
+    for name, keys, options in COMPOUND_INDEXES:
+        if name == "atribuicoes":
+            await rebuild.create_index(keys, **options)
+    await rebuild.create_index("id", unique=True, name="id_unique")
+    await rebuild.rename("atribuicoes", dropTarget=True)
+    return len(docs)
+
+@api_router.get("/recursos/{recurso_id}/localizacao")
+async def get_localizacao_recurso(recurso_id: str, data: Optional[str] = None, user=Depends(get_current_user)):
+    """Obra onde estava um equipamento/viatura num dado instante (por omissão, agora)"""
+    instante = parse_data_param(data) if data else datetime.now(timezone.utc)
+    atribuicao = await db.atribuicoes.find_one(
+        {"recurso_id": recurso_id, **atribuicao_em(instante)}, {"_id": 0}, sort=[("inicio", -1)]
+    )
+    if not atribuicao and not (
+            await db.equipamentos.count_documents({"id": recurso_id}, limit=1)
+            or await db.viaturas.count_documents({"id": recurso_id}, limit=1)
+            or await db.atribuicoes.count_documents({"recurso_id": recurso_id}, limit=1)):
+        raise HTTPException(status_code=404, detail="Recurso não encontrado")
+    
+    obra = None
+    if atribuicao and atribuicao.get("obra_id"):
+        obra = await db.obras.find_one({"id": atribuicao["obra_id"]}, {"_id": 0, "id": 1, "codigo": 1, "nome": 1})
+    return {"recurso_id": recurso_id, "data": instante.isoformat(), "atribuicao": atribuicao, "obra": obra}
+
+@api_router.get("/obras/{obra_id}/recursos")
+async def get_recursos_obra_em(obra_id: str, data: Optional[str] = None, user=Depends(get_current_user)):
+    """Equipamentos e viaturas atribuídos a uma obra num dado instante (por omissão, agora)"""
+    instante = parse_data_param(data) if data else datetime.now(timezone.utc)
+    atribuicoes = await db.atribuicoes.find({"obra_id": obra_id, **atribuicao_em(instante)}, {"_id": 0}).to_list(None)
     
-    # Date filtering
+    equipamentos = await lookup_by_ids(db.equipamentos, [a["recurso_id"] for a in atribuicoes if a["tipo_recurso"] == "equipamento"],
+                                       {"codigo": 1, "descricao": 1})
+    viaturas = await lookup_by_ids(db.viaturas, [a["recurso_id"] for a in atribuicoes if a["tipo_recurso"] == "viatura"],
+                                   {"matricula": 1, "marca": 1, "modelo": 1})
+    resultado = {"obra_id": obra_id, "data": instante.isoformat(), "equipamentos": [], "viaturas": []}
+    for atribuicao in atribuicoes:
+        if atribuicao["tipo_recurso"] == "equipamento":
+            recurso = equipamentos.get(atribuicao["recurso_id"], {})
+            resultado["equipamentos"].append({**atribuicao, "codigo": recurso.get("codigo", ""),
+                                              "descricao": recurso.get("descricao", "")})
+        else:
+            recurso = viaturas.get(atribuicao["recurso_id"], {})
+            resultado["viaturas"].append({**atribuicao, "matricula": recurso.get("matricula", ""),
+                                          "marca": recurso.get("marca", ""), "modelo": recurso.get("modelo", "")})
+    return resultado
+
+# ==================== RELATÓRIOS AVANÇADOS ====================
+def material_eliminado(mov: dict) -> Optional[dict]:
+    """Identificação do material guardada no movimento quando o material foi eliminado"""
+    if not mov.get("material_eliminado"):
+        return None
+    return {"codigo": mov.get("material_codigo", ""), "descricao": mov.get("material_descricao", ""),
+            "unidade": mov.get("material_unidade", "un")}
+
+def periodo_range(mes: Optional[int], ano: Optional[int]):
+    """Intervalo [início, fim) do filtro mes/ano, ou None sem filtro"""
     if mes and ano:
         start_date = datetime(ano, mes, 1, tzinfo=timezone.utc)
         if mes == 12:
             end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
         else:
             end_date = datetime(ano, mes + 1, 1, tzinfo=timezone.utc)
-        query["created_at"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
+        return start_date, end_date
     elif ano:
-        start_date = datetime(ano, 1, 1, tzinfo=timezone.utc)
-        end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
-        query["created_at"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-    
-    movimentos = await db.movimentos.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        return datetime(ano, 1, 1, tzinfo=timezone.utc), datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
+    return None
+
+def periodo_query(mes: Optional[int], ano: Optional[int]):
+    """Filtro sobre um campo de data dos movimentos"""
+    intervalo = periodo_range(mes, ano)
+    if not intervalo:
+        return None
+    return {"$gte": db_ts(intervalo[0]), "$lt": db_ts(intervalo[1])}
+
+async def lookup_by_ids(collection, ids, projection: dict) -> dict:
+    """Carrega vários documentos numa só query, indexados por id"""
+    ids = list({i for i in ids if i})
+    if not ids:
+        return {}
+    docs = await collection.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, **projection}).to_list(None)
+    return {d["id"]: d for d in docs}
+
+@api_router.get("/relatorios/movimentos")
+async def get_relatorio_movimentos(
+    obra_id: Optional[str] = None,
+    mes: Optional[int] = None,
+    ano: Optional[int] = None,
+    tipo_recurso: Optional[str] = None,
+    detalhe: bool = True,
+    user=Depends(get_current_user)
+):
+    """Relatório de movimentos de equipamentos e viaturas filtrado por obra e período"""
+    # Statistics come from the monthly rollups; the raw list is only read when detalhe=true
+    stats = await rollup_totais_ativos(obra_id, mes, ano, tipo_recurso)
     
-    # Enrich with resource and obra details
     enriched = []
-    for mov in movimentos:
-        item = {**mov}
+    if detalhe:
+        query = {}
+        if obra_id:
+            query["obra_id"] = obra_id
+        if tipo_recurso:
+            query["tipo_recurso"] = tipo_recurso
+        created_at = periodo_query(mes, ano)
+        if created_at:
+            query["created_at"] = created_at
         
-        # Get resource details
-        if mov.get("tipo_recurso") == "equipamento":
-            recurso = await db.equipamentos.find_one({"id": mov["recurso_id"]}, {"_id": 0, "codigo": 1, "descricao": 1})
-            if recurso:
-                item["recurso_codigo"] = recurso.get("codigo", "")
-                item["recurso_descricao"] = recurso.get("descricao", "")
-        elif mov.get("tipo_recurso") == "viatura":
-            recurso = await db.viaturas.find_one({"id": mov["recurso_id"]}, {"_id": 0, "matricula": 1, "marca": 1, "modelo": 1})
-            if recurso:
-                item["recurso_codigo"] = recurso.get("matricula", "")
-                item["recurso_descricao"] = f"{recurso.get('marca', '')} {recurso.get('modelo', '')}"
+        movimentos = await db.movimentos.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
         
-        # Get obra details
-        if mov.get("obra_id"):
-            obra = await db.obras.find_one({"id": mov["obra_id"]}, {"_id": 0, "codigo": 1, "nome": 1})
+        # Enrich with resource and obra details, one query per collection
+        equipamentos = await lookup_by_ids(db.equipamentos, [m["recurso_id"] for m in movimentos if m.get("tipo_recurso") == "equipamento"],
+                                           {"codigo": 1, "descricao": 1})
+        viaturas = await lookup_by_ids(db.viaturas, [m["recurso_id"] for m in movimentos if m.get("tipo_recurso") == "viatura"],
+                                       {"matricula": 1, "marca": 1, "modelo": 1})
+        obras = await lookup_by_ids(db.obras, [m.get("obra_id") for m in movimentos], {"codigo": 1, "nome": 1})
+        
+        for mov in movimentos:
+            item = {**mov}
+            if mov.get("tipo_recurso") == "equipamento":
+                recurso = equipamentos.get(mov["recurso_id"])
+                if recurso:
+                    item["recurso_codigo"] = recurso.get("codigo", "")
+                    item["recurso_descricao"] = recurso.get("descricao", "")
+            elif mov.get("tipo_recurso") == "viatura":
+                recurso = viaturas.get(mov["recurso_id"])
+                if recurso:
+                    item["recurso_codigo"] = recurso.get("matricula", "")
+                    item["recurso_descricao"] = f"{recurso.get('marca', '')} {recurso.get('modelo', '')}"
+            
+            obra = obras.get(mov.get("obra_id"))
             if obra:
                 item["obra_codigo"] = obra.get("codigo", "")
                 item["obra_nome"] = obra.get("nome", "")
-        
-        enriched.append(item)
-    
-    # Statistics
-    total_saidas = len([m for m in movimentos if m.get("tipo_movimento") == "Saida"])
-    total_devolucoes = len([m for m in movimentos if m.get("tipo_movimento") == "Devolucao"])
-    equipamentos_movidos = len(set([m["recurso_id"] for m in movimentos if m.get("tipo_recurso") == "equipamento"]))
-    viaturas_movidas = len(set([m["recurso_id"] for m in movimentos if m.get("tipo_recurso") == "viatura"]))
+            
+            enriched.append(item)
     
     return {
         "movimentos": enriched,
         "estatisticas": {
-            "total_movimentos": len(movimentos),
-            "total_saidas": total_saidas,
-            "total_devolucoes": total_devolucoes,
-            "equipamentos_movidos": equipamentos_movidos,
-            "viaturas_movidas": viaturas_movidas
+            "total_movimentos": stats["saidas"] + stats["devolucoes"],
+            "total_saidas": stats["saidas"],
+            "total_devolucoes": stats["devolucoes"],
+            "equipamentos_movidos": stats["equipamentos_movidos"],
+            "viaturas_movidas": stats["viaturas_movidas"]
         }
     }
 
@@ -1053,75 +4161,64 @@ async def get_relatorio_stock(
     obra_id: Optional[str] = None,
     mes: Optional[int] = None,
     ano: Optional[int] = None,
+    detalhe: bool = True,
     user=Depends(get_current_user)
 ):
     """Relatório de movimentos de stock (materiais) filtrado por obra e período"""
-    query = {}
-    
-    if obra_id:
-        query["obra_id"] = obra_id
-    
-    if mes and ano:
-        start_date = datetime(ano, mes, 1, tzinfo=timezone.utc)
-        if mes == 12:
-            end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
-        else:
-            end_date = datetime(ano, mes + 1, 1, tzinfo=timezone.utc)
-        query["data_hora"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-    elif ano:
-        start_date = datetime(ano, 1, 1, tzinfo=timezone.utc)
-        end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
-        query["data_hora"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-    
-    movimentos = await db.movimentos_stock.find(query, {"_id": 0}).sort("data_hora", -1).to_list(1000)
+    por_material = await rollup_totais_stock(obra_id, mes, ano)
     
-    # Enrich with material and obra details
     enriched = []
-    materiais_gastos = {}
+    movimentos = []
+    if detalhe:
+        query = {}
+        if obra_id:
+            query["obra_id"] = obra_id
+        data_hora = periodo_query(mes, ano)
+        if data_hora:
+            query["data_hora"] = data_hora
+        movimentos = await db.movimentos_stock.find(query, {"_id": 0}).sort("data_hora", -1).to_list(1000)
+    
+    materiais = await lookup_by_ids(db.materiais, list(por_material) + [m["material_id"] for m in movimentos],
+                                    {"codigo": 1, "descricao": 1, "unidade": 1})
+    obras = await lookup_by_ids(db.obras, [m.get("obra_id") for m in movimentos], {"codigo": 1, "nome": 1})
     
     for mov in movimentos:
         item = {**mov}
-        
-        # Get material details
-        material = await db.materiais.find_one({"id": mov["material_id"]}, {"_id": 0, "codigo": 1, "descricao": 1, "unidade": 1})
+        material = materiais.get(mov["material_id"]) or material_eliminado(mov)
         if material:
             item["material_codigo"] = material.get("codigo", "")
             item["material_descricao"] = material.get("descricao", "")
             item["material_unidade"] = material.get("unidade", "un")
-            
-            # Track consumption by material
-            mat_id = mov["material_id"]
-            if mat_id not in materiais_gastos:
-                materiais_gastos[mat_id] = {
-                    "codigo": material.get("codigo", ""),
-                    "descricao": material.get("descricao", ""),
-                    "unidade": material.get("unidade", "un"),
-                    "entradas": 0,
-                    "saidas": 0
-                }
-            if mov.get("tipo_movimento") == "Entrada":
-                materiais_gastos[mat_id]["entradas"] += mov.get("quantidade", 0)
-            else:
-                materiais_gastos[mat_id]["saidas"] += mov.get("quantidade", 0)
         
-        # Get obra details
-        if mov.get("obra_id"):
-            obra = await db.obras.find_one({"id": mov["obra_id"]}, {"_id": 0, "codigo": 1, "nome": 1})
-            if obra:
-                item["obra_codigo"] = obra.get("codigo", "")
-                item["obra_nome"] = obra.get("nome", "")
+        obra = obras.get(mov.get("obra_id"))
+        if obra:
+            item["obra_codigo"] = obra.get("codigo", "")
+            item["obra_nome"] = obra.get("nome", "")
         
         enriched.append(item)
     
-    # Statistics
-    total_entradas = sum(m.get("quantidade", 0) for m in movimentos if m.get("tipo_movimento") == "Entrada")
-    total_saidas = sum(m.get("quantidade", 0) for m in movimentos if m.get("tipo_movimento") == "Saida")
+    # Consumption by material
+    materiais_gastos = []
+    for mat_id, totais in por_material.items():
+        material = materiais.get(mat_id)
+        if not material:
+            continue
+        materiais_gastos.append({
+            "codigo": material.get("codigo", ""),
+            "descricao": material.get("descricao", ""),
+            "unidade": material.get("unidade", "un"),
+            "entradas": totais["entradas"],
+            "saidas": totais["saidas"]
+        })
+    
+    total_entradas = sum(t["entradas"] for t in por_material.values())
+    total_saidas = sum(t["saidas"] for t in por_material.values())
     
     return {
         "movimentos": enriched,
-        "materiais_resumo": list(materiais_gastos.values()),
+        "materiais_resumo": materiais_gastos,
         "estatisticas": {
-            "total_movimentos": len(movimentos),
+            "total_movimentos": sum(t["n_entradas"] + t["n_saidas"] for t in por_material.values()),
             "total_entradas": total_entradas,
             "total_saidas": total_saidas,
             "consumo_liquido": total_saidas - total_entradas,
@@ -1129,6 +4226,164 @@ async def get_relatorio_stock(
         }
     }
 
+async def consumo_por_obra_material(de: datetime, ate: datetime) -> pd.DataFrame:
+    """Quantidade saída para obras por (obra, material) em [de, ate), num único $group"""
+    pipeline = [
+        {"$match": {"tipo_movimento": "Saida", "obra_id": {"$ne": None},
+                    "data_hora": {"$gte": db_ts(de), "$lt": db_ts(ate)}}},
+        {"$group": {
+            "_id": {"obra_id": "$obra_id", "material_id": "$material_id"},
+            "quantidade": {"$sum": "$quantidade"},
+            # Identification of deleted materials, kept on their movements
+            "material_codigo": {"$first": "$material_codigo"},
+            "material_descricao": {"$first": "$material_descricao"},
+            "material_unidade": {"$first": "$material_unidade"}
+        }}
+    ]
+    linhas = [{**grupo["_id"], **{k: v for k, v in grupo.items() if k != "_id"}}
+              async for grupo in db.movimentos_stock.aggregate(pipeline, allowDiskUse=True)]
+    return pd.DataFrame(linhas, columns=["obra_id", "material_id", "quantidade",
+                                         "material_codigo", "material_descricao", "material_unidade"])
+
+def matriz_consumo_xlsx(periodo: dict, obras: list, materiais: list, totais_obra: list, total: float):
+    """Livro em modo write_only (linhas escritas sem manter células) num ficheiro temporário que
+    só passa da memória para o disco acima de XLSX_SPOOL_MAX bytes"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Consumo por obra")
+    ws.append([f"Consumo de materiais por obra de {periodo['de'][:10]} a {periodo['ate'][:10]}"])
+    ws.append(["Código", "Descrição", "Unidade"] + [o["codigo"] or o["id"] for o in obras] + ["Total"])
+    for m in materiais:
+        ws.append([m["codigo"], m["descricao"], m["unidade"]] + m["quantidades"] + [m["total"]])
+    ws.append(["Total", "", ""] + totais_obra + [total])
+    ficheiro = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_MAX)
+    wb.save(ficheiro)
+    ficheiro.seek(0)
+    return ficheiro
+
+def ler_e_fechar(ficheiro, bloco: int = 64 * 1024):
+    """Blocos do ficheiro para uma StreamingResponse; fecha-o no fim ou se o cliente desistir"""
+    try:
+        while dados := ficheiro.read(bloco):
+            yield dados
+    finally:
+        ficheiro.close()
+
+@api_router.get("/relatorios/consumo-matriz")
+async def get_relatorio_consumo_matriz(
+    de: Optional[str] = None,
+    ate: Optional[str] = None,
+    formato: str = "json",
+    user=Depends(get_current_user)
+):
+    """Matriz materiais x obras das quantidades saídas no período (JSON ou XLSX)"""
+    if formato not in ("json", "xlsx"):
+        raise HTTPException(status_code=400, detail="Formato inválido (json ou xlsx)")
+    agora = datetime.now(timezone.utc)
+    data_de = parse_data_param(de) if de else datetime(agora.year, 1, 1, tzinfo=timezone.utc)
+    data_ate = parse_data_param(ate, fim_do_dia=True) if ate else agora
+    if data_ate <= data_de:
+        raise HTTPException(status_code=400, detail="Intervalo de datas inválido")
+    
+    df = await consumo_por_obra_material(data_de, data_ate)
+    matriz = (df.pivot_table(index="material_id", columns="obra_id", values="quantidade", aggfunc="sum", fill_value=0)
+              if not df.empty else pd.DataFrame())
+    
+    obras_info = await lookup_by_ids(db.obras, matriz.columns, {"codigo": 1, "nome": 1})
+    materiais_info = await lookup_by_ids(db.materiais, matriz.index, {"codigo": 1, "descricao": 1, "unidade": 1})
+    eliminados = df.drop_duplicates("material_id").set_index("material_id")
+    
+    def material(mat_id: str) -> dict:
+        info = materiais_info.get(mat_id)
+        if info is None:
+            antigo = eliminados.loc[mat_id]
+            info = {"codigo": antigo["material_codigo"] or "", "descricao": antigo["material_descricao"] or "",
+                    "unidade": antigo["material_unidade"] or "un", "eliminado": True}
+        return {"id": mat_id, "codigo": info.get("codigo", ""), "descricao": info.get("descricao", ""),
+                "unidade": info.get("unidade", "un"), **({"eliminado": True} if info.get("eliminado") else {})}
+    
+    obras = sorted(({"id": obra_id, "codigo": obras_info.get(obra_id, {}).get("codigo", ""),
+                     "nome": obras_info.get(obra_id, {}).get("nome", "")} for obra_id in matriz.columns),
+                   key=lambda o: (o["codigo"], o["id"]))
+    linhas = sorted((material(mat_id) for mat_id in matriz.index), key=lambda m: (m["codigo"], m["id"]))
+    if linhas:
+        matriz = matriz.reindex(index=[m["id"] for m in linhas], columns=[o["id"] for o in obras]).round(3)
+    
+    materiais = [{**m, "quantidades": valores, "total": round(sum(valores), 3)}
+                 for m, valores in zip(linhas, matriz.to_numpy().tolist())]
+    totais_obra = matriz.sum(axis=0).round(3).tolist() if linhas else []
+    total = round(float(sum(totais_obra)), 3)
+    periodo = {"de": data_de.isoformat(), "ate": data_ate.isoformat()}
+    
+    if formato == "xlsx":
+        ficheiro = matriz_consumo_xlsx(periodo, obras, materiais, totais_obra, total)
+        return StreamingResponse(
+            ler_e_fechar(ficheiro),
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f"attachment; filename=consumo_obras_{data_de:%Y%m%d}_{data_ate:%Y%m%d}.xlsx"}
+        )
+    return {"periodo": periodo, "obras": obras, "materiais": materiais, "totais_obra": totais_obra, "total": total}
+
+async def km_por_viatura_obra_mes(query: dict) -> list:
+    """Km percorridos por (viatura, obra, mês) num único $group sobre movimentos_viaturas"""
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": {"viatura_id": "$viatura_id", "obra_id": "$obra_id", "mes": periodo_expr("created_at")},
+            "km": {"$sum": KM_PERCORRIDOS},
+            "registos": {"$sum": 1},
+            "lacunas_km": {"$sum": {"$ifNull": ["$lacuna_km", 0]}}
+        }},
+        {"$sort": {"_id.mes": 1, "_id.viatura_id": 1, "_id.obra_id": 1}}
+    ]
+    return [{**grupo["_id"], "km": round(grupo["km"], 1), "registos": grupo["registos"],
+             "lacunas_km": round(grupo["lacunas_km"], 1)}
+            async for grupo in db.movimentos_viaturas.aggregate(pipeline, allowDiskUse=True)]
+
+@api_router.get("/relatorios/km")
+async def get_relatorio_km(
+    de: Optional[str] = None,
+    ate: Optional[str] = None,
+    obra_id: Optional[str] = None,
+    viatura_id: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    """Km por viatura, por obra e por mês, para imputação de custos da frota"""
+    agora = datetime.now(timezone.utc)
+    data_de = parse_data_param(de) if de else datetime(agora.year, 1, 1, tzinfo=timezone.utc)
+    data_ate = parse_data_param(ate, fim_do_dia=True) if ate else agora
+    if data_ate <= data_de:
+        raise HTTPException(status_code=400, detail="Intervalo de datas inválido")
+    
+    query = {"created_at": {"$gte": db_ts(data_de), "$lt": db_ts(data_ate)}}
+    if obra_id:
+        query["obra_id"] = obra_id
+    if viatura_id:
+        query["viatura_id"] = viatura_id
+    linhas = await km_por_viatura_obra_mes(query)
+    
+    viaturas = await lookup_by_ids(db.viaturas, [l["viatura_id"] for l in linhas], {"matricula": 1, "marca": 1, "modelo": 1})
+    obras = await lookup_by_ids(db.obras, [l["obra_id"] for l in linhas], {"codigo": 1, "nome": 1})
+    por_viatura, por_obra = {}, {}
+    for linha in linhas:
+        viatura = viaturas.get(linha["viatura_id"], {})
+        obra = obras.get(linha["obra_id"], {})
+        linha["matricula"] = viatura.get("matricula", "")
+        linha["obra_codigo"] = obra.get("codigo", "")
+        linha["obra_nome"] = obra.get("nome", "")
+        total = por_viatura.setdefault(linha["viatura_id"], {"viatura_id": linha["viatura_id"], "matricula": linha["matricula"], "km": 0})
+        total["km"] = round(total["km"] + linha["km"], 1)
+        total = por_obra.setdefault(linha["obra_id"], {"obra_id": linha["obra_id"], "obra_codigo": linha["obra_codigo"],
+                                                       "obra_nome": linha["obra_nome"], "km": 0})
+        total["km"] = round(total["km"] + linha["km"], 1)
+    
+    return {
+        "periodo": {"de": data_de.isoformat(), "ate": data_ate.isoformat()},
+        "linhas": linhas,
+        "por_viatura": sorted(por_viatura.values(), key=lambda t: -t["km"]),
+        "por_obra": sorted(por_obra.values(), key=lambda t: -t["km"]),
+        "total_km": round(sum(l["km"] for l in linhas), 1)
+    }
+
 @api_router.get("/relatorios/obra/{obra_id}")
 async def get_relatorio_obra(
     obra_id: str,
@@ -1140,47 +4395,37 @@ async def get_relatorio_obra(
     obra = await db.obras.find_one({"id": obra_id}, {"_id": 0})
     if not obra:
         raise HTTPException(status_code=404, detail="Obra não encontrada")
+    if not mes and not ano:
+        # Closed obras answer from their frozen final report
+        snapshot = await relatorio_final_em_vigor(obra)
+        if snapshot:
+            return {**snapshot["relatorio"], "relatorio_final": {"id": snapshot["id"], "encerrada_em": snapshot["encerrada_em"]}}
+    
+    return await build_relatorio_obra(obra, mes, ano)
+
+async def build_relatorio_obra(obra: dict, mes: Optional[int] = None, ano: Optional[int] = None, session=None):
+    obra_id = obra["id"]
     
     # Get resources currently assigned
-    equipamentos_atuais = await db.equipamentos.find({"obra_id": obra_id}, {"_id": 0}).to_list(100)
-    viaturas_atuais = await db.viaturas.find({"obra_id": obra_id}, {"_id": 0}).to_list(100)
+    equipamentos_atuais = await db.equipamentos.find({"obra_id": obra_id}, {"_id": 0}, session=session).to_list(100)
+    viaturas_atuais = await db.viaturas.find({"obra_id": obra_id}, {"_id": 0}, session=session).to_list(100)
     
-    # Get movement history for this obra
-    mov_query = {"obra_id": obra_id}
-    stock_query = {"obra_id": obra_id}
+    ativos = await rollup_totais_ativos(obra_id, mes, ano, session=session)
+    por_material = await rollup_totais_stock(obra_id, mes, ano, session=session)
     
-    if mes and ano:
-        start_date = datetime(ano, mes, 1, tzinfo=timezone.utc)
-        if mes == 12:
-            end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
-        else:
-            end_date = datetime(ano, mes + 1, 1, tzinfo=timezone.utc)
-        mov_query["created_at"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-        stock_query["data_hora"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-    elif ano:
-        start_date = datetime(ano, 1, 1, tzinfo=timezone.utc)
-        end_date = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
-        mov_query["created_at"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-        stock_query["data_hora"] = {"$gte": start_date.isoformat(), "$lt": end_date.isoformat()}
-    
-    movimentos_ativos = await db.movimentos.find(mov_query, {"_id": 0}).sort("created_at", -1).to_list(500)
-    movimentos_stock = await db.movimentos_stock.find(stock_query, {"_id": 0}).sort("data_hora", -1).to_list(500)
-    
-    # Calculate stock consumption by material
-    consumo_materiais = {}
-    for mov in movimentos_stock:
-        mat_id = mov["material_id"]
-        material = await db.materiais.find_one({"id": mat_id}, {"_id": 0, "codigo": 1, "descricao": 1, "unidade": 1})
-        if material:
-            if mat_id not in consumo_materiais:
-                consumo_materiais[mat_id] = {
-                    "codigo": material.get("codigo", ""),
-                    "descricao": material.get("descricao", ""),
-                    "unidade": material.get("unidade", "un"),
-                    "quantidade_gasta": 0
-                }
-            if mov.get("tipo_movimento") == "Saida":
-                consumo_materiais[mat_id]["quantidade_gasta"] += mov.get("quantidade", 0)
+    # Stock consumption by material
+    materiais = await lookup_by_ids(db.materiais, list(por_material), {"codigo": 1, "descricao": 1, "unidade": 1})
+    consumo_materiais = []
+    for mat_id, totais in por_material.items():
+        material = materiais.get(mat_id)
+        if not material:
+            continue
+        consumo_materiais.append({
+            "codigo": material.get("codigo", ""),
+            "descricao": material.get("descricao", ""),
+            "unidade": material.get("unidade", "un"),
+            "quantidade_gasta": totais["saidas"]
+        })
     
     return {
         "obra": obra,
@@ -1195,18 +4440,107 @@ async def get_relatorio_obra(
         "estatisticas": {
             "equipamentos_atuais": len(equipamentos_atuais),
             "viaturas_atuais": len(viaturas_atuais),
-            "movimentos_ativos": len(movimentos_ativos),
-            "movimentos_stock": len(movimentos_stock),
-            "total_saidas_ativos": len([m for m in movimentos_ativos if m.get("tipo_movimento") == "Saida"]),
-            "total_devolucoes": len([m for m in movimentos_ativos if m.get("tipo_movimento") == "Devolucao"])
+            "movimentos_ativos": ativos["saidas"] + ativos["devolucoes"],
+            "movimentos_stock": sum(t["n_entradas"] + t["n_saidas"] for t in por_material.values()),
+            "total_saidas_ativos": ativos["saidas"],
+            "total_devolucoes": ativos["devolucoes"]
         },
-        "consumo_materiais": list(consumo_materiais.values())
+        "consumo_materiais": consumo_materiais
     }
 
 @api_router.get("/")
 async def root():
     return {"message": "José Firmino - API de Gestão de Armazém"}
 
+# ==================== IDEMPOTENCY ====================
+# A POST with an Idempotency-Key header runs once per (user, path, key): the first
+# request claims the key through the unique _id, retries replay the stored response.
+IDEMPOTENCY_LOCK_SECONDS = 60  # a claim older than this belongs to a request that died
+# Only writes a client may retry; their responses are small and hold no credentials, so they
+# can be buffered and stored. Auth responses (tokens) are never stored.
+IDEMPOTENCY_PATHS = {
+    "/api/equipamentos", "/api/viaturas", "/api/materiais", "/api/obras", "/api/reservas", "/api/alerts/regras",
+    "/api/movimentos/stock", "/api/movimentos/atribuir", "/api/movimentos/devolver",
+    "/api/movimentos/viaturas", "/api/movimentos/lote",
+}
+# Streamed uploads can't be fingerprinted without buffering them; their rows are deduplicated
+# by natural key instead, so a key there is rejected rather than silently trusted
+IDEMPOTENCY_REJECTED_PATHS = {"/api/movimentos/viaturas/ingest"}
+
+def idempotency_scope(request: Request, key: str) -> str:
+    auth = request.headers.get("authorization", "")
+    try:
+        utilizador = jwt.decode(auth.split(" ", 1)[-1], JWT_SECRET, algorithms=[JWT_ALGORITHM])["sub"]
+    except (jwt.InvalidTokenError, KeyError):
+        utilizador = hashlib.sha256(auth.encode()).hexdigest()
+    return hashlib.sha256(f"{utilizador}\n{request.url.path}\n{key}".encode()).hexdigest()
+
+def replay(registo: dict) -> Response:
+    return Response(content=registo["corpo"], status_code=registo["status"], media_type=registo["content_type"],
+                    headers={"Idempotent-Replayed": "true"})
+
+async def claim_idempotency_key(chave: str, impressao: str) -> Optional[Response]:
+    """Reserva a chave; devolve a resposta a repetir se outro pedido já a usou"""
+    limite = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        agora = datetime.now(timezone.utc)
+        try:
+            await db.idempotency.insert_one({"_id": chave, "impressao": impressao, "estado": "em_curso", "criado_em": agora})
+            return None
+        except DuplicateKeyError:
+            registo = await db.idempotency.find_one({"_id": chave})
+        if registo is None:
+            continue  # expired between the insert and the read
+        if registo["impressao"] != impressao:
+            return Response(content=json.dumps({"detail": "Idempotency-Key já usada com um pedido diferente"}),
+                            status_code=422, media_type="application/json")
+        if registo["estado"] == "concluido":
+            return replay(registo)
+        if parse_ts(registo["criado_em"]) < agora - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS):
+            tomada = await db.idempotency.update_one({"_id": chave, "estado": "em_curso", "criado_em": registo["criado_em"]},
+                                                     {"$set": {"criado_em": agora}})
+            if tomada.modified_count:
+                return None
+        if time.monotonic() > limite:
+            return Response(content=json.dumps({"detail": "Pedido com a mesma Idempotency-Key ainda em processamento"}),
+                            status_code=409, media_type="application/json")
+        await asyncio.sleep(0.1)
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get("idempotency-key")
+    if request.method != "POST" or not key:
+        return await call_next(request)
+    if request.url.path in IDEMPOTENCY_REJECTED_PATHS:
+        return Response(content=json.dumps({"detail": "Idempotency-Key não é suportado neste endpoint: "
+                                                      "as viagens repetidas já são ignoradas"}),
+                        status_code=400, media_type="application/json")
+    if request.url.path not in IDEMPOTENCY_PATHS:
+        return await call_next(request)
+    
+    chave = idempotency_scope(request, key)
+    impressao = hashlib.sha256(await request.body()).hexdigest()
+    repetida = await claim_idempotency_key(chave, impressao)
+    if repetida is not None:
+        return repetida
+    
+    try:
+        response = await call_next(request)
+        corpo = b"".join([parte async for parte in response.body_iterator])
+    except BaseException:
+        await db.idempotency.delete_one({"_id": chave})
+        raise
+    if response.status_code >= 500:
+        # Server errors are not a result: let the retry run the handler again
+        await db.idempotency.delete_one({"_id": chave})
+    else:
+        await db.idempotency.update_one({"_id": chave}, {"$set": {
+            "estado": "concluido", "status": response.status_code,
+            "content_type": response.headers.get("content-type"), "corpo": corpo
+        }})
+    headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+    return Response(content=corpo, status_code=response.status_code, headers=headers)
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -1215,8 +4549,42 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Idempotent-Replayed"],
 )
 
+background_tasks = []
+
+async def run_every(nome: str, segundos: float, job):
+    while True:
+        await asyncio.sleep(segundos)
+        try:
+            await job()
+        except Exception:
+            logger.exception(f"Background job '{nome}' failed")
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    await run_migrations()
+    logger.info(f"Loaded {await reservas_index.carregar()} active reservation(s)")
+    logger.info(f"Scheduled {await agenda_alertas.carregar()} alert(s)")
+    if EVENTS_SOURCE == "changestream":
+        background_tasks.append(asyncio.create_task(change_stream_loop()))
+    background_tasks.append(asyncio.create_task(stock_snapshot_loop()))
+    background_tasks.append(asyncio.create_task(outbox_loop()))
+    if ALERT_DIGEST_HOUR >= 0:
+        background_tasks.append(asyncio.create_task(alert_digest_loop()))
+    if FORECAST_INTERVAL_HOURS > 0:
+        background_tasks.append(asyncio.create_task(run_every(
+            "consumption forecast", FORECAST_INTERVAL_HOURS * 3600, atualizar_previsao_consumo)))
+    if STOCK_RECONCILE_INTERVAL_HOURS > 0:
+        background_tasks.append(asyncio.create_task(run_every(
+            "stock reconciliation", STOCK_RECONCILE_INTERVAL_HOURS * 3600,
+            lambda: run_stock_reconciliation(STOCK_RECONCILE_AUTOFIX, "agendada")
+        )))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
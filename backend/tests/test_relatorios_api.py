@@ -5,6 +5,7 @@ Tests: /api/relatorios/movimentos, /api/relatorios/stock, /api/relatorios/obra/{
 import pytest
 import requests
 import os
+import uuid
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://buildstock-hub.preview.emergentagent.com')
 
@@ -248,6 +249,173 @@ class TestRelatoriosObra:
         print("✓ Non-existent obra returns 404")
 
 
+class TestRelatoriosRollups:
+    """Report statistics served from the monthly rollups"""
+    
+    def test_stock_movement_updates_rollup(self, auth_token):
+        """Test that a new stock movement is reflected in the report totals for its month"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        material = requests.post(f"{BASE_URL}/api/materiais", json={
+            "codigo": f"TEST_MAT_{uuid.uuid4().hex[:6].upper()}", "descricao": "Rollup Material"
+        }, headers=headers).json()
+        try:
+            movimento = requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+                "material_id": material["id"], "tipo_movimento": "Entrada", "quantidade": 7
+            }, headers=headers).json()
+            ano, mes = int(movimento["data_hora"][:4]), int(movimento["data_hora"][5:7])
+            
+            response = requests.get(f"{BASE_URL}/api/relatorios/stock?mes={mes}&ano={ano}&detalhe=false", headers=headers)
+            assert response.status_code == 200
+            data = response.json()
+            assert data["movimentos"] == []
+            resumo = [m for m in data["materiais_resumo"] if m["codigo"] == material["codigo"]]
+            assert resumo and resumo[0]["entradas"] == 7
+            print("✓ Stock rollup updated on write")
+        finally:
+            requests.delete(f"{BASE_URL}/api/materiais/{material['id']}", headers=headers)
+    
+    def test_movimentos_report_without_detail(self, auth_token):
+        """Test that detalhe=false returns only the rollup statistics"""
+        response = requests.get(f"{BASE_URL}/api/relatorios/movimentos?ano=2026&detalhe=false", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["movimentos"] == []
+        assert "total_saidas" in data["estatisticas"]
+        print("✓ Relatorio movimentos served from rollups")
+
+
+class TestEncerrarObra:
+    """Tests for /api/obras/{obra_id}/encerrar and the frozen final report"""
+    
+    def test_encerrar_obra_returns_resources_and_freezes_report(self, auth_token):
+        """Test closing an obra with an assigned equipment"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        suffix = uuid.uuid4().hex[:6].upper()
+        obra = requests.post(f"{BASE_URL}/api/obras", json={"codigo": f"TEST_OBR_{suffix}", "nome": "Obra a encerrar"}, headers=headers).json()
+        equipamento = requests.post(f"{BASE_URL}/api/equipamentos", json={"codigo": f"TEST_EQ_{suffix}", "descricao": "Equipamento a devolver"}, headers=headers).json()
+        try:
+            requests.post(f"{BASE_URL}/api/movimentos/atribuir", json={
+                "recurso_id": equipamento["id"], "tipo_recurso": "equipamento", "obra_id": obra["id"]
+            }, headers=headers)
+            
+            response = requests.post(f"{BASE_URL}/api/obras/{obra['id']}/encerrar", json={}, headers=headers)
+            assert response.status_code == 200
+            data = response.json()
+            assert data["equipamentos_devolvidos"] == 1
+            assert data["relatorio_final"]["relatorio"]["obra"]["estado"] == "Concluida"
+            
+            detail = requests.get(f"{BASE_URL}/api/equipamentos/{equipamento['id']}", headers=headers).json()
+            assert detail["equipamento"]["obra_id"] is None
+            
+            relatorio = requests.get(f"{BASE_URL}/api/relatorios/obra/{obra['id']}", headers=headers).json()
+            assert relatorio["relatorio_final"]["id"] == data["relatorio_final"]["id"]
+            assert relatorio["estatisticas"]["total_devolucoes"] == 1
+            
+            again = requests.post(f"{BASE_URL}/api/obras/{obra['id']}/encerrar", json={}, headers=headers)
+            assert again.status_code == 400
+            print("✓ Obra encerrada with frozen final report")
+        finally:
+            requests.delete(f"{BASE_URL}/api/equipamentos/{equipamento['id']}", headers=headers)
+            requests.delete(f"{BASE_URL}/api/obras/{obra['id']}", headers=headers)
+    
+    def test_reabrir_obra_drops_final_report(self, auth_token):
+        """Test that reopening a closed obra stops serving its final report and allows closing it again"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        obra = requests.post(f"{BASE_URL}/api/obras", json={"codigo": f"TEST_OBR_{uuid.uuid4().hex[:6].upper()}", "nome": "Obra a reabrir"},
+                             headers=headers).json()
+        try:
+            requests.post(f"{BASE_URL}/api/obras/{obra['id']}/encerrar", json={}, headers=headers)
+            reaberta = requests.patch(f"{BASE_URL}/api/obras/{obra['id']}", json={"estado": "Ativa"}, headers=headers)
+            assert reaberta.status_code == 200
+            assert reaberta.json()["encerrada_em"] is None
+            
+            assert requests.get(f"{BASE_URL}/api/obras/{obra['id']}/relatorio-final", headers=headers).status_code == 404
+            relatorio = requests.get(f"{BASE_URL}/api/relatorios/obra/{obra['id']}", headers=headers).json()
+            assert "relatorio_final" not in relatorio
+            
+            again = requests.post(f"{BASE_URL}/api/obras/{obra['id']}/encerrar", json={}, headers=headers)
+            assert again.status_code == 200
+            assert requests.get(f"{BASE_URL}/api/obras/{obra['id']}/relatorio-final", headers=headers).status_code == 200
+            print("✓ Reopened obra has no final report until closed again")
+        finally:
+            requests.delete(f"{BASE_URL}/api/obras/{obra['id']}", headers=headers)
+    
+    def test_relatorio_final_not_found(self, auth_token):
+        """Test that an open obra has no final report"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        obra = requests.post(f"{BASE_URL}/api/obras", json={"codigo": f"TEST_OBR_{uuid.uuid4().hex[:6].upper()}", "nome": "Obra aberta"},
+                             headers=headers).json()
+        try:
+            response = requests.get(f"{BASE_URL}/api/obras/{obra['id']}/relatorio-final", headers=headers)
+            assert response.status_code == 404
+            assert response.json()["detail"] == "Obra sem relatório final"
+        finally:
+            requests.delete(f"{BASE_URL}/api/obras/{obra['id']}", headers=headers)
+        print("✓ Open obra has no final report")
+
+
+class TestRelatoriosUtilizacao:
+    """Tests for /api/relatorios/utilizacao"""
+    
+    def test_utilizacao_structure(self, auth_token):
+        """Test utilization report structure"""
+        response = requests.get(f"{BASE_URL}/api/relatorios/utilizacao", params={"de": "2024-01-01", "ate": "2024-12-31"}, headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert "por_obra" in data
+        assert "por_recurso" in data
+        assert "por_mes" in data
+        assert "estatisticas" in data
+        for row in data["por_mes"]:
+            assert row["dias_equipamento"] >= 0
+            assert row["dias_viatura"] >= 0
+        print(f"✓ Utilizacao report: {data['estatisticas']}")
+    
+    def test_utilizacao_invalid_range(self, auth_token):
+        """Test that an inverted date range is rejected"""
+        response = requests.get(f"{BASE_URL}/api/relatorios/utilizacao", params={"de": "2024-12-31", "ate": "2024-01-01"}, headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Invalid utilizacao range returns 400")
+
+
+class TestRelatoriosConsumoMatriz:
+    """Tests for /api/relatorios/consumo-matriz"""
+
+    def test_matriz_includes_obra_consumption(self, auth_token, obra_id):
+        """Test that a stock exit to an obra appears in its matrix cell"""
+        if not obra_id:
+            pytest.skip("No obra available for testing")
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        material = requests.post(f"{BASE_URL}/api/materiais", json={
+            "codigo": f"TEST_MAT_{uuid.uuid4().hex[:6].upper()}", "descricao": "Matriz Material", "stock_atual": 20
+        }, headers=headers).json()
+        try:
+            requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+                "material_id": material["id"], "tipo_movimento": "Saida", "quantidade": 6, "obra_id": obra_id
+            }, headers=headers)
+
+            response = requests.get(f"{BASE_URL}/api/relatorios/consumo-matriz", headers=headers)
+            assert response.status_code == 200
+            data = response.json()
+            coluna = [o["id"] for o in data["obras"]].index(obra_id)
+            linha = next(m for m in data["materiais"] if m["id"] == material["id"])
+            assert linha["quantidades"][coluna] == 6
+            assert len(linha["quantidades"]) == len(data["obras"]) == len(data["totais_obra"])
+
+            xlsx = requests.get(f"{BASE_URL}/api/relatorios/consumo-matriz?formato=xlsx", headers=headers)
+            assert xlsx.status_code == 200
+            assert "spreadsheetml" in xlsx.headers["content-type"]
+            print("✓ Consumption matrix built in one aggregation")
+        finally:
+            requests.delete(f"{BASE_URL}/api/materiais/{material['id']}", headers=headers)
+
+
 class TestRelatoriosAuth:
     """Tests for authentication on report endpoints"""
     
@@ -6,6 +6,7 @@ import pytest
 import requests
 import os
 import uuid
+import json
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://buildstock-hub.preview.emergentagent.com')
 
@@ -373,6 +374,775 @@ class TestExportImport:
         print(f"✓ Excel export successful - {len(response.content)} bytes")
 
 
+class TestVersionedUpdates:
+    """Optimistic concurrency (If-Match / version) and PATCH tests"""
+    
+    def test_put_returns_etag_and_bumps_version(self, auth_token, created_obra_id):
+        """Test that PUT returns the new version in the ETag header"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        detail = requests.get(f"{BASE_URL}/api/obras/{created_obra_id}", headers=headers)
+        assert detail.status_code == 200
+        etag = detail.headers.get("ETag")
+        assert etag
+        
+        response = requests.put(f"{BASE_URL}/api/obras/{created_obra_id}", json={
+            "codigo": f"TEST_OBR_{uuid.uuid4().hex[:6].upper()}",
+            "nome": "Versioned Obra"
+        }, headers={**headers, "If-Match": etag})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["nome"] == "Versioned Obra"
+        assert response.headers.get("ETag") == f'"{data["version"]}"'
+        assert response.headers.get("ETag") != etag
+        print(f"✓ PUT with If-Match {etag} -> {response.headers.get('ETag')}")
+    
+    def test_stale_if_match_returns_412(self, auth_token, created_material_id):
+        """Test that a stale If-Match is rejected instead of overwriting"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        etag = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).headers.get("ETag")
+        
+        first = requests.patch(f"{BASE_URL}/api/materiais/{created_material_id}", json={"stock_minimo": 10},
+                               headers={**headers, "If-Match": etag})
+        assert first.status_code == 200
+        
+        second = requests.patch(f"{BASE_URL}/api/materiais/{created_material_id}", json={"stock_minimo": 20},
+                                headers={**headers, "If-Match": etag})
+        assert second.status_code == 412
+        print("✓ Stale If-Match rejected with 412")
+    
+    def test_movement_invalidates_if_match(self, auth_token, created_material_id):
+        """Test that a stock movement bumps the version, so an edit read before it is rejected"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        etag = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).headers.get("ETag")
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+            "material_id": created_material_id, "tipo_movimento": "Entrada", "quantidade": 1
+        }, headers=headers)
+        
+        response = requests.patch(f"{BASE_URL}/api/materiais/{created_material_id}", json={"stock_minimo": 5},
+                                  headers={**headers, "If-Match": etag})
+        assert response.status_code == 412
+        print("✓ Edit read before a stock movement rejected with 412")
+    
+    def test_patch_only_changes_sent_fields(self, auth_token, created_equipamento_id):
+        """Test that PATCH leaves fields that were not sent untouched"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        response = requests.patch(f"{BASE_URL}/api/equipamentos/{created_equipamento_id}",
+                                  json={"estado_conservacao": "Razoável"}, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["estado_conservacao"] == "Razoável"
+        assert data["descricao"] == "Fixture Equipment"
+        print("✓ PATCH updated only the sent field")
+    
+    def test_stock_and_obra_not_editable(self, auth_token, created_material_id, created_equipamento_id, created_obra_id):
+        """Test that stock_atual and obra_id only change through movements"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        stock = requests.patch(f"{BASE_URL}/api/materiais/{created_material_id}", json={"stock_atual": 0}, headers=headers)
+        assert stock.status_code == 422
+        obra = requests.patch(f"{BASE_URL}/api/equipamentos/{created_equipamento_id}", json={"obra_id": created_obra_id},
+                              headers=headers)
+        assert obra.status_code == 422
+        
+        material = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["material"]
+        replaced = requests.put(f"{BASE_URL}/api/materiais/{created_material_id}",
+                                json={"codigo": material["codigo"], "descricao": "Replaced", "stock_atual": 0}, headers=headers)
+        assert replaced.status_code == 200
+        assert replaced.json()["stock_atual"] == material["stock_atual"]
+        print("✓ stock_atual and obra_id rejected or ignored outside movements")
+    
+    def test_patch_not_found(self, auth_token):
+        """Test PATCH on a non-existent resource"""
+        response = requests.patch(f"{BASE_URL}/api/viaturas/non-existent-id", json={"marca": "X"},
+                                  headers={"Authorization": f"Bearer {auth_token}", "If-Match": '"1"'})
+        assert response.status_code == 404
+        print("✓ PATCH on non-existent viatura returns 404")
+
+
+class TestUniqueKeys:
+    """Duplicate natural keys are rejected by unique indexes"""
+    
+    def test_duplicate_codigo_rejected(self, auth_token, created_material_id):
+        """Test that creating a material with an existing code returns 400"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        codigo = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["material"]["codigo"]
+        response = requests.post(f"{BASE_URL}/api/materiais", json={
+            "codigo": codigo,
+            "descricao": "Duplicate Material"
+        }, headers=headers)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Código já existe"
+        print(f"✓ Duplicate codigo {codigo} rejected")
+    
+    def test_update_to_existing_matricula_rejected(self, auth_token, created_viatura_id):
+        """Test that renaming a viatura to an existing matricula returns 400"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        other = requests.post(f"{BASE_URL}/api/viaturas", json={
+            "matricula": f"TEST-{uuid.uuid4().hex[:4].upper()}"
+        }, headers=headers).json()
+        try:
+            response = requests.patch(f"{BASE_URL}/api/viaturas/{created_viatura_id}",
+                                      json={"matricula": other["matricula"]}, headers=headers)
+            assert response.status_code == 400
+            assert response.json()["detail"] == "Matrícula já existe"
+            print("✓ Duplicate matricula on update rejected")
+        finally:
+            requests.delete(f"{BASE_URL}/api/viaturas/{other['id']}", headers=headers)
+
+
+class TestCascadeDeletes:
+    """Deleting an obra/resource closes open assignments and keeps history readable"""
+    
+    def test_delete_obra_returns_assigned_resources(self, auth_token, created_equipamento_id):
+        """Test that deleting an obra writes a Devolução and frees its equipment"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        obra = requests.post(f"{BASE_URL}/api/obras", json={
+            "codigo": f"TEST_OBR_{uuid.uuid4().hex[:6].upper()}",
+            "nome": "Cascade Obra"
+        }, headers=headers).json()
+        assign = requests.post(f"{BASE_URL}/api/movimentos/atribuir", json={
+            "recurso_id": created_equipamento_id,
+            "tipo_recurso": "equipamento",
+            "obra_id": obra["id"]
+        }, headers=headers)
+        assert assign.status_code == 200
+        
+        response = requests.delete(f"{BASE_URL}/api/obras/{obra['id']}", headers=headers)
+        assert response.status_code == 200
+        
+        detail = requests.get(f"{BASE_URL}/api/equipamentos/{created_equipamento_id}", headers=headers).json()
+        assert detail["equipamento"]["obra_id"] is None
+        ultimo = detail["historico"][0]
+        assert ultimo["tipo_movimento"] == "Devolucao"
+        assert ultimo["obra_eliminada"] is True
+        assert ultimo["obra_nome"] == "Cascade Obra"
+        print("✓ Obra deletion closed the open assignment")
+    
+    def test_delete_material_keeps_stock_history(self, auth_token, created_material_id):
+        """Test that stock movements of a deleted material still report its code"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        material = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["material"]
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+            "material_id": created_material_id,
+            "tipo_movimento": "Saida",
+            "quantidade": 1
+        }, headers=headers)
+        
+        response = requests.delete(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers)
+        assert response.status_code == 200
+        
+        movimentos = requests.get(f"{BASE_URL}/api/movimentos/stock", headers=headers).json()
+        orfaos = [m for m in movimentos if m["material_id"] == created_material_id]
+        assert orfaos and all(m["material_eliminado"] for m in orfaos)
+        assert orfaos[0]["material_codigo"] == material["codigo"]
+        print("✓ Material deletion marked its stock movements as orphans")
+
+
+class TestStockEm:
+    """Point-in-time stock balances (/api/materiais/stock-em)"""
+    
+    def test_stock_em_applies_movements_up_to_date(self, auth_token, created_material_id):
+        """Test that balances include the opening stock and movements up to the requested date only"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+            "material_id": created_material_id, "tipo_movimento": "Entrada", "quantidade": 12
+        }, headers=headers)
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+            "material_id": created_material_id, "tipo_movimento": "Saida", "quantidade": 5
+        }, headers=headers)
+        
+        hoje = requests.get(f"{BASE_URL}/api/materiais/stock-em", params={
+            "data": "2999-12-31", "material_id": created_material_id
+        }, headers=headers)
+        assert hoje.status_code == 200
+        assert hoje.json()["materiais"][0]["stock"] == 57  # 50 opening stock + 12 - 5
+        
+        antes = requests.get(f"{BASE_URL}/api/materiais/stock-em", params={
+            "data": "2000-01-01", "material_id": created_material_id
+        }, headers=headers).json()
+        assert antes["materiais"][0]["stock"] == 0
+        print("✓ Point-in-time stock computed from the ledger")
+    
+    def test_stock_em_invalid_date(self, auth_token):
+        """Test that an invalid date is rejected"""
+        response = requests.get(f"{BASE_URL}/api/materiais/stock-em?data=ontem", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Invalid date rejected")
+
+
+class TestStockReconciliation:
+    """Drift detection between stock_atual and the stock ledger"""
+    
+    def test_opening_stock_is_not_drift(self, auth_token, created_material_id):
+        """Test that a material created with stock has its opening balance in the ledger"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        report = requests.get(f"{BASE_URL}/api/materiais/reconciliacao", headers=headers)
+        assert report.status_code == 200
+        assert not [d for d in report.json()["divergencias"] if d["material_id"] == created_material_id]
+        
+        historico = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["historico"]
+        assert [m["quantidade"] for m in historico if m["documento"] == "SALDO_INICIAL"] == [50]
+        
+        fixed = requests.post(f"{BASE_URL}/api/materiais/reconciliacao?corrigir=true", headers=headers)
+        assert fixed.status_code == 200
+        assert not [d for d in fixed.json()["divergencias"] if d["material_id"] == created_material_id]
+        print("✓ Opening stock booked in the ledger, no drift reported")
+
+
+class TestAtribuicoes:
+    """Point-in-time assignment lookups (/api/recursos/{id}/localizacao, /api/obras/{id}/recursos)"""
+    
+    def test_localizacao_follows_assignments(self, auth_token, created_equipamento_id, created_obra_id):
+        """Test that the resource location is answered for past and current dates"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        requests.post(f"{BASE_URL}/api/movimentos/atribuir", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento",
+            "obra_id": created_obra_id, "data_levantamento": "2024-01-10"
+        }, headers=headers)
+        requests.post(f"{BASE_URL}/api/movimentos/devolver", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento", "data_devolucao": "2024-02-10"
+        }, headers=headers)
+        
+        durante = requests.get(f"{BASE_URL}/api/recursos/{created_equipamento_id}/localizacao",
+                               params={"data": "2024-01-20"}, headers=headers)
+        assert durante.status_code == 200
+        assert durante.json()["obra"]["id"] == created_obra_id
+        
+        depois = requests.get(f"{BASE_URL}/api/recursos/{created_equipamento_id}/localizacao",
+                              params={"data": "2024-02-20"}, headers=headers).json()
+        assert depois["atribuicao"] is None
+        
+        obra = requests.get(f"{BASE_URL}/api/obras/{created_obra_id}/recursos",
+                            params={"data": "2024-01-20"}, headers=headers).json()
+        assert [e["recurso_id"] for e in obra["equipamentos"]] == [created_equipamento_id]
+        print("✓ Resource location answered from assignment intervals")
+    
+    def test_devolucao_before_levantamento_rejected(self, auth_token, created_equipamento_id, created_obra_id):
+        """Test that a return dated before the open assignment started is rejected"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        requests.post(f"{BASE_URL}/api/movimentos/atribuir", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento",
+            "obra_id": created_obra_id, "data_levantamento": "2024-03-10"
+        }, headers=headers)
+        response = requests.post(f"{BASE_URL}/api/movimentos/devolver", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento", "data_devolucao": "2024-03-01"
+        }, headers=headers)
+        assert response.status_code == 400
+        
+        ainda = requests.get(f"{BASE_URL}/api/recursos/{created_equipamento_id}/localizacao",
+                             params={"data": "2024-03-20"}, headers=headers).json()
+        assert ainda["obra"]["id"] == created_obra_id
+        requests.post(f"{BASE_URL}/api/movimentos/devolver", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento", "data_devolucao": "2024-03-20"
+        }, headers=headers)
+        print("✓ Backdated return before the pickup rejected")
+    
+    def test_localizacao_not_found(self, auth_token):
+        """Test location of a non-existent resource"""
+        response = requests.get(f"{BASE_URL}/api/recursos/non-existent-id/localizacao", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 404
+        print("✓ Unknown resource returns 404")
+
+
+class TestReservas:
+    """Reservation calendar with conflict detection (/api/reservas)"""
+    
+    def test_reserva_conflicts_and_availability(self, auth_token, created_equipamento_id, created_obra_id):
+        """Test that overlapping reservations are rejected and availability reflects them"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        reserva = {"recurso_id": created_equipamento_id, "tipo_recurso": "equipamento",
+                   "obra_id": created_obra_id, "inicio": "2099-01-01", "fim": "2099-01-31"}
+        response = requests.post(f"{BASE_URL}/api/reservas", json=reserva, headers=headers)
+        assert response.status_code == 200
+        reserva_id = response.json()["id"]
+        try:
+            overlap = requests.post(f"{BASE_URL}/api/reservas", json={**reserva, "inicio": "2099-01-15", "fim": "2099-02-15"},
+                                    headers=headers)
+            assert overlap.status_code == 400
+            
+            disponibilidade = requests.get(f"{BASE_URL}/api/reservas/disponibilidade", params={
+                "inicio": "2099-01-10", "fim": "2099-01-12"
+            }, headers=headers).json()
+            assert created_equipamento_id in [r["id"] for r in disponibilidade["reservados"]]
+            assert created_equipamento_id not in [r["id"] for r in disponibilidade["disponiveis"]]
+            print("✓ Overlapping reservation rejected")
+        finally:
+            requests.delete(f"{BASE_URL}/api/reservas/{reserva_id}", headers=headers)
+    
+    def test_reserva_invalid_period(self, auth_token, created_equipamento_id, created_obra_id):
+        """Test that a reservation ending before it starts is rejected"""
+        response = requests.post(f"{BASE_URL}/api/reservas", json={
+            "recurso_id": created_equipamento_id, "tipo_recurso": "equipamento",
+            "obra_id": created_obra_id, "inicio": "2099-02-01", "fim": "2099-01-01"
+        }, headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 400
+        print("✓ Invalid reservation period rejected")
+    
+    def test_reserva_put_requires_full_body(self, auth_token, created_equipamento_id, created_obra_id):
+        """Test that PUT replaces the whole reservation while PATCH changes single fields"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        reserva = {"recurso_id": created_equipamento_id, "tipo_recurso": "equipamento",
+                   "obra_id": created_obra_id, "inicio": "2099-03-01", "fim": "2099-03-31"}
+        response = requests.post(f"{BASE_URL}/api/reservas", json=reserva, headers=headers)
+        assert response.status_code == 200
+        reserva_id, fim_original = response.json()["id"], response.json()["fim"]
+        try:
+            parcial = requests.put(f"{BASE_URL}/api/reservas/{reserva_id}", json={"fim": "2099-03-20"}, headers=headers)
+            assert parcial.status_code == 422
+            
+            extra = requests.patch(f"{BASE_URL}/api/reservas/{reserva_id}", json={"fim": "2099-03-20", "foo": 1},
+                                   headers=headers)
+            assert extra.status_code == 422
+            
+            response = requests.patch(f"{BASE_URL}/api/reservas/{reserva_id}", json={"responsavel": "Rui"},
+                                      headers=headers)
+            assert response.status_code == 200
+            
+            response = requests.put(f"{BASE_URL}/api/reservas/{reserva_id}", json={**reserva, "fim": "2099-03-20"},
+                                    headers=headers)
+            assert response.status_code == 200
+            assert response.json()["fim"] < fim_original
+            assert response.json()["responsavel"] == ""
+            print("✓ PUT replaces the reservation, PATCH is partial")
+        finally:
+            requests.delete(f"{BASE_URL}/api/reservas/{reserva_id}", headers=headers)
+
+
+class TestObraTimeline:
+    """Merged activity timeline (/api/obras/{id}/timeline)"""
+    
+    def test_timeline_pages_newest_first(self, auth_token, created_obra_id, created_material_id):
+        """Test that timeline pages are disjoint and ordered newest first"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        for quantidade in (1, 2, 3):
+            requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+                "material_id": created_material_id, "tipo_movimento": "Entrada",
+                "quantidade": quantidade, "obra_id": created_obra_id
+            }, headers=headers)
+        
+        primeira = requests.get(f"{BASE_URL}/api/obras/{created_obra_id}/timeline", params={"limite": 2}, headers=headers)
+        assert primeira.status_code == 200
+        data = primeira.json()
+        assert len(data["items"]) == 2
+        assert data["proximo_cursor"]
+        
+        segunda = requests.get(f"{BASE_URL}/api/obras/{created_obra_id}/timeline",
+                               params={"limite": 2, "cursor": data["proximo_cursor"]}, headers=headers).json()
+        datas = [i["data"] for i in data["items"] + segunda["items"]]
+        assert datas == sorted(datas, reverse=True)
+        assert not {i["id"] for i in data["items"]} & {i["id"] for i in segunda["items"]}
+        print("✓ Timeline paginated newest first")
+    
+    def test_timeline_obra_not_found(self, auth_token):
+        """Test timeline of a non-existent obra"""
+        response = requests.get(f"{BASE_URL}/api/obras/non-existent-id/timeline", headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 404
+        print("✓ Timeline of unknown obra returns 404")
+
+
+class TestSync:
+    """Delta sync feed (/api/sync)"""
+    
+    def test_sync_returns_changes_and_tombstones(self, auth_token):
+        """Test that created and deleted documents show up after the given seq"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        inicial = requests.get(f"{BASE_URL}/api/sync", params={"collections": "obras", "limite": 1}, headers=headers)
+        assert inicial.status_code == 200
+        since = inicial.json()["seq"]
+        
+        obra = requests.post(f"{BASE_URL}/api/obras", json={
+            "codigo": f"TEST_SYNC_{uuid.uuid4().hex[:6].upper()}", "nome": "Obra sync"
+        }, headers=headers).json()
+        criada = requests.get(f"{BASE_URL}/api/sync", params={"since": since, "collections": "obras"}, headers=headers).json()
+        assert obra["id"] in [o["id"] for o in criada["alterados"]["obras"]]
+        
+        requests.delete(f"{BASE_URL}/api/obras/{obra['id']}", headers=headers)
+        eliminada = requests.get(f"{BASE_URL}/api/sync", params={"since": since, "collections": "obras"}, headers=headers).json()
+        assert obra["id"] in eliminada["eliminados"]["obras"]
+        assert eliminada["seq"] >= since
+        print("✓ Sync returns changes and tombstones")
+    
+    def test_sync_invalid_collection(self, auth_token):
+        """Test that unknown collections are rejected"""
+        response = requests.get(f"{BASE_URL}/api/sync", params={"collections": "users"}, headers={
+            "Authorization": f"Bearer {auth_token}"
+        })
+        assert response.status_code == 400
+        print("✓ Unknown sync collection rejected")
+
+
+class TestServerEvents:
+    """SSE change stream (/api/events)"""
+    
+    def test_events_requires_auth(self):
+        """Test that the stream rejects unauthenticated clients"""
+        response = requests.get(f"{BASE_URL}/api/events", params={"token": "invalid"}, timeout=10)
+        assert response.status_code == 401
+        print("✓ Events stream requires auth")
+    
+    def test_events_stream_opens_with_query_token(self, auth_token):
+        """Test that EventSource-style auth (?token=) opens the stream"""
+        with requests.get(f"{BASE_URL}/api/events", params={"token": auth_token}, stream=True, timeout=10) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            primeira = next(response.iter_lines(decode_unicode=True))
+            assert primeira.startswith("retry:")
+        print("✓ Events stream opened")
+
+
+class TestIdempotency:
+    """Idempotency-Key replay on POST endpoints"""
+    
+    def test_retry_with_same_key_is_not_applied_twice(self, auth_token, created_material_id):
+        """Test that a retried stock movement is replayed instead of re-executed"""
+        headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": str(uuid.uuid4())}
+        body = {"material_id": created_material_id, "tipo_movimento": "Saida", "quantidade": 2}
+        primeira = requests.post(f"{BASE_URL}/api/movimentos/stock", json=body, headers=headers)
+        segunda = requests.post(f"{BASE_URL}/api/movimentos/stock", json=body, headers=headers)
+        assert primeira.status_code == 200
+        assert segunda.status_code == 200
+        assert segunda.json()["id"] == primeira.json()["id"]
+        assert segunda.headers.get("Idempotent-Replayed") == "true"
+        
+        material = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["material"]
+        assert material["stock_atual"] == 48
+        print("✓ Retried POST replayed once")
+    
+    def test_same_key_different_body_rejected(self, auth_token, created_material_id):
+        """Test that reusing a key for another request is rejected"""
+        headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": str(uuid.uuid4())}
+        body = {"material_id": created_material_id, "tipo_movimento": "Entrada", "quantidade": 1}
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json=body, headers=headers)
+        response = requests.post(f"{BASE_URL}/api/movimentos/stock", json={**body, "quantidade": 5}, headers=headers)
+        assert response.status_code == 422
+        print("✓ Key reuse with another body rejected")
+    
+    def test_auth_responses_not_stored(self):
+        """Test that login ignores Idempotency-Key, so tokens are never cached"""
+        headers = {"Idempotency-Key": str(uuid.uuid4())}
+        body = {"email": TEST_EMAIL, "password": TEST_PASSWORD}
+        primeira = requests.post(f"{BASE_URL}/api/auth/login", json=body, headers=headers)
+        segunda = requests.post(f"{BASE_URL}/api/auth/login", json=body, headers=headers)
+        assert primeira.status_code == 200
+        assert segunda.headers.get("Idempotent-Replayed") is None
+        print("✓ Auth responses not replayed")
+    
+    def test_ingest_rejects_key(self, auth_token):
+        """Test that the streaming ingest route rejects Idempotency-Key"""
+        headers = {"Authorization": f"Bearer {auth_token}", "Idempotency-Key": str(uuid.uuid4()),
+                   "Content-Type": "application/x-ndjson"}
+        response = requests.post(f"{BASE_URL}/api/movimentos/viaturas/ingest", data="", headers=headers)
+        assert response.status_code == 400
+        print("✓ Idempotency-Key rejected on ingest")
+
+
+class TestMovimentosLote:
+    """Offline movement replay through /api/movimentos/lote"""
+
+    def test_replayed_batch_applied_once(self, auth_token, created_material_id):
+        """Test that replaying the same offline batch reports duplicates instead of re-applying"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        lote = {"itens": [
+            {"id_cliente": str(uuid.uuid4()), "tipo": "stock", "registado_em": "2024-03-01T10:00:00Z",
+             "dados": {"material_id": created_material_id, "tipo_movimento": "Saida", "quantidade": 3}},
+            {"id_cliente": str(uuid.uuid4()), "tipo": "stock", "registado_em": "2024-03-01T10:05:00Z",
+             "dados": {"material_id": created_material_id, "tipo_movimento": "Saida", "quantidade": 1000}},
+        ]}
+        response = requests.post(f"{BASE_URL}/api/movimentos/lote", json=lote, headers=headers)
+        assert response.status_code == 200
+        estados = [r["estado"] for r in response.json()["resultados"]]
+        assert estados == ["criado", "conflito"]
+
+        replay = requests.post(f"{BASE_URL}/api/movimentos/lote", json=lote, headers=headers)
+        assert replay.json()["resultados"][0]["estado"] == "duplicado"
+
+        material = requests.get(f"{BASE_URL}/api/materiais/{created_material_id}", headers=headers).json()["material"]
+        assert material["stock_atual"] == 47
+        print("✓ Offline batch applied once, conflict reported")
+
+    def test_invalid_tipo_reported_per_item(self, auth_token):
+        """Test that an unknown item type fails only that item"""
+        response = requests.post(f"{BASE_URL}/api/movimentos/lote", json={"itens": [
+            {"id_cliente": str(uuid.uuid4()), "tipo": "desconhecido", "dados": {}}
+        ]}, headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 200
+        assert response.json()["resultados"][0]["estado"] == "erro"
+        print("✓ Invalid item reported without failing the batch")
+
+
+class TestViaturaExpiracoes:
+    """Inspection/insurance dates stored as dates and queried for alerts"""
+
+    def test_expiring_vistoria_alerted(self, auth_token):
+        """Test that a viatura whose vistoria expires soon is alerted and its date served as ISO text"""
+        from datetime import date, timedelta
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        vistoria = (date.today() + timedelta(days=3)).isoformat()
+        viatura = requests.post(f"{BASE_URL}/api/viaturas", json={
+            "matricula": f"TEST-{uuid.uuid4().hex[:6].upper()}", "data_vistoria": vistoria, "data_seguro": ""
+        }, headers=headers).json()
+        try:
+            assert viatura["data_vistoria"].startswith(vistoria)
+            assert viatura["data_seguro"] is None
+
+            alerts = requests.get(f"{BASE_URL}/api/alerts/check", headers=headers).json()["alerts"]
+            alerta = next(a for a in alerts if a["viatura_id"] == viatura["id"])
+            assert alerta["tipo_alerta"] == "vistoria"
+            assert alerta["dias_restantes"] in (2, 3, 4)  # server clock is UTC
+        finally:
+            requests.delete(f"{BASE_URL}/api/viaturas/{viatura['id']}", headers=headers)
+        print("✓ Expiring vistoria alerted")
+
+
+class TestRegrasAlerta:
+    """Alert rules stored in the database and served from the scheduler"""
+
+    def test_rule_alerts_equipment_inspection(self, auth_token):
+        """Test that a new rule immediately alerts on an equipment with an overdue inspection"""
+        from datetime import date, timedelta
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        regra = requests.post(f"{BASE_URL}/api/alerts/regras", json={
+            "nome": "Inspeção teste", "tipo_alerta": "inspecao_teste", "entidade": "equipamento",
+            "campo": "data_inspecao", "antecedencia_dias": 5
+        }, headers=headers).json()
+        equipamento = requests.post(f"{BASE_URL}/api/equipamentos", json={
+            "codigo": f"TEST_EQ_{uuid.uuid4().hex[:6].upper()}", "descricao": "Grua teste",
+            "data_inspecao": (date.today() - timedelta(days=2)).isoformat()
+        }, headers=headers).json()
+        try:
+            alerts = requests.get(f"{BASE_URL}/api/alerts/check", headers=headers).json()["alerts"]
+            alerta = next(a for a in alerts if a["regra_id"] == regra["id"])
+            assert alerta["entidade_id"] == equipamento["id"]
+            assert alerta["dias_restantes"] < 0
+
+            requests.delete(f"{BASE_URL}/api/alerts/regras/{regra['id']}", headers=headers)
+            alerts = requests.get(f"{BASE_URL}/api/alerts/check", headers=headers).json()["alerts"]
+            assert not any(a["regra_id"] == regra["id"] for a in alerts)
+        finally:
+            requests.delete(f"{BASE_URL}/api/alerts/regras/{regra['id']}", headers=headers)
+            requests.delete(f"{BASE_URL}/api/equipamentos/{equipamento['id']}", headers=headers)
+        print("✓ Rule-based alert scheduled and removed with its rule")
+
+    def test_revision_rule_skips_unrecorded_revision(self, auth_token, created_viatura_id):
+        """Test that a viatura with no recorded revision is not flagged as overdue by the km rule"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        requests.post(f"{BASE_URL}/api/movimentos/viaturas", json={
+            "viatura_id": created_viatura_id, "km_inicial": 20000, "km_final": 20100
+        }, headers=headers)
+        alerts = requests.get(f"{BASE_URL}/api/alerts/check", headers=headers).json()["alerts"]
+        assert not any(a["entidade_id"] == created_viatura_id and a["tipo_alerta"] == "revisao" for a in alerts)
+
+        requests.patch(f"{BASE_URL}/api/viaturas/{created_viatura_id}", json={"km_ultima_revisao": 5000}, headers=headers)
+        alerts = requests.get(f"{BASE_URL}/api/alerts/check", headers=headers).json()["alerts"]
+        assert any(a["entidade_id"] == created_viatura_id and a["tipo_alerta"] == "revisao" for a in alerts)
+        print("✓ Revision rule only applies once a revision is recorded")
+
+    def test_invalid_rule_rejected(self, auth_token):
+        """Test that km rules require a viatura and a positive interval"""
+        response = requests.post(f"{BASE_URL}/api/alerts/regras", json={
+            "nome": "Revisão", "tipo_alerta": "revisao", "entidade": "equipamento", "tipo": "km", "campo": "km_ultima_revisao"
+        }, headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 400
+        print("✓ Invalid rule rejected")
+
+
+class TestAlertasEmail:
+    """Alert digests queued in the email outbox"""
+
+    def test_repeated_send_does_not_resend(self, auth_token):
+        """Test that a second send right after the first has no new alerts to notify"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        primeira = requests.post(f"{BASE_URL}/api/alerts/send", headers=headers)
+        if primeira.status_code == 400:
+            pytest.skip("Email not configured on this server")
+        assert primeira.status_code == 200
+        segunda = requests.post(f"{BASE_URL}/api/alerts/send", headers=headers)
+        assert segunda.status_code == 200
+        assert segunda.json()["alerts_count"] == 0
+
+        if primeira.json()["alerts_count"]:
+            outbox = requests.get(f"{BASE_URL}/api/alerts/outbox", headers=headers).json()
+            assert any(m["id"] == primeira.json()["outbox_id"] for m in outbox)
+        print("✓ Already notified alerts not re-sent")
+
+
+class TestMateriaisAbaixoMinimo:
+    """Low-stock flag maintained on every stock write"""
+
+    def test_stock_exit_flags_material(self, auth_token, created_material_id, created_obra_id):
+        """Test that a stock exit below the minimum lists the material with its deficit"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        requests.post(f"{BASE_URL}/api/movimentos/stock", json={
+            "material_id": created_material_id, "tipo_movimento": "Saida", "quantidade": 48, "obra_id": created_obra_id
+        }, headers=headers)
+
+        lista = requests.get(f"{BASE_URL}/api/materiais/abaixo-minimo", headers=headers).json()
+        material = next(m for m in lista if m["id"] == created_material_id)
+        assert material["abaixo_minimo"] is True
+        assert material["deficit"] == 3
+        assert [m["deficit"] for m in lista] == sorted((m["deficit"] for m in lista), reverse=True)
+
+        requests.patch(f"{BASE_URL}/api/materiais/{created_material_id}", json={"stock_minimo": 1}, headers=headers)
+        lista = requests.get(f"{BASE_URL}/api/materiais/abaixo-minimo", headers=headers).json()
+        assert not any(m["id"] == created_material_id for m in lista)
+        print("✓ Low-stock flag follows stock movements and minimum changes")
+
+
+class TestPrevisaoConsumo:
+    """Consumption forecast and suggested reorder points"""
+
+    def test_forecast_lists_material(self, auth_token, created_material_id):
+        """Test that a recalculated forecast covers a material without history"""
+        response = requests.get(f"{BASE_URL}/api/materiais/previsao?recalcular=true",
+                                headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["execucao"]["materiais"] >= 1
+        assert data["parametros"]["janela_dias"] > 0
+
+        previsao = next(p for p in data["materiais"] if p["material_id"] == created_material_id)
+        assert previsao["consumo_medio_diario"] == 0
+        assert previsao["consumo_pico_diario"] == 0
+        assert previsao["dias_cobertura"] is None
+        assert previsao["repor"] is False
+        print("✓ Consumption forecast computed for all materials")
+
+
+class TestKpisSerie:
+    """Time-series KPIs bucketed by day, week or month"""
+
+    def test_dense_daily_series(self, auth_token):
+        """Test that every day of the range has a bucket for each requested metric"""
+        response = requests.get(f"{BASE_URL}/api/kpis/serie", params={
+            "metric": "movimentos,stock,km,atribuicoes", "granularidade": "dia", "de": "2024-03-01", "ate": "2024-03-31"
+        }, headers={"Authorization": f"Bearer {auth_token}"})
+        assert response.status_code == 200
+        metricas = response.json()["metricas"]
+        assert set(metricas) == {"movimentos", "stock", "km", "atribuicoes"}
+        serie = metricas["stock"]["serie"]
+        assert len(serie) == 31
+        assert serie[0]["periodo"].startswith("2024-03-01")
+        assert metricas["stock"]["totais"]["entradas"] == sum(p["entradas"] for p in serie)
+        print("✓ Dense KPI series for all metrics in one request")
+
+    def test_invalid_metric_rejected(self, auth_token):
+        """Test that unknown metrics and granularities return 400"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        assert requests.get(f"{BASE_URL}/api/kpis/serie?metric=lucro", headers=headers).status_code == 400
+        assert requests.get(f"{BASE_URL}/api/kpis/serie?granularidade=ano", headers=headers).status_code == 400
+        print("✓ Invalid KPI parameters rejected")
+
+
+class TestOdometro:
+    """Vehicle odometer kept by the km ledger"""
+
+    def test_odometer_continuity(self, auth_token, created_viatura_id, created_obra_id):
+        """Test that km entries advance the odometer, reject regressions and flag gaps"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        url = f"{BASE_URL}/api/movimentos/viaturas"
+        base = {"viatura_id": created_viatura_id, "obra_id": created_obra_id}
+        assert requests.post(url, json={**base, "km_inicial": 1000, "km_final": 1100}, headers=headers).status_code == 200
+
+        recuo = requests.post(url, json={**base, "km_inicial": 1050, "km_final": 1200}, headers=headers)
+        assert recuo.status_code == 409
+
+        lacuna = requests.post(url, json={**base, "km_inicial": 1150, "km_final": 1200}, headers=headers)
+        assert lacuna.status_code == 200
+        assert lacuna.json()["lacuna_km"] == 50
+
+        km = requests.get(f"{BASE_URL}/api/viaturas/{created_viatura_id}/km", headers=headers).json()
+        assert km["km_atual"] == 1200
+        assert km["km_total"] == 150
+        assert len(km["descontinuidades"]) == 1
+
+        relatorio = requests.get(f"{BASE_URL}/api/relatorios/km?viatura_id={created_viatura_id}", headers=headers).json()
+        assert [l["km"] for l in relatorio["linhas"] if l["obra_id"] == created_obra_id] == [150]
+        print("✓ Odometer continuity enforced and km aggregated per obra")
+
+
+class TestIngestViagens:
+    """Bulk trip ingest from telemetry files"""
+
+    def test_ingest_ndjson_and_duplicates(self, auth_token, created_viatura_id):
+        """Test that NDJSON trips are inserted once, bad lines reported and the odometer advanced"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        matricula = requests.get(f"{BASE_URL}/api/viaturas/{created_viatura_id}", headers=headers).json()["viatura"]["matricula"]
+        viagens = [{"matricula": matricula.lower(), "data": f"2025-03-0{d}T08:00:00+00:00",
+                    "km_inicial": 5000 + d * 100, "km_final": 5080 + d * 100} for d in range(1, 4)]
+        corpo = "\n".join(json.dumps(v) for v in viagens) + "\n{invalida\n"
+        url = f"{BASE_URL}/api/movimentos/viaturas/ingest"
+
+        response = requests.post(url, data=corpo, headers=headers)
+        assert response.status_code == 200
+        resultado = response.json()
+        assert resultado["inseridas"] == 3
+        assert resultado["invalidas"] == 1
+        assert resultado["erros"][0]["linha"] == 4
+        assert resultado["viagens_por_segundo"] > 0
+
+        repetido = requests.post(url, data=corpo, headers=headers).json()
+        assert repetido["inseridas"] == 0
+        assert repetido["duplicadas"] == 3
+
+        km = requests.get(f"{BASE_URL}/api/viaturas/{created_viatura_id}/km", headers=headers).json()
+        assert km["km_atual"] == 5380
+        print("✓ Telemetry trips ingested once and odometer advanced")
+
+    def test_ingest_csv(self, auth_token, created_viatura_id):
+        """Test CSV ingest and unknown plates"""
+        headers = {"Authorization": f"Bearer {auth_token}", "Content-Type": "text/csv"}
+        matricula = requests.get(f"{BASE_URL}/api/viaturas/{created_viatura_id}", headers=headers).json()["viatura"]["matricula"]
+        corpo = f"matricula,data,km_inicial,km_final\n{matricula},2025-04-01,100,150\nXX-00-XX,2025-04-01,1,2\n"
+        resultado = requests.post(f"{BASE_URL}/api/movimentos/viaturas/ingest", data=corpo, headers=headers).json()
+        assert resultado["formato"] == "csv"
+        assert resultado["inseridas"] == 1
+        assert resultado["erros"][0]["erros"][0]["loc"] == ["matricula"]
+        print("✓ CSV trips ingested, unknown plate reported")
+
+    def test_ingest_csv_quoted_newline(self, auth_token, created_viatura_id):
+        """Test CSV fields with line breaks inside quotes"""
+        headers = {"Authorization": f"Bearer {auth_token}", "Content-Type": "text/csv"}
+        matricula = requests.get(f"{BASE_URL}/api/viaturas/{created_viatura_id}", headers=headers).json()["viatura"]["matricula"]
+        corpo = f'matricula,data,km_inicial,km_final,observacoes\n{matricula},2025-04-02,150,160,"portagem\nA1, Lisboa"\n'
+        resultado = requests.post(f"{BASE_URL}/api/movimentos/viaturas/ingest", data=corpo, headers=headers).json()
+        assert resultado["recebidas"] == 1
+        assert resultado["inseridas"] == 1
+        print("✓ Quoted multi-line CSV field kept in one record")
+
+
+class TestPesquisa:
+    """Global search across equipment, vehicles, materials and obras"""
+
+    def test_prefix_and_accent_insensitive_search(self, auth_token, created_equipamento_id):
+        """Test code prefixes, accent-insensitive words and typed, ranked results"""
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        codigo = requests.get(f"{BASE_URL}/api/equipamentos/{created_equipamento_id}", headers=headers).json()["equipamento"]["codigo"]
+        requests.patch(f"{BASE_URL}/api/equipamentos/{created_equipamento_id}",
+                       json={"descricao": f"Máquina Betoneira {codigo}"}, headers=headers)
+
+        response = requests.get(f"{BASE_URL}/api/pesquisa", params={"q": codigo.lower()[:-1]}, headers=headers)
+        assert response.status_code == 200
+        resultados = response.json()["resultados"]
+        assert resultados[0]["id"] == created_equipamento_id
+        assert resultados[0]["tipo"] == "equipamento"
+
+        exato = requests.get(f"{BASE_URL}/api/pesquisa", params={"q": codigo}, headers=headers).json()["resultados"]
+        assert exato[0]["correspondencia"] == "codigo"
+
+        por_texto = requests.get(f"{BASE_URL}/api/pesquisa", params={"q": f"maquina {codigo}", "tipos": "equipamento"},
+                                 headers=headers).json()["resultados"]
+        assert created_equipamento_id in [r["id"] for r in por_texto]
+        assert all(r["tipo"] == "equipamento" for r in por_texto)
+
+        assert requests.get(f"{BASE_URL}/api/pesquisa?q=x&tipos=foo", headers=headers).status_code == 400
+        print("✓ Search matches code prefixes and accent-insensitive words")
+
+
 # Fixtures
 @pytest.fixture(scope="session")
 def auth_token():
@@ -1,10 +1,27 @@
-const CACHE_NAME = 'jose-firmino-v1';
+const CACHE_NAME = 'jose-firmino-v2';
+const API_CACHE_NAME = 'jose-firmino-api-v1';
 const STATIC_ASSETS = [
   '/',
   '/index.html',
   '/manifest.json'
 ];
 
+// Catalog GETs served stale-while-revalidate
+const CATALOG_PATHS = ['/api/equipamentos', '/api/viaturas', '/api/materiais', '/api/obras', '/api/summary'];
+
+// Movement POSTs queued in IndexedDB when offline, by batch item type
+const QUEUED_PATHS = {
+  '/api/movimentos/stock': 'stock',
+  '/api/movimentos/atribuir': 'atribuir',
+  '/api/movimentos/devolver': 'devolver',
+  '/api/movimentos/viaturas': 'viatura'
+};
+
+const QUEUE_DB = 'jose-firmino-offline';
+const QUEUE_STORE = 'movimentos';
+const SYNC_TAG = 'movimentos-offline';
+const BATCH_SIZE = 100;
+
 // Install event - cache static assets
 self.addEventListener('install', (event) => {
   event.waitUntil(
@@ -23,19 +40,224 @@ self.addEventListener('activate', (event) => {
     caches.keys().then((cacheNames) => {
       return Promise.all(
         cacheNames
-          .filter((name) => name !== CACHE_NAME)
+          .filter((name) => name !== CACHE_NAME && !name.startsWith(`${API_CACHE_NAME}:`))
           .map((name) => caches.delete(name))
       );
     }).then(() => self.clients.claim())
   );
 });
 
-// Fetch event - network first, fallback to cache
+// ==================== OFFLINE QUEUE (IndexedDB) ====================
+function openQueue() {
+  return new Promise((resolve, reject) => {
+    const request = indexedDB.open(QUEUE_DB, 1);
+    request.onupgradeneeded = () => {
+      request.result.createObjectStore(QUEUE_STORE, { keyPath: 'ordem', autoIncrement: true });
+    };
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+async function queueTransaction(mode, work) {
+  const db = await openQueue();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(QUEUE_STORE, mode);
+    const result = work(tx.objectStore(QUEUE_STORE));
+    tx.oncomplete = () => resolve(result.result);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+const enqueue = (item) => queueTransaction('readwrite', (store) => store.add(item));
+const queuedItems = () => queueTransaction('readonly', (store) => store.getAll());
+const removeQueued = (ordens) => queueTransaction('readwrite', (store) => {
+  ordens.forEach((ordem) => store.delete(ordem));
+  return {};
+});
+
+async function notifyClients(message) {
+  const clients = await self.clients.matchAll({ includeUncontrolled: true });
+  clients.forEach((client) => client.postMessage(message));
+}
+
+// ==================== SESSION ====================
+// The JWT is never persisted by the worker: queued items and cached catalogs only
+// record the user id, and replays use the token of the request or of an open page.
+function userFromAuthorization(authorization) {
+  const token = (authorization || '').replace(/^Bearer\s+/i, '');
+  try {
+    const payload = token.split('.')[1].replace(/-/g, '+').replace(/_/g, '/');
+    return JSON.parse(atob(payload)).sub || null;
+  } catch (error) {
+    return null;
+  }
+}
+
+function askClient(client) {
+  return new Promise((resolve) => {
+    const channel = new MessageChannel();
+    const timer = setTimeout(() => resolve(null), 2000);
+    channel.port1.onmessage = (event) => {
+      clearTimeout(timer);
+      resolve(event.data && event.data.authorization ? event.data.authorization : null);
+    };
+    client.postMessage({ type: 'session-request' }, [channel.port2]);
+  });
+}
+
+async function currentAuthorization() {
+  const clients = await self.clients.matchAll({ type: 'window' });
+  for (const client of clients) {
+    const authorization = await askClient(client);
+    if (authorization) return authorization;
+  }
+  return null;
+}
+
+// Items queued by older versions still carry the token they were recorded with
+const itemUser = (item) => item.utilizador || userFromAuthorization(item.authorization);
+
+const apiCacheName = (user) => `${API_CACHE_NAME}:${user}`;
+
+async function clearApiCaches() {
+  const names = await caches.keys();
+  await Promise.all(names.filter((name) => name.startsWith(`${API_CACHE_NAME}:`)).map((name) => caches.delete(name)));
+}
+
+// Replays the user's queued items in order through /api/movimentos/lote. Items carry their
+// client-generated id, so a batch re-sent after a lost response is not applied twice.
+// Items queued under another login stay queued until that user is back.
+async function replayQueue(authorization) {
+  authorization = authorization || await currentAuthorization();
+  const user = userFromAuthorization(authorization);
+  if (!user) return; // no open session to replay with
+  let items = (await queuedItems()).filter((item) => itemUser(item) === user);
+  while (items.length) {
+    // A batch never mixes backends, so every item goes where it was recorded
+    const { apiBase } = items[0];
+    const fim = items.findIndex((item) => item.apiBase !== apiBase);
+    const batch = items.slice(0, Math.min(fim === -1 ? items.length : fim, BATCH_SIZE));
+    let response;
+    try {
+      response = await fetch(`${apiBase}/movimentos/lote`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', Authorization: authorization },
+        body: JSON.stringify({
+          itens: batch.map(({ id_cliente, tipo, dados, registado_em }) => ({ id_cliente, tipo, dados, registado_em }))
+        })
+      });
+    } catch (error) {
+      return; // still offline
+    }
+    if (!response.ok) {
+      // e.g. expired session: keep the queue until the user logs in again
+      console.log('PWA: Falha ao sincronizar movimentos offline:', response.status);
+      return;
+    }
+    const result = await response.json();
+    await removeQueued(batch.map((item) => item.ordem));
+    await notifyClients({ type: 'offline-queue-replayed', ...result });
+    items = items.slice(batch.length);
+  }
+}
+
+let replaying = null;
+function flushQueue(authorization) {
+  if (!replaying) {
+    replaying = replayQueue(authorization).finally(() => { replaying = null; });
+  }
+  return replaying;
+}
+
+async function postOrQueue(request, tipo) {
+  const dados = await request.json();
+  const idCliente = dados.id_cliente || self.crypto.randomUUID();
+  const headers = new Headers(request.headers);
+  headers.set('Content-Type', 'application/json');
+  const authorization = headers.get('Authorization');
+  const utilizador = userFromAuthorization(authorization);
+  // Earlier queued movements go first (a Devolução depends on its Saída): while any are
+  // left after trying to flush them, new ones join the queue instead of overtaking it
+  await flushQueue(authorization);
+  const pendentes = (await queuedItems()).some((item) => itemUser(item) === utilizador);
+  if (!pendentes) {
+    try {
+      return await fetch(request.url, {
+        method: 'POST',
+        headers,
+        body: JSON.stringify({ ...dados, id_cliente: idCliente })
+      });
+    } catch (error) {
+      // offline: queue it below
+    }
+  }
+  await enqueue({
+    id_cliente: idCliente,
+    tipo,
+    dados,
+    registado_em: new Date().toISOString(),
+    apiBase: request.url.slice(0, request.url.indexOf('/api/') + 4),
+    utilizador
+  });
+  if (self.registration.sync) {
+    self.registration.sync.register(SYNC_TAG).catch(() => {});
+  }
+  return new Response(JSON.stringify({
+    message: pendentes
+      ? 'Movimento guardado no dispositivo e enviado a seguir aos movimentos offline pendentes'
+      : 'Sem rede: movimento guardado no dispositivo e enviado quando houver ligação',
+    offline: true,
+    id: idCliente,
+    movimento_id: idCliente
+  }), { status: 202, headers: { 'Content-Type': 'application/json' } });
+}
+
+// Cached per user, so a catalog fetched under one login is never served to another
+async function staleWhileRevalidate(event) {
+  const authorization = event.request.headers.get('Authorization');
+  const user = userFromAuthorization(authorization);
+  if (!user) return fetch(event.request);
+  const cache = await caches.open(apiCacheName(user));
+  const cached = await cache.match(event.request);
+  const network = fetch(event.request).then((response) => {
+    if (response.ok) {
+      cache.put(event.request, response.clone());
+      flushQueue(authorization);
+    }
+    return response;
+  });
+  if (cached) {
+    event.waitUntil(network.catch(() => {}));
+    return cached;
+  }
+  return network;
+}
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === SYNC_TAG) event.waitUntil(flushQueue());
+});
+
+self.addEventListener('message', (event) => {
+  if (!event.data) return;
+  if (event.data.type === 'flush-offline-queue') event.waitUntil(flushQueue());
+  if (event.data.type === 'logout') event.waitUntil(clearApiCaches());
+});
+
+// Fetch event - API: catalogs stale-while-revalidate, movements queued offline;
+// everything else network first, fallback to cache
 self.addEventListener('fetch', (event) => {
-  // Skip non-GET requests and API calls
+  const url = new URL(event.request.url);
+  if (url.pathname.startsWith('/api/')) {
+    if (event.request.method === 'GET' && CATALOG_PATHS.includes(url.pathname)) {
+      event.respondWith(staleWhileRevalidate(event));
+    } else if (event.request.method === 'POST' && QUEUED_PATHS[url.pathname]) {
+      event.respondWith(postOrQueue(event.request, QUEUED_PATHS[url.pathname]));
+    }
+    return;
+  }
   if (event.request.method !== 'GET') return;
-  if (event.request.url.includes('/api/')) return;
-  
+
   event.respondWith(
     fetch(event.request)
       .then((response) => {
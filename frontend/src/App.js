@@ -3,6 +3,7 @@ import "@/App.css";
 import { BrowserRouter, Routes, Route, Navigate } from "react-router-dom";
 import axios from "axios";
 import { Toaster } from "@/components/ui/sonner";
+import { toast } from "sonner";
 
 // Pages
 import Login from "@/pages/Login";
@@ -35,6 +36,26 @@ if ('serviceWorker' in navigator) {
         console.log('PWA: Falha ao registar Service Worker:', error);
       });
   });
+
+  // Replay movements queued while offline as soon as the connection returns
+  window.addEventListener('online', () => {
+    navigator.serviceWorker.controller?.postMessage({ type: 'flush-offline-queue' });
+  });
+
+  navigator.serviceWorker.addEventListener('message', (event) => {
+    // The worker does not keep the JWT: it asks for the current one when replaying the queue
+    if (event.data?.type === 'session-request') {
+      const token = localStorage.getItem("token");
+      event.ports[0]?.postMessage({ authorization: token ? `Bearer ${token}` : null });
+      return;
+    }
+    if (event.data?.type !== 'offline-queue-replayed') return;
+    const { criados, resultados = [] } = event.data;
+    if (criados) toast.success(`${criados} movimento(s) offline sincronizado(s)`);
+    resultados
+      .filter((r) => r.estado === 'conflito' || r.estado === 'erro')
+      .forEach((r) => toast.error(`Movimento offline rejeitado: ${typeof r.detail === 'string' ? r.detail : 'dados inválidos'}`));
+  });
 }
 
 // Auth Context
@@ -126,6 +147,8 @@ const AuthProvider = ({ children }) => {
 
   const logout = () => {
     localStorage.removeItem("token");
+    // Catalogs cached by the service worker belong to this session
+    navigator.serviceWorker?.controller?.postMessage({ type: 'logout' });
     setToken(null);
     setUser(null);
   };
@@ -1,6 +1,7 @@
-import { useState } from "react";
+import { useState, useEffect } from "react";
 import { Outlet, NavLink, useNavigate } from "react-router-dom";
-import { useAuth, useTheme } from "@/App";
+import { useAuth, useTheme, API } from "@/App";
+import axios from "axios";
 import {
   LayoutDashboard,
   Wrench,
@@ -16,7 +17,8 @@ import {
   ChevronLeft,
   ChevronDown,
   Sun,
-  Moon
+  Moon,
+  Search
 } from "lucide-react";
 import {
   DropdownMenu,
@@ -41,6 +43,13 @@ const navItems = [
   { path: "/obras", icon: Building2, label: "Obras" },
 ];
 
+const pesquisaTipos = {
+  equipamento: { path: "/equipamentos", icon: Wrench, titulo: (r) => r.codigo, detalhe: (r) => r.descricao },
+  viatura: { path: "/viaturas", icon: Truck, titulo: (r) => r.matricula, detalhe: (r) => [r.marca, r.modelo].filter(Boolean).join(" ") },
+  material: { path: "/materiais", icon: Package, titulo: (r) => r.codigo, detalhe: (r) => r.descricao },
+  obra: { path: "/obras", icon: Building2, titulo: (r) => r.codigo, detalhe: (r) => r.nome },
+};
+
 const movimentosItems = [
   { path: "/movimentos/ativos", label: "Mov. Ativos" },
   { path: "/movimentos/stock", label: "Mov. Stock" },
@@ -48,12 +57,40 @@ const movimentosItems = [
 ];
 
 export default function Layout() {
-  const { user, logout } = useAuth();
+  const { user, logout, token } = useAuth();
   const { theme, toggleTheme } = useTheme();
   const navigate = useNavigate();
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [mobileOpen, setMobileOpen] = useState(false);
   const [movimentosOpen, setMovimentosOpen] = useState(false);
+  const [pesquisa, setPesquisa] = useState("");
+  const [resultados, setResultados] = useState([]);
+
+  useEffect(() => {
+    if (pesquisa.trim().length < 2) {
+      setResultados([]);
+      return;
+    }
+    // Debounced server search instead of downloading every catalog
+    const timer = setTimeout(async () => {
+      try {
+        const response = await axios.get(`${API}/pesquisa`, {
+          headers: { Authorization: `Bearer ${token}` },
+          params: { q: pesquisa, limite: 10 }
+        });
+        setResultados(response.data.resultados);
+      } catch (error) {
+        console.error("Error searching:", error);
+      }
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [pesquisa, token]);
+
+  const abrirResultado = (resultado) => {
+    setPesquisa("");
+    setResultados([]);
+    navigate(`${pesquisaTipos[resultado.tipo].path}/${resultado.id}`);
+  };
 
   const handleLogout = () => {
     logout();
@@ -189,7 +226,41 @@ export default function Layout() {
             <Menu className="h-5 w-5" />
           </button>
 
-          <div className="flex-1" />
+          <div className="flex-1 flex justify-center px-2">
+            <div className="relative w-full max-w-md">
+              <Search className={`absolute left-3 top-1/2 -translate-y-1/2 h-4 w-4 ${isDark ? 'text-neutral-500' : 'text-gray-400'}`} />
+              <input
+                value={pesquisa}
+                onChange={(e) => setPesquisa(e.target.value)}
+                onKeyDown={(e) => e.key === "Enter" && resultados.length > 0 && abrirResultado(resultados[0])}
+                placeholder="Pesquisar código, matrícula, descrição..."
+                data-testid="global-search-input"
+                className={`w-full h-9 pl-9 pr-3 rounded-sm text-sm outline-none border
+                  ${isDark ? 'bg-neutral-900 border-neutral-800 text-white placeholder:text-neutral-500 focus:border-orange-500' : 'bg-gray-50 border-gray-200 text-gray-900 focus:border-orange-500'}`}
+              />
+              {resultados.length > 0 && (
+                <div className={`absolute top-full mt-1 w-full rounded-sm border shadow-lg z-50 max-h-96 overflow-y-auto
+                  ${isDark ? 'bg-neutral-900 border-neutral-700' : 'bg-white border-gray-200'}`}>
+                  {resultados.map((resultado) => {
+                    const tipo = pesquisaTipos[resultado.tipo];
+                    return (
+                      <button
+                        key={`${resultado.tipo}-${resultado.id}`}
+                        onClick={() => abrirResultado(resultado)}
+                        data-testid={`search-result-${resultado.id}`}
+                        className={`flex items-center gap-3 w-full px-3 py-2 text-left text-sm
+                          ${isDark ? 'text-neutral-300 hover:bg-neutral-800' : 'text-gray-700 hover:bg-gray-100'}`}
+                      >
+                        <tipo.icon className="h-4 w-4 flex-shrink-0 text-orange-500" />
+                        <span className="font-mono">{tipo.titulo(resultado)}</span>
+                        <span className={`truncate ${isDark ? 'text-neutral-500' : 'text-gray-500'}`}>{tipo.detalhe(resultado)}</span>
+                      </button>
+                    );
+                  })}
+                </div>
+              )}
+            </div>
+          </div>
 
           {/* Theme Toggle */}
           <button
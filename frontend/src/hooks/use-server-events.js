@@ -0,0 +1,27 @@
+import { useEffect, useRef } from "react";
+import { API } from "@/App";
+
+// Subscribes to /api/events (SSE) and calls onEvent for changes to the given collections.
+// "reset" events (missed changes) are always delivered so the page can refetch.
+export function useServerEvents(token, collections, onEvent) {
+  const handlerRef = useRef(onEvent);
+  handlerRef.current = onEvent;
+  const key = collections.join(",");
+
+  useEffect(() => {
+    if (!token || typeof EventSource === "undefined") return;
+    const watched = new Set(key.split(","));
+    const source = new EventSource(`${API}/events?token=${encodeURIComponent(token)}`);
+
+    const handle = (message) => {
+      const event = JSON.parse(message.data);
+      if (event.acao === "reset" || watched.has(event.colecao)) {
+        handlerRef.current(event);
+      }
+    };
+    ["criado", "atualizado", "eliminado", "importado", "reset"].forEach((tipo) =>
+      source.addEventListener(tipo, handle)
+    );
+    return () => source.close();
+  }, [token, key]);
+}
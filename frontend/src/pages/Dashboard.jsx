@@ -1,5 +1,6 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useAuth, useTheme, API } from "@/App";
+import { useServerEvents } from "@/hooks/use-server-events";
 import axios from "axios";
 import { 
   Wrench, 
@@ -12,18 +13,29 @@ import {
 } from "lucide-react";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
 import { Link } from "react-router-dom";
+import { ResponsiveContainer, LineChart, Line, XAxis, YAxis, Tooltip, Legend, CartesianGrid } from "recharts";
 
 export default function Dashboard() {
   const { token } = useAuth();
   const { theme } = useTheme();
   const [summary, setSummary] = useState(null);
+  const [tendencia, setTendencia] = useState([]);
   const [loading, setLoading] = useState(true);
   const isDark = theme === "dark";
 
+  const refreshTimer = useRef(null);
+
   useEffect(() => {
     fetchSummary();
+    return () => clearTimeout(refreshTimer.current);
   }, []);
 
+  // Bursts of changes (imports, cascades) trigger a single refetch
+  useServerEvents(token, ["equipamentos", "viaturas", "materiais", "obras", "movimentos"], () => {
+    clearTimeout(refreshTimer.current);
+    refreshTimer.current = setTimeout(fetchSummary, 500);
+  });
+
   const fetchSummary = async () => {
     try {
       const response = await axios.get(`${API}/summary`, {
@@ -35,6 +47,25 @@ export default function Dashboard() {
     } finally {
       setLoading(false);
     }
+    fetchTendencia();
+  };
+
+  // Last 30 days of movements, all series in one request
+  const fetchTendencia = async () => {
+    try {
+      const response = await axios.get(`${API}/kpis/serie`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { metric: "movimentos,stock", granularidade: "dia" }
+      });
+      const { movimentos, stock } = response.data.metricas;
+      setTendencia(movimentos.serie.map((ponto, i) => ({
+        dia: ponto.periodo.slice(5, 10),
+        ativos: ponto.total,
+        stock: stock.serie[i].movimentos
+      })));
+    } catch (error) {
+      console.error("Error fetching KPI series:", error);
+    }
   };
 
   if (loading) {
@@ -181,6 +212,32 @@ export default function Dashboard() {
           </Card>
         </Link>
       </div>
+
+      {/* Trend */}
+      {tendencia.length > 0 && (
+        <Card className={isDark ? 'bg-neutral-800 border-neutral-700' : 'bg-white border-gray-200 shadow-sm'} data-testid="kpi-trend">
+          <CardHeader className="pb-2">
+            <CardTitle className={`text-sm font-medium uppercase tracking-wider ${isDark ? 'text-neutral-400' : 'text-gray-500'}`}>
+              Movimentos nos últimos 30 dias
+            </CardTitle>
+          </CardHeader>
+          <CardContent>
+            <div className="h-64">
+              <ResponsiveContainer width="100%" height="100%">
+                <LineChart data={tendencia}>
+                  <CartesianGrid strokeDasharray="3 3" stroke={isDark ? '#404040' : '#e5e7eb'} />
+                  <XAxis dataKey="dia" stroke={isDark ? '#a3a3a3' : '#6b7280'} fontSize={12} />
+                  <YAxis allowDecimals={false} stroke={isDark ? '#a3a3a3' : '#6b7280'} fontSize={12} />
+                  <Tooltip contentStyle={{ backgroundColor: isDark ? '#262626' : '#fff', borderColor: isDark ? '#404040' : '#e5e7eb' }} />
+                  <Legend />
+                  <Line type="monotone" dataKey="ativos" name="Equipamentos/viaturas" stroke="#f97316" strokeWidth={2} dot={false} />
+                  <Line type="monotone" dataKey="stock" name="Stock" stroke="#10b981" strokeWidth={2} dot={false} />
+                </LineChart>
+              </ResponsiveContainer>
+            </div>
+          </CardContent>
+        </Card>
+      )}
     </div>
   );
 }
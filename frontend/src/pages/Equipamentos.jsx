@@ -57,12 +57,12 @@ export default function Equipamentos() {
     marca: "",
     modelo: "",
     data_aquisicao: "",
+    data_inspecao: "",
     ativo: true,
     categoria: "",
     numero_serie: "",
     estado_conservacao: "Bom",
-    foto: "",
-    obra_id: ""
+    foto: ""
   });
   const [atribuirData, setAtribuirData] = useState({
     obra_id: "",
@@ -91,10 +91,10 @@ export default function Equipamentos() {
   const handleSubmit = async (e) => {
     e.preventDefault();
     try {
-      const payload = { ...formData, obra_id: formData.obra_id || null };
+      const payload = { ...formData };
       if (selectedItem) {
         await axios.put(`${API}/equipamentos/${selectedItem.id}`, payload, {
-          headers: { Authorization: `Bearer ${token}` }
+          headers: { Authorization: `Bearer ${token}`, "If-Match": `"${selectedItem.version ?? 0}"` }
         });
         toast.success("Equipamento atualizado");
       } else {
@@ -165,12 +165,12 @@ export default function Equipamentos() {
       marca: item.marca || "",
       modelo: item.modelo || "",
       data_aquisicao: item.data_aquisicao?.split("T")[0] || "",
+      data_inspecao: item.data_inspecao?.split("T")[0] || "",
       ativo: item.ativo ?? true,
       categoria: item.categoria || "",
       numero_serie: item.numero_serie || "",
       estado_conservacao: item.estado_conservacao || "Bom",
-      foto: item.foto || "",
-      obra_id: item.obra_id || ""
+      foto: item.foto || ""
     });
     setDialogOpen(true);
   };
@@ -184,9 +184,9 @@ export default function Equipamentos() {
   const resetForm = () => {
     setSelectedItem(null);
     setFormData({
-      codigo: "", descricao: "", marca: "", modelo: "", data_aquisicao: "",
+      codigo: "", descricao: "", marca: "", modelo: "", data_aquisicao: "", data_inspecao: "",
       ativo: true, categoria: "", numero_serie: "",
-      estado_conservacao: "Bom", foto: "", obra_id: ""
+      estado_conservacao: "Bom", foto: ""
     });
   };
 
@@ -420,6 +420,10 @@ export default function Equipamentos() {
                 <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Data Aquisição</Label>
                 <Input type="date" value={formData.data_aquisicao} onChange={(e) => setFormData({...formData, data_aquisicao: e.target.value})} className={inputClass} />
               </div>
+              <div className="space-y-2">
+                <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Próxima Inspeção</Label>
+                <Input type="date" value={formData.data_inspecao} onChange={(e) => setFormData({...formData, data_inspecao: e.target.value})} className={inputClass} />
+              </div>
               <div className="space-y-2">
                 <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Estado Conservação</Label>
                 <Select value={formData.estado_conservacao} onValueChange={(v) => setFormData({...formData, estado_conservacao: v})}>
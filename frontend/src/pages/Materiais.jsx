@@ -90,7 +90,7 @@ export default function Materiais() {
     e.preventDefault();
     try {
       if (selectedItem) {
-        await axios.put(`${API}/materiais/${selectedItem.id}`, formData, { headers: { Authorization: `Bearer ${token}` } });
+        await axios.put(`${API}/materiais/${selectedItem.id}`, formData, { headers: { Authorization: `Bearer ${token}`, "If-Match": `"${selectedItem.version ?? 0}"` } });
         toast.success("Material atualizado");
       } else {
         await axios.post(`${API}/materiais`, formData, { headers: { Authorization: `Bearer ${token}` } });
@@ -315,8 +315,8 @@ export default function Materiais() {
                 </Select>
               </div>
               <div className="space-y-2">
-                <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Stock Atual</Label>
-                <Input type="number" step="0.01" value={formData.stock_atual} onChange={(e) => setFormData({...formData, stock_atual: parseFloat(e.target.value) || 0})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />
+                <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>{selectedItem ? "Stock Atual (alterar por movimento)" : "Stock Inicial"}</Label>
+                <Input type="number" step="0.01" value={formData.stock_atual} disabled={!!selectedItem} onChange={(e) => setFormData({...formData, stock_atual: parseFloat(e.target.value) || 0})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />
               </div>
               <div className="space-y-2">
                 <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Stock Mínimo</Label>
@@ -72,7 +72,7 @@ export default function Obras() {
     e.preventDefault();
     try {
       if (selectedItem) {
-        await axios.put(`${API}/obras/${selectedItem.id}`, formData, { headers: { Authorization: `Bearer ${token}` } });
+        await axios.put(`${API}/obras/${selectedItem.id}`, formData, { headers: { Authorization: `Bearer ${token}`, "If-Match": `"${selectedItem.version ?? 0}"` } });
         toast.success("Obra atualizada");
       } else {
         await axios.post(`${API}/obras`, formData, { headers: { Authorization: `Bearer ${token}` } });
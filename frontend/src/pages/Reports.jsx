@@ -38,7 +38,7 @@ export default function Reports() {
   const { theme } = useTheme();
   const isDark = theme === "dark";
   
-  const [downloading, setDownloading] = useState({ pdf: false, excel: false });
+  const [downloading, setDownloading] = useState({ pdf: false, excel: false, matriz: false });
   const [uploading, setUploading] = useState(false);
   const [summary, setSummary] = useState(null);
   const [obras, setObras] = useState([]);
@@ -182,6 +182,38 @@ export default function Reports() {
     }
   };
 
+  const downloadConsumoMatriz = async () => {
+    setDownloading({ ...downloading, matriz: true });
+    try {
+      // Period from the report filters: the chosen month, or the whole year
+      const ano = Number(filtroAno) || new Date().getFullYear();
+      const mes = Number(filtroMes);
+      const pad = (n) => String(n).padStart(2, "0");
+      const de = mes ? `${ano}-${pad(mes)}-01` : `${ano}-01-01`;
+      const ate = mes ? `${ano}-${pad(mes)}-${pad(new Date(ano, mes, 0).getDate())}` : `${ano}-12-31`;
+      const response = await axios.get(`${API}/relatorios/consumo-matriz`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { de, ate, formato: "xlsx" },
+        responseType: "blob"
+      });
+      
+      const url = window.URL.createObjectURL(new Blob([response.data]));
+      const link = document.createElement("a");
+      link.href = url;
+      link.setAttribute("download", `consumo_obras_${de}_${ate}.xlsx`);
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      window.URL.revokeObjectURL(url);
+      
+      toast.success("Matriz de consumo exportada com sucesso");
+    } catch (error) {
+      toast.error("Erro ao exportar matriz de consumo");
+    } finally {
+      setDownloading({ ...downloading, matriz: false });
+    }
+  };
+
   const handleImportClick = () => {
     fileInputRef.current?.click();
   };
@@ -677,6 +709,16 @@ export default function Reports() {
                   <Download className="h-4 w-4 mr-2" />
                   {downloading.excel ? "A exportar..." : "Exportar Excel"}
                 </Button>
+                <Button 
+                  onClick={downloadConsumoMatriz} 
+                  disabled={downloading.matriz}
+                  variant="outline"
+                  className="w-full mt-2"
+                  data-testid="export-consumo-matriz-btn"
+                >
+                  <Download className="h-4 w-4 mr-2" />
+                  {downloading.matriz ? "A exportar..." : "Consumo por obra (matriz)"}
+                </Button>
               </CardContent>
             </Card>
 
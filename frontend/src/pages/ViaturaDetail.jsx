@@ -244,6 +244,11 @@ export default function ViaturaDetail() {
                 <CardTitle className="text-lg text-white flex items-center gap-2">
                   <Gauge className="h-5 w-5 text-orange-500" />
                   Histórico de Quilómetros
+                  {viatura.km_atual != null && (
+                    <span className="ml-auto text-sm font-mono text-neutral-400">
+                      Odómetro: <span className="text-white">{viatura.km_atual.toLocaleString()} km</span>
+                    </span>
+                  )}
                 </CardTitle>
               </CardHeader>
               <CardContent>
@@ -263,7 +268,14 @@ export default function ViaturaDetail() {
                         <tr key={km.id || idx} className="border-b border-neutral-700/50 text-neutral-300">
                           <td className="py-2">{km.data ? formatDateSimple(km.data) : "-"}</td>
                           <td className="py-2">{km.condutor || "-"}</td>
-                          <td className="py-2 text-right font-mono">{km.km_inicial?.toLocaleString() || "-"}</td>
+                          <td className="py-2 text-right font-mono">
+                            {km.lacuna_km > 0 && (
+                              <span className="mr-2 text-xs text-amber-500" title="Km não registados desde o registo anterior">
+                                +{km.lacuna_km.toLocaleString()} em falta
+                              </span>
+                            )}
+                            {km.km_inicial?.toLocaleString() || "-"}
+                          </td>
                           <td className="py-2 text-right font-mono">{km.km_final?.toLocaleString() || "-"}</td>
                           <td className="py-2 text-right font-mono text-orange-400">
                             {km.km_inicial && km.km_final ? (km.km_final - km.km_inicial).toLocaleString() : "-"}
@@ -62,10 +62,11 @@ export default function Viaturas() {
     foto: "",
     data_vistoria: "",
     data_seguro: "",
+    data_tacografo: "",
+    km_ultima_revisao: "",
     documento_unico: "",
     apolice_seguro: "",
-    observacoes: "",
-    obra_id: ""
+    observacoes: ""
   });
   const [atribuirData, setAtribuirData] = useState({
     obra_id: "",
@@ -106,9 +107,9 @@ export default function Viaturas() {
   const handleSubmit = async (e) => {
     e.preventDefault();
     try {
-      const payload = { ...formData, obra_id: formData.obra_id || null };
+      const payload = { ...formData, km_ultima_revisao: formData.km_ultima_revisao === "" ? null : Number(formData.km_ultima_revisao) };
       if (selectedItem) {
-        await axios.put(`${API}/viaturas/${selectedItem.id}`, payload, { headers: { Authorization: `Bearer ${token}` } });
+        await axios.put(`${API}/viaturas/${selectedItem.id}`, payload, { headers: { Authorization: `Bearer ${token}`, "If-Match": `"${selectedItem.version ?? 0}"` } });
         toast.success("Viatura atualizada");
       } else {
         await axios.post(`${API}/viaturas`, payload, { headers: { Authorization: `Bearer ${token}` } });
@@ -177,10 +178,11 @@ export default function Viaturas() {
       foto: item.foto || "",
       data_vistoria: item.data_vistoria?.split("T")[0] || "",
       data_seguro: item.data_seguro?.split("T")[0] || "",
+      data_tacografo: item.data_tacografo?.split("T")[0] || "",
+      km_ultima_revisao: item.km_ultima_revisao ?? "",
       documento_unico: item.documento_unico || "",
       apolice_seguro: item.apolice_seguro || "",
-      observacoes: item.observacoes || "",
-      obra_id: item.obra_id || ""
+      observacoes: item.observacoes || ""
     });
     setDialogOpen(true);
   };
@@ -195,8 +197,8 @@ export default function Viaturas() {
     setSelectedItem(null);
     setFormData({
       matricula: "", marca: "", modelo: "", combustivel: "Gasoleo", ativa: true,
-      foto: "", data_vistoria: "", data_seguro: "", documento_unico: "",
-      apolice_seguro: "", observacoes: "", obra_id: ""
+      foto: "", data_vistoria: "", data_seguro: "", data_tacografo: "", km_ultima_revisao: "", documento_unico: "",
+      apolice_seguro: "", observacoes: ""
     });
   };
 
@@ -409,6 +411,14 @@ export default function Viaturas() {
                 <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Data Seguro</Label>
                 <Input type="date" value={formData.data_seguro} onChange={(e) => setFormData({...formData, data_seguro: e.target.value})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />
               </div>
+              <div className="space-y-2">
+                <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Calibração Tacógrafo</Label>
+                <Input type="date" value={formData.data_tacografo} onChange={(e) => setFormData({...formData, data_tacografo: e.target.value})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />
+              </div>
+              <div className="space-y-2">
+                <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Km Última Revisão</Label>
+                <Input type="number" min="0" value={formData.km_ultima_revisao} onChange={(e) => setFormData({...formData, km_ultima_revisao: e.target.value})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />
+              </div>
               <div className="space-y-2">
                 <Label className={isDark ? 'text-neutral-300' : 'text-gray-700'}>Documento Único</Label>
                 <Input value={formData.documento_unico} onChange={(e) => setFormData({...formData, documento_unico: e.target.value})} className={isDark ? 'bg-neutral-800 border-neutral-700 text-white' : 'bg-white border-gray-300'} />